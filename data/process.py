@@ -1,60 +1,128 @@
-import requests 
-import pandas as pd 
-from dotenv import load_dotenv
-import os 
+import requests
+import argparse
+import csv
+import io
+import json
+import os
+from pathlib import Path
+
+"""Builds tickers.csv from the NASDAQ symbol directories
+Each directory is kept in ./sources next to its ETag / Last-Modified, later runs ask for it with If-None-Match /
+If-Modified-Since and reuse the local copy on a 304, so nothing is downloaded when NASDAQ has not changed it.
+With --offline (or when a download fails) the local copies stand in for the download.
+tickers.csv is only rewritten when its content changes, the processor compiles it into the universe snapshot
+(processor/tickers/universe.py) and only rebuilds the snapshot when the csv changes.
+"""
 
 URLS ={
     'NASDAQ': 'https://www.nasdaqtrader.com/dynamic/symdir/nasdaqlisted.txt',
     'OTHER_LISTED': 'https://www.nasdaqtrader.com/dynamic/symdir/otherlisted.txt',
 }
 
-def get_ticker_data(URL):
-    resp = requests.get(URL)
+SOURCES = Path(__file__).resolve().parent / "sources"
+
+
+def fetch_source(name, URL, offline = False, timeout = 30):
+    """
+    The text of a symbol directory, downloaded only when it changed since the last run
+    Args:
+        name: key in URLS, the local copy is sources/<name>.txt
+        URL: the directory to download
+        offline: only use the local copy
+    Returns:
+        (text, changed) where changed is False when the local copy was used
+    """
+    local = SOURCES / f"{name}.txt"
+    meta_path = SOURCES / f"{name}.json"
+    meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+
+    if offline:
+        if not local.exists():
+            raise FileNotFoundError(f"no local copy of {name} at {local}, run once without --offline")
+        return local.read_text(encoding="utf-8"), False
+
+    headers = {}
+    if local.exists():
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        resp = requests.get(URL, headers=headers, timeout=timeout)
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        if not local.exists():
+            raise
+        print(f"Could not download {name}, using the local copy: ", e)
+        return local.read_text(encoding="utf-8"), False
+
+    if resp.status_code == 304:
+        return local.read_text(encoding="utf-8"), False
 
-    data = resp.text.split("\n")
+    SOURCES.mkdir(exist_ok=True)
+    local.write_text(resp.text, encoding="utf-8")
+    meta_path.write_text(json.dumps({
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }))
+    return resp.text, True
+
+
+def get_ticker_data(text):
+    data = text.split("\n")
     tickerls = list()
     namels = list()
-    
+
     for line in data[1:len(data)-2]:
-        elements = line.split("|")[0:2] # first and second row contain the ticker and the company name 
+        elements = line.split("|")[0:2] # first and second row contain the ticker and the company name
+        if len(elements) < 2:
+            continue
         tickerls.append(elements[0].strip())
         namels.append(elements[1].split("-")[0].strip())
-    
-    return tickerls, namels
 
-def prepare_file(file_path):
+    return tickerls, namels
 
-    write_header =  os.path.exists(file_path)
-    if write_header:
-        columns = ["Ticker", "Name"]
-        pd.DataFrame(columns = columns).to_csv(file_path, index = False)
 
+def render_csv(texts):
+    # the whole file as a string, so it can be compared with what is already on disk
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["Ticker", "Name"])
+    for text in texts:
+        tickers, names = get_ticker_data(text)
+        writer.writerows(zip(tickers, names))
+    return buffer.getvalue()
 
 
-def create_dataframe(URL):
-    
-    tickers, names = get_ticker_data(URL)
-    
-    df = pd.DataFrame({"Ticker": tickers, "Name": names})
+def create_file(file_path = "./tickers.csv", offline = False):
+    """
+    Brings tickers.csv up to date with the symbol directories
+    Returns:
+        True when the file was rewritten
+    """
+    texts = [fetch_source(name, url, offline)[0] for name, url in URLS.items()]
+    content = render_csv(texts)
 
-    return df
-        
+    if os.path.exists(file_path):
+        with open(file_path, encoding="utf-8", newline="") as f:
+            if f.read() == content:
+                print(f"{file_path} is up to date")
+                return False
 
-def create_file(file_path = "./tickers.csv"):
+    # written next to it and renamed so the processor never reads half a file
+    tmp = f"{file_path}.tmp"
+    with open(tmp, "w", encoding="utf-8", newline="") as f:
+        f.write(content)
+    os.replace(tmp, file_path)
+    print(f"wrote {file_path}")
+    return True
 
-    prepare_file(file_path)
 
-    for name, url in URLS.items():
-        write_header = not os.path.exists(file_path)
-        df = create_dataframe(url)
-        df.to_csv(
-            file_path,
-            mode='a',
-            header = write_header,
-            index = False
-        )
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build tickers.csv from the NASDAQ symbol directories")
+    parser.add_argument("file_path", nargs="?", default="./tickers.csv")
+    parser.add_argument("--offline", action="store_true", help="use the copies in ./sources instead of downloading")
+    args = parser.parse_args()
 
-    create_file()
-    
-
+    create_file(args.file_path, args.offline)
@@ -0,0 +1,11 @@
+-- the transaction that inserted each post and comment, the incremental processor's watermark (see incremental.py)
+-- rows from before the column stay NULL, the collector's upserts only set it on insert
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS xact XID8;
+ALTER TABLE posts ALTER COLUMN xact SET DEFAULT pg_current_xact_id();
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS xact XID8;
+ALTER TABLE comments ALTER COLUMN xact SET DEFAULT pg_current_xact_id();
+CREATE INDEX IF NOT EXISTS idx_posts_xact ON posts (xact);
+CREATE INDEX IF NOT EXISTS idx_comments_xact ON comments (xact);
+-- rows from before the column are taken in (inserted_at, id) order by the first run after it
+CREATE INDEX IF NOT EXISTS idx_posts_inserted_at ON posts (inserted_at, id);
+CREATE INDEX IF NOT EXISTS idx_comments_inserted_at ON comments (inserted_at, id);
@@ -1,7 +1,7 @@
 CREATE TABLE IF NOT EXISTS comment_tickers (
     id BIGSERIAL PRIMARY KEY,
     comment_id VARCHAR(255) NOT NULL REFERENCES comments(id),
-    parent_id VARCHAR(255) REFERENCES comments(id)
+    parent_id VARCHAR(255) REFERENCES comments(id),
     post_id VARCHAR(255) NULL REFERENCES posts(id),   -- helpful to query by post
     ticker TEXT NOT NULL,                              -- normalized uppercase ticker
     detected_by TEXT NOT NULL,                         -- 'dollar_regex'|'allcaps_regex'|'symbol_prefix'|'ml'|'propagated'
@@ -12,11 +12,21 @@ CREATE TABLE IF NOT EXISTS comment_tickers (
     author TEXT,                                       -- comment author (copy for fast aggregation)
     created_utc BIGINT,                                -- copy of comment timestamp (epoch)
     sentiment_real REAL,                               -- raw sentiment score (e.g. VADER compound) for this comment
+    universe_version TEXT,                             -- ticker universe snapshot the match was made with
     validated BOOLEAN DEFAULT FALSE,                   -- set true if human-reviewed
-    inserted_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+    inserted_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    xact XID8 DEFAULT pg_current_xact_id()             -- transaction that inserted the row, the rollup's watermark
 );
 
 -- index for fast aggregation & lookups
-CREATE INDEX IF NOT EXISTS idx_comment_tickers_ticker_date ON comment_tickers (ticker, to_timestamp(created_utc)::date);
+CREATE INDEX IF NOT EXISTS idx_comment_tickers_ticker_date ON comment_tickers (ticker, ((to_timestamp(created_utc) AT TIME ZONE 'UTC')::date));
 CREATE INDEX IF NOT EXISTS idx_comment_tickers_comment ON comment_tickers (comment_id);
 CREATE INDEX IF NOT EXISTS idx_comment_tickers_post ON comment_tickers (post_id);
+-- one row per ticker per comment, the writers upsert against this
+CREATE UNIQUE INDEX IF NOT EXISTS uq_comment_tickers_comment_ticker ON comment_tickers (comment_id, ticker);
+-- tables created before the universe snapshot
+ALTER TABLE comment_tickers ADD COLUMN IF NOT EXISTS universe_version TEXT;
+-- tables created before the rollup's transaction watermark, rows from before it stay NULL
+ALTER TABLE comment_tickers ADD COLUMN IF NOT EXISTS xact XID8;
+ALTER TABLE comment_tickers ALTER COLUMN xact SET DEFAULT pg_current_xact_id();
+CREATE INDEX IF NOT EXISTS idx_comment_tickers_xact ON comment_tickers (xact);
@@ -9,9 +9,19 @@ CREATE TABLE IF NOT EXISTS post_tickers(
     author TEXT, 
     created_utc BIGINT,
     sentiment_real REAL,
+    universe_version TEXT,
     validated BOOLEAN DEFAULT FALSE,
-    inserted_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+    inserted_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+    xact XID8 DEFAULT pg_current_xact_id()
 );
 
-CREATE INDEX IF NOT EXISTS idx_post_tickers_date ON post_tickers (ticker, to_timestamp(created_utc)::date);
-CREATE INDEX IF NOT EXISTS idx_post_tickers_post ON post_ticker (post_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_post_tickers_date ON post_tickers (ticker, ((to_timestamp(created_utc) AT TIME ZONE 'UTC')::date));
+CREATE INDEX IF NOT EXISTS idx_post_tickers_post ON post_tickers (post_id);
+-- one row per ticker per post, the writers upsert against this
+CREATE UNIQUE INDEX IF NOT EXISTS uq_post_tickers_post_ticker ON post_tickers (post_id, ticker);
+-- tables created before the universe snapshot
+ALTER TABLE post_tickers ADD COLUMN IF NOT EXISTS universe_version TEXT;
+-- tables created before the rollup's transaction watermark, rows from before it stay NULL
+ALTER TABLE post_tickers ADD COLUMN IF NOT EXISTS xact XID8;
+ALTER TABLE post_tickers ALTER COLUMN xact SET DEFAULT pg_current_xact_id();
+CREATE INDEX IF NOT EXISTS idx_post_tickers_xact ON post_tickers (xact);
@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS processor_checkpoints(
+    table_name TEXT PRIMARY KEY,                            -- 'posts' or 'comments'
+    last_inserted_at TIMESTAMP WITH TIME ZONE NOT NULL,     -- inserted_at of the last processed row (high-water mark)
+    last_id VARCHAR(255) NOT NULL,                          -- id of the last processed row, breaks inserted_at ties
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+);
+
+-- the incremental scans go by the transaction that inserted each row (collector_xact.sql), see incremental.py
+ALTER TABLE processor_checkpoints ADD COLUMN IF NOT EXISTS since_xact XID8;            -- rows from this transaction horizon on are new
+ALTER TABLE processor_checkpoints ADD COLUMN IF NOT EXISTS run_xact XID8;              -- horizon of a run that has not finished, NULL between runs
+ALTER TABLE processor_checkpoints ADD COLUMN IF NOT EXISTS run_created_utc BIGINT;     -- (created_utc, id) of the last row that run wrote
+ALTER TABLE processor_checkpoints ADD COLUMN IF NOT EXISTS run_last_id VARCHAR(255);
@@ -0,0 +1,27 @@
+CREATE TABLE IF NOT EXISTS processor_leases(
+    run_id TEXT NOT NULL,                                   -- one plan, several workers
+    shard INTEGER NOT NULL,                                 -- number of the unit of work within the run
+    post_ids VARCHAR(255)[] NOT NULL,                       -- whole posts with all their comments
+    root_ids VARCHAR(255)[],                                -- set for a split megathread: only these top level comments and their replies
+    comments INTEGER NOT NULL,                              -- comments in the shard, biggest are handed out first
+    status TEXT NOT NULL DEFAULT 'pending',                 -- 'pending'|'leased'|'done'|'failed'
+    owner TEXT,                                             -- worker holding the lease (host:pid)
+    leased_until TIMESTAMP WITH TIME ZONE,                  -- the lease is up for grabs again after this
+    heartbeat_at TIMESTAMP WITH TIME ZONE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    matches INTEGER,                                        -- comment matches written by the shard
+    error TEXT,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (run_id, shard)
+);
+
+-- claims look for pending or expired leases of a run
+CREATE INDEX IF NOT EXISTS idx_processor_leases_claim ON processor_leases (run_id, status, leased_until);
+
+-- the shards read the comments of their posts and walk reply trees
+CREATE INDEX IF NOT EXISTS idx_comments_post ON comments (post_id);
+CREATE INDEX IF NOT EXISTS idx_comments_parent ON comments (parent_id);
+
+-- the full scan (tickers.Comment_Scan) walks the comments oldest first without sorting the table
+CREATE INDEX IF NOT EXISTS idx_comments_created_id ON comments (created_utc, id);
@@ -0,0 +1,99 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import tickers
+from bench_matcher import synthetic_universe
+from corpus import synthetic_reddit
+from extract_cache import ExtractionCache
+from workers import start_pool, match_batches, match_comment
+
+"""Benchmark and regression check for the extraction cache
+Matches a synthetic corpus the way a collection cycle sees it: the whole corpus again every cycle (the collector
+upserts the same comments each time) with a share of copypasta bodies repeated across comments. Timed per run:
+    no cache     every body goes to the pool
+    cold         empty cache file
+    warm memory  same cache object, hits come from the LRU
+    warm disk    new cache object on the same file, hits come from SQLite
+Every run has to give the same results as the run without the cache, and a cache with a small max_entries has to stay
+inside it. Exits non zero otherwise.
+Run from processor/tickers:
+    python bench_cache.py --comments-per-post 2000
+"""
+
+
+def bodies(comment_rows, copypasta, seed = 11):
+    rng = random.Random(seed)
+    pasta = [row[1] or "" for row in rng.sample(comment_rows, min(50, len(comment_rows)))]
+    return [rng.choice(pasta) if rng.random() < copypasta else row[1] or "" for row in comment_rows]
+
+
+def run(pool, texts, batchSize, cache = None):
+    rows = [(None, None, None, text) for text in texts]
+    batches = (rows[i:i + batchSize] for i in range(0, len(rows), batchSize))
+    start = time.perf_counter()
+    results = [r for _, bucketed in match_batches(pool, batches, match_comment, 3, cache=cache) for r in bucketed]
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extraction cache benchmark")
+    parser.add_argument("--universe", type=int, default=8000)
+    parser.add_argument("--posts", type=int, default=50, help="posts per subreddit")
+    parser.add_argument("--comments-per-post", type=int, default=400)
+    parser.add_argument("--copypasta", type=float, default=0.2, help="share of bodies that repeat another comment")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    universe = synthetic_universe(args.universe)
+    _, comment_rows = synthetic_reddit(universe, posts=args.posts, comments_per_post=args.comments_per_post)
+    texts = bodies(comment_rows, args.copypasta)
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp, start_pool(universe, args.workers) as pool:
+        path = os.path.join(tmp, "extract_cache.sqlite")
+        expected, base = run(pool, texts, args.batch_size)
+        print(f"{'no cache':<12} {len(texts) / base:>12,.0f} comments/sec")
+
+        cache = ExtractionCache(path, "bench")
+        runs = [("cold", cache), ("warm memory", cache)]
+        for name, run_cache in runs:
+            results, elapsed = run(pool, texts, args.batch_size, run_cache)
+            print(f"{name:<12} {len(texts) / elapsed:>12,.0f} comments/sec  {base / elapsed:>5.1f}x  {run_cache.report()}")
+            failed |= results != expected
+        cache.close()
+
+        with ExtractionCache(path, "bench", memory_size=0) as disk:
+            results, elapsed = run(pool, texts, args.batch_size, disk)
+            print(f"{'warm disk':<12} {len(texts) / elapsed:>12,.0f} comments/sec  {base / elapsed:>5.1f}x  {disk.report()}")
+            failed |= results != expected
+
+        # another universe must not see these results
+        with ExtractionCache(path, "other") as other:
+            other.lookup("match_comment", texts[:1000])
+            failed |= other.disk_hits != 0
+
+        # bounded file, the oldest generations go first
+        bound = max(1, len(set(texts)) // 4)
+        with ExtractionCache(os.path.join(tmp, "bounded.sqlite"), "bench", max_entries=bound, flush_every=500) as bounded:
+            results, _ = run(pool, texts, args.batch_size, bounded)
+            bounded.flush()
+            kept = bounded.db.execute("SELECT count(*) FROM extractions").fetchone()[0]
+            print(f"bounded to {bound:,} entries: {kept:,} kept, {bounded.evicted:,} evicted")
+            failed |= results != expected or kept > bound * 1.1
+
+    # the in process path, tickers.process_text with a cache gives the same dicts
+    matcher_cache = ExtractionCache(None, "bench")
+    sample = texts[:5000]
+    failed |= [tickers.process_text(t, universe, cache=matcher_cache) for t in sample] != \
+              [tickers.process_text(t, universe) for t in sample]
+
+    if failed:
+        print("MISMATCH: cached results differ from matching")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import numpy as np
+from bench_matcher import synthetic_universe
+from matcher import TickerMatcher
+from disambiguate import examples, fit, precision_recall
+from workers import start_pool, match_batches, match_comment
+
+"""Precision, recall and throughput of the lowercase ticker model
+A synthetic corpus where common words are tickers too (all, now, fun, love, and any random symbol that happens to be
+a word) and real mentions come in a trading context, written as $GME, GME, ticker: GME or gme. Every lowercase
+mention is recorded, so each lowercase candidate of the matcher is known to be a mention or not.
+The model is trained on one corpus with the weak labels of disambiguate.examples (nothing of the truth) and scored on
+another one against the truth, next to the rule it replaces (a lowercase candidate counts when the text has a context
+word or a number).
+Throughput is matched in process over the test corpus:
+    no lowercase    allow_lowercase off, what the pipeline does without a model
+    rule            lowercase candidates kept on context or a number
+    per text        the model, one predict per text (TickerMatcher.mentions)
+    batched         the model, one predict per chunk (TickerMatcher.mentions_many)
+and then through the worker pool with the model file in PROCESSOR_LOWERCASE_MODEL.
+Batched and per text have to give the same mentions and the model has to beat the rule on F1. Exits non zero otherwise.
+Run from processor/tickers:
+    python bench_disambiguate.py --docs 50000
+"""
+
+Word_Tickers = ("ALL", "ARE", "FOR", "NOW", "FUN", "BIG", "LOVE", "REAL", "HOME", "WELL", "PLAY", "OPEN", "CASH",
+                "POST", "LIFE", "EAT", "CAR", "AIR", "ANY", "ONE", "TEAM", "GOOD", "BEST", "FAST", "JOB", "SAFE",
+                "TRUE", "ME", "HAS", "CAN")
+
+Mention_Templates = (
+    "{m} calls expiring friday", "bought {n} shares of {m}", "{m} earnings next week", "loaded up on {m} at {n}",
+    "{m} is going to the moon", "sold my {m} puts", "{m} to {n} by eow", "holding {m} since {n}", "thoughts on {m}",
+    "{m} gapped up today", "{m} short interest is insane", "averaged down on {m}", "{m} dip is a gift", "long {m}",
+)
+
+Chatter = (
+    "i think it is all going to be fine", "are you going to the game now", "that was fun", "big if true",
+    "love this sub", "for real though", "stay home and eat", "well played sir", "good post", "any news on this",
+    "one more day", "my wife has a new car", "can we all just agree", "open the window for some air",
+    "best team in the league", "that job was not safe", "life is good", "fast and cheap", "post your positions now",
+    "all in on calls", "are we going to buy the dip", "cash is king for now", "who else is holding",
+)
+
+Numbers = ("100", "12.5", "40", "5th", "2x", "Q3", "420.69", "3/15")
+
+
+def synthetic_texts(symbols, docs, seed):
+    """
+    Returns:
+        (texts, truth): truth[i] is the set of (pos, ticker) of the lowercase mentions in texts[i]
+    """
+    rng = random.Random(seed)
+    texts = []
+    truth = []
+    for _ in range(docs):
+        parts = []
+        found = set()
+        length = 0
+        sentences = [rng.choice(Chatter) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.5:
+            sentences.insert(rng.randrange(len(sentences) + 1), None)
+        for sentence in sentences:
+            if length:
+                parts.append(". ")
+                length += 2
+            if sentence is not None:
+                parts.append(sentence)
+                length += len(sentence)
+                continue
+            template = rng.choice(Mention_Templates)
+            symbol = rng.choice(Word_Tickers) if rng.random() < 0.15 else rng.choice(symbols)
+            form = rng.random()
+            if form < 0.35:
+                mention = "$" + symbol
+            elif form < 0.7:
+                mention = symbol
+            elif form < 0.75:
+                mention = "ticker: " + symbol
+            else:
+                mention = symbol.lower()
+            before, after = template.split("{m}")
+            before = before.replace("{n}", rng.choice(Numbers))
+            after = after.replace("{n}", rng.choice(Numbers))
+            if mention.islower():
+                found.add((length + len(before), symbol))
+            parts.extend((before, mention, after))
+            length += len(before) + len(mention) + len(after)
+        texts.append("".join(parts))
+        truth.append(found)
+    return texts, truth
+
+
+def lowercase_truth(matcher, texts, truth):
+    # every lowercase candidate of the test texts with its true label, and what the rule says about it
+    labels = []
+    rule = []
+    for text, found in zip(texts, truth):
+        scan = matcher.scan(text, True)
+        for ticker, kind, pos, raw in scan.lowercase:
+            labels.append(1 if (pos, ticker) in found else 0)
+            rule.append(scan.has_context or scan.has_number)
+    return np.array(labels), np.array(rule)
+
+
+def throughput(fn, texts, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(texts)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(texts) / best
+
+
+def f1(precision, recall):
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lowercase ticker model benchmark")
+    parser.add_argument("--universe", type=int, default=8000)
+    parser.add_argument("--docs", type=int, default=30000, help="texts in each of the train and test corpus")
+    parser.add_argument("--chunk", type=int, default=64, help="texts per mentions_many call, like a worker task")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    universe = frozenset(synthetic_universe(args.universe) | set(Word_Tickers))
+    symbols = sorted(universe)
+    train_texts, _ = synthetic_texts(symbols, args.docs, seed=1)
+    test_texts, truth = synthetic_texts(symbols, args.docs, seed=2)
+    plain = TickerMatcher(universe)
+    failed = False
+
+    start = time.perf_counter()
+    rows, labels = examples(train_texts, plain)
+    classifier = fit(rows, labels)
+    print(f"trained on {len(rows):,} weak labels ({int(labels.sum()):,} mentions) in {time.perf_counter() - start:.2f}s")
+    model = TickerMatcher(universe, classifier=classifier)
+
+    test_labels, rule = lowercase_truth(plain, test_texts, truth)
+    test_rows = []
+    for text in test_texts:
+        scan = plain.scan(text, True)
+        test_rows.extend(classifier.features(text, c, scan) for c in scan.lowercase)
+    probabilities = classifier.predict(test_rows)
+    print(f"{len(test_labels):,} lowercase candidates in the test corpus, {int(test_labels.sum()):,} of them mentions")
+    rule_f1 = f1(*precision_recall(rule.astype(float), test_labels, 0.5))
+    print(f"  {'rule':<12} precision {precision_recall(rule.astype(float), test_labels, 0.5)[0]:.3f} "
+          f"recall {precision_recall(rule.astype(float), test_labels, 0.5)[1]:.3f} F1 {rule_f1:.3f}")
+    best_f1 = 0.0
+    for threshold in (0.5, 0.9):
+        precision, recall = precision_recall(probabilities, test_labels, threshold)
+        best_f1 = max(best_f1, f1(precision, recall))
+        print(f"  model > {threshold:<4} precision {precision:.3f} recall {recall:.3f} F1 {f1(precision, recall):.3f}")
+    failed |= best_f1 <= rule_f1
+
+    chunks = lambda texts: [texts[i:i + args.chunk] for i in range(0, len(texts), args.chunk)]
+    paths = [
+        ("no lowercase", lambda texts: [plain.mentions(t) for t in texts]),
+        ("rule", lambda texts: [plain.mentions(t, allow_lowercase=True, threshold=0.5) for t in texts]),
+        ("per text", lambda texts: [model.mentions(t, allow_lowercase=True) for t in texts]),
+        ("batched", lambda texts: [m for c in chunks(texts) for m in model.mentions_many(c, allow_lowercase=True)]),
+    ]
+    for name, fn in paths:
+        print(f"  {name:<12} {throughput(fn, test_texts):>10,.0f} texts/sec")
+    same = paths[2][1](test_texts) == paths[3][1](test_texts)
+    print(f"batched and per text give the same mentions: {same}")
+    failed |= not same
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "lowercase_model.npz")
+        classifier.save(path)
+        os.environ["PROCESSOR_LOWERCASE_MODEL"] = path
+        with start_pool(universe, args.workers) as pool:
+            batches = [[(None, None, None, t) for t in test_texts[i:i + 2000]] for i in range(0, len(test_texts), 2000)]
+            start = time.perf_counter()
+            pooled = [r for _, bucketed in match_batches(pool, batches, match_comment, 3, args.chunk) for r in bucketed]
+            elapsed = time.perf_counter() - start
+        print(f"  {'pool':<12} {len(test_texts) / elapsed:>10,.0f} texts/sec with {args.workers} workers")
+        failed |= pooled != paths[3][1](test_texts)
+
+    if failed:
+        print("MISMATCH: the model lost to the rule or the paths disagree")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
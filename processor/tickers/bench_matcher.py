@@ -0,0 +1,143 @@
+import argparse
+import random
+import string
+import time
+from pathlib import Path
+import tickers
+from matcher import TickerMatcher
+
+"""Parity check and micro benchmark for the single pass matcher against the original regex path
+Run from processor/tickers:
+    python bench_matcher.py                      # synthetic ticker universe
+    python bench_matcher.py --tickers tickers.csv --docs 50000
+Exits non zero if any text gives different results on the two paths.
+"""
+
+# edge cases the regex rules are touchy about, all of these must agree on both paths
+Edge_Cases = [
+    "$TSLA to the moon, bought 100 shares",
+    "ticker: AAPL earnings next week",
+    "tickerAAPL and symbol:   gme",
+    "ticker ticker AAPL",
+    "Symbol\n\tNVDA looks cheap",
+    "xAAPL ABCDEFG AAPL_ AAPL1 1AAPL",
+    "M&A talk about amd at 12.50",
+    "m & a is not context, amd 5th",
+    "$$GME $gme$AMC $ABCDEF",
+    "watching nvda 2024Q3, a1b2 ab12cd",
+    "price was £13.37 for tsla",
+    "ＡＡＰＬ is fullwidth, 𝟙𝟚 are math digits",
+    "Kelvin ſell ticker: KO",
+    "IT AI CEO US UK are redlisted but GME is not",
+    "",
+    "1234567890" * 12 + " GME " + "x" * 60 + "9",
+    "AMD" + " filler" * 20 + " 42",
+]
+
+Filler = ("the", "and", "this", "that", "going", "just", "think", "market", "today", "really", "lol", "yolo",
+          "when", "calls", "puts", "week", "money", "about", "with", "from")
+
+
+def synthetic_universe(size = 8000, seed = 7):
+    rng = random.Random(seed)
+    universe = {"AAPL", "TSLA", "GME", "AMC", "NVDA", "AMD", "KO", "IT", "AI", "US", "BUY", "LOL", "JUST", "WEEK", "SO", "S"}
+    while len(universe) < size:
+        universe.add("".join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(1, 5))))
+    return universe
+
+
+def synthetic_corpus(universe, docs = 20000, seed = 11):
+    rng = random.Random(seed)
+    symbols = sorted(universe)
+    context = ["buy", "sell", "shares", "moon", "earnings", "dip", "hold", "M&A", "Bullish"]
+    corpus = list(Edge_Cases)
+    for _ in range(docs):
+        words = []
+        for _ in range(rng.randint(5, 60)):
+            roll = rng.random()
+            if roll < 0.03:
+                words.append("$" + rng.choice(symbols))
+            elif roll < 0.06:
+                words.append(rng.choice(symbols))
+            elif roll < 0.08:
+                words.append(rng.choice(symbols).lower())
+            elif roll < 0.1:
+                words.append(rng.choice(context))
+            elif roll < 0.13:
+                words.append(rng.choice(["100", "12.5", "$40", "£3", "5th", "2x", "Q3"]))
+            elif roll < 0.135:
+                words.append("ticker: " + rng.choice(symbols))
+            else:
+                words.append(rng.choice(Filler))
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def normalise(results):
+    return sorted((r["ticker"], r["kind"], r["score"], r["snippet"], r["inferred_from"]) for r in results)
+
+
+def check_parity(corpus, ticker_set):
+    """
+    Runs every text through both paths with every flag combination
+    Returns:
+        list of (text, flags, regex_results, matcher_results) for every text that disagrees
+    """
+    matcher = TickerMatcher(ticker_set)
+    mismatches = []
+    for text in corpus:
+        for allow_lowercase in (False, True):
+            for post in (False, True):
+                for threshold in (0.9, -1):
+                    flags = {"allow_lowercase": allow_lowercase, "post": post, "threshold": threshold}
+                    expected = normalise(tickers.process_text_regex(text, ticker_set, **flags))
+                    got = normalise(matcher.process_text(text, **flags))
+                    if expected != got:
+                        mismatches.append((text, flags, expected, got))
+                expected = sorted(tickers.extract_candidates(text, ticker_set, allow_lowercase))
+                got = sorted(matcher.extract_candidates(text, allow_lowercase))
+                if expected != got:
+                    mismatches.append((text, {"allow_lowercase": allow_lowercase}, expected, got))
+    return mismatches
+
+
+def time_path(fn, corpus, repeat = 3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Single pass matcher parity check and benchmark")
+    parser.add_argument("--tickers", help="tickers.csv to use instead of a synthetic universe")
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.tickers:
+        ticker_set = set(tickers.load_tickers(Path(args.tickers))["Ticker"])
+    else:
+        ticker_set = synthetic_universe()
+    corpus = synthetic_corpus(ticker_set, args.docs)
+
+    mismatches = check_parity(corpus, ticker_set)
+    for text, flags, expected, got in mismatches[:10]:
+        print(f"MISMATCH {flags}\n  text: {text[:120]!r}\n  regex:   {expected}\n  matcher: {got}")
+    print(f"parity: {len(corpus)} texts, {len(mismatches)} mismatches")
+
+    matcher = TickerMatcher(ticker_set)
+    regex_time = time_path(lambda t: tickers.process_text_regex(t, ticker_set), corpus, args.repeat)
+    matcher_time = time_path(matcher.process_text, corpus, args.repeat)
+    print(f"regex path:   {len(corpus) / regex_time:,.0f} docs/sec")
+    print(f"matcher path: {len(corpus) / matcher_time:,.0f} docs/sec ({regex_time / matcher_time:.2f}x)")
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
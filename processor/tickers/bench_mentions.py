@@ -0,0 +1,115 @@
+import argparse
+import gc
+import time
+import tracemalloc
+import tickers
+from bench_matcher import synthetic_universe
+from corpus import synthetic_reddit
+from matcher import TickerMatcher
+from mentions import Kinds
+
+"""Memory of the mention records against the dict per match they replaced
+Matches a synthetic corpus once, then holds the results of every comment both ways and measures each with tracemalloc:
+    dicts    {"comment": key, "match_details": {...}} with a copied snippet, one per mention
+    batches  tickers.propagate_batch MentionBatches, a fetchmany batch each
+Every string of a row is a fresh object like the ones a DB fetch gives, so a batch pays for the texts it keeps alive and the
+dicts pay for their snippet copies. Both hold every ticker, the old pipeline kept one per comment.
+Run from processor/tickers:
+    python bench_mentions.py --comments-per-post 2000
+"""
+
+
+def fresh(text):
+    # a new string object with the same value, like each row of a fetch
+    return (text + ".")[:-1] if text else text
+
+
+def as_dicts(rows, bucketed, matches_com, matches_post, parent_map):
+    found = []
+    for row, mentions in zip(rows, bucketed):
+        if mentions:
+            for ticker, kind, score, _ in mentions:
+                found.append({"comment": tickers.comment_key(row), "match_details": {
+                    "ticker": ticker, "kind": Kinds[kind], "score": score, "snippet": row[3][:200], "inferred_from": None,
+                    "sentiment": 0.0}})
+        else:
+            tree = tickers.build_ancestor_tree(row[0], parent_map)
+            mentions = tickers.propogate_for_comment(row, matches_com, matches_post, tree)
+            for ticker, kind, score, inferred_from, hops in mentions:
+                found.append({"comment": tickers.comment_key(row), "match_details": {
+                    "ticker": ticker, "kind": Kinds[kind], "score": score, "snippet": row[3][:300],
+                    "inferred_from": inferred_from, "hops": hops, "sentiment": 0.0}})
+        if mentions:
+            matches_com[row[0]] = tickers.flat_scores(mentions)
+    return found
+
+
+def as_batches(rows, bucketed, matches_com, matches_post, parent_map):
+    batch = tickers.propagate_batch(rows, bucketed, matches_com, matches_post, parent_map)
+    batch.set_sentiment([0.0] * len(batch.docs))
+    return [batch.trim()]
+
+
+def measure(build, batches, matches_post, parent_map):
+    """
+    Returns:
+        (bytes held by the results, mentions, seconds)
+    """
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    held = []
+    matches_com = {}
+    for rows, bucketed in batches:
+        # the rows go out of scope after their batch, only what the results keep stays allocated
+        rows = [(fresh(r[0]), fresh(r[1]), fresh(r[2]), fresh(r[3]), fresh(r[4]), r[5]) for r in rows]
+        held.extend(build(rows, bucketed, matches_com, matches_post, parent_map))
+    elapsed = time.perf_counter() - start
+    del matches_com
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    mentions = sum(len(h) for h in held) if held and not isinstance(held[0], dict) else len(held)
+    return size, mentions, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mention record memory benchmark")
+    parser.add_argument("--universe", type=int, default=8000)
+    parser.add_argument("--posts", type=int, default=50, help="posts per subreddit")
+    parser.add_argument("--comments-per-post", type=int, default=400)
+    parser.add_argument("--mention-density", type=float, default=0.15)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    universe = synthetic_universe(args.universe)
+    post_rows, comment_rows = synthetic_reddit(universe, posts=args.posts, comments_per_post=args.comments_per_post,
+                                               mention_density=args.mention_density)
+    matcher = TickerMatcher(frozenset(universe))
+
+    matches_post = {}
+    for row in post_rows:
+        mentions = matcher.mentions(row[2], post=True)
+        if mentions and row[2] != "The Lounge":
+            matches_post[row[0]] = tickers.flat_scores(mentions)
+    parent_map = {row[0]: row[4] for row in comment_rows if row[4]}
+
+    # matched up front so only the records are measured
+    rows = [(c[0], c[4], c[5], c[1] or "", c[2], c[3]) for c in comment_rows]
+    batches = []
+    for i in range(0, len(rows), args.batch_size):
+        chunk = rows[i:i + args.batch_size]
+        batches.append((chunk, [matcher.mentions(r[3]) for r in chunk]))
+
+    comments = len(rows)
+    results = {}
+    for name, build in (("dicts", as_dicts), ("batches", as_batches)):
+        size, mentions, elapsed = measure(build, batches, matches_post, parent_map)
+        results[name] = size
+        print(f"{name:<8} {mentions:>8} mentions {size / 2**20:>8.1f} MB  {size / mentions:>6.0f} B/mention  "
+              f"{size / comments * 1e6 / 2**20:>8,.0f} MB per million comments  {comments / elapsed:>10,.0f} comments/sec")
+    print(f"batches use {results['dicts'] / results['batches']:.1f}x less memory")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import tickers
+from bench_matcher import synthetic_universe
+from bench_suite import synthetic
+from corpus import synthetic_reddit
+from standin import LocalDatabase
+from workers import StageStats
+from metrics import Metrics
+
+"""Overhead and output check for the run metrics
+Runs process_db over a synthetic corpus against the SQLite stand-in with:
+    off       no PROCESSOR_METRICS settings, StageStats has no metrics
+    metrics   PROCESSOR_METRICS to a Prometheus text file
+    jsonl     PROCESSOR_METRICS to a JSON lines file
+    profile   metrics and the sampling profiler
+and reports the run time of each next to the off run. The matches have to be the same every time, every line of the
+Prometheus file has to parse, and the mention counters have to add up to the mentions the run returned. Exits non
+zero otherwise. Also times a StageStats.add call with and without metrics.
+Run from processor/tickers:
+    python bench_metrics.py --comments-per-post 2000
+"""
+
+Sample_RE = re.compile(r'^[a-z_]+(\{([a-z_]+="[^"]*",?)*\})? -?[0-9.e+-]+(inf)?$')
+
+
+def run(universe, post_rows, comment_rows, workers, env):
+    with LocalDatabase() as db:
+        db.load(post_rows, comment_rows)
+        tickers.connection = db.connection
+        for key in ("PROCESSOR_METRICS", "PROCESSOR_PROFILE"):
+            os.environ.pop(key, None)
+        os.environ.update(env)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            comments, posts = tickers.process_db(workers=workers, universe=universe)
+        elapsed = time.perf_counter() - start
+    found = {(m.key[0], m.ticker, m.kind_name) for batch in comments for m in batch}
+    found |= {(m.key[0], m.ticker, m.kind_name) for m in posts}
+    mentions = sum(len(batch) for batch in comments) + len(posts)
+    return found, mentions, elapsed
+
+
+def add_cost(metrics, calls = 200000):
+    stats = StageStats(metrics)
+    start = time.perf_counter()
+    for _ in range(calls):
+        stats.add("match", 500, 0.01)
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run metrics overhead benchmark")
+    parser.add_argument("--universe", type=int, default=8000)
+    parser.add_argument("--posts", type=int, default=50, help="posts per subreddit")
+    parser.add_argument("--comments-per-post", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per setting, the fastest is reported")
+    args = parser.parse_args()
+
+    symbols = synthetic_universe(args.universe)
+    post_rows, comment_rows = synthetic_reddit(symbols, posts=args.posts, comments_per_post=args.comments_per_post)
+    universe = synthetic(symbols)
+    os.environ["PROCESSOR_CACHE"] = "off"
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        prom = os.path.join(tmp, "processor.prom")
+        lines = os.path.join(tmp, "processor.jsonl")
+        profile = os.path.join(tmp, "profile.txt")
+        settings = [("off", {}), ("metrics", {"PROCESSOR_METRICS": prom}),
+                    ("jsonl", {"PROCESSOR_METRICS": lines}),
+                    ("profile", {"PROCESSOR_METRICS": prom, "PROCESSOR_PROFILE": profile})]
+        expected, base = None, None
+        for name, env in settings:
+            best = None
+            for _ in range(args.repeat):
+                found, mentions, elapsed = run(universe, post_rows, comment_rows, args.workers, env)
+                best = elapsed if best is None else min(best, elapsed)
+            if expected is None:
+                expected, base = found, best
+            failed |= found != expected
+            print(f"{name:<8} {best:>7.2f}s  {(best / base - 1) * 100:>+6.1f}% against off")
+
+        text = open(prom).read()
+        bad = [line for line in text.splitlines() if not line.startswith("#") and not Sample_RE.match(line)]
+        counted = sum(float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith("processor_mentions_total"))
+        print(f"prometheus: {len(text.splitlines())} lines, {len(bad)} unparsable, {counted:.0f} mentions counted of {mentions}")
+        failed |= bool(bad) or counted != mentions
+
+        records = [json.loads(line) for line in open(lines)]
+        print(f"json lines: {len(records) // args.repeat} series per run x {args.repeat} runs")
+        for line in text.splitlines():
+            if line.startswith(("processor_pool_utilization", "processor_pool_pending_rows_max", "processor_run_seconds")):
+                print(f"  {line}")
+        print("\n".join(open(profile).read().splitlines()[:20]))
+
+    print(f"StageStats.add: {add_cost(None):.0f} ns off, {add_cost(Metrics('bench')):.0f} ns with metrics")
+    if failed:
+        print("MISMATCH: metrics changed the matches or exported bad output")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
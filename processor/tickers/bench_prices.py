@@ -0,0 +1,151 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import correlate
+from prices import ingest
+
+"""Benchmark and regression check for the price store and the correlation engine
+Writes a synthetic universe of daily OHLCV csv files (one per ticker, Yahoo style) and daily sentiment aggregates in
+the shape of processed_data, some of them on weekends. A share of the tickers are leaders: their return on day d + 1
+follows their sentiment on day d. Then:
+    ingest       csv files -> store, and a second long format file merged into it
+    scan         correlate.scan over every ticker and lag, against the same correlations from a pandas loop per
+                 ticker (Series.corr with a shift, the way it would be written without the engine)
+Checks that the store gives back the csv rows, that the merge keeps the old rows and takes the new ones, that the
+engine and the loop agree, that the leaders peak at lag 1 and that rolling_zscore matches pandas rolling. Exits non
+zero otherwise.
+Run from processor/tickers:
+    python bench_prices.py --tickers 5000 --days 1250
+"""
+
+
+def synthetic(tickers, days, leaders, seed = 7):
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2021-01-04", periods=days)
+    names = [f"T{i:05d}" for i in range(tickers)]
+    # sentiment on about a third of the days, the leaders' next day return follows it
+    mentioned = rng.random((tickers, days)) < 0.35
+    sentiment = np.where(mentioned, rng.normal(0.05, 0.3, (tickers, days)), np.nan)
+    returns = rng.normal(0.0, 0.02, (tickers, days))
+    lead = np.zeros(tickers, dtype=bool)
+    lead[:leaders] = True
+    follow = np.nan_to_num(sentiment[:, :-1]) * 0.03
+    returns[lead, 1:] += follow[lead]
+    close = 20 * np.exp(np.cumsum(returns, axis=1))
+    open_ = close * np.exp(rng.normal(0, 0.005, close.shape))
+    volume = rng.integers(1e4, 1e7, close.shape)
+
+    rows, cols = np.nonzero(mentioned)
+    daily = pd.DataFrame({
+        "ticker": np.array(names)[rows],
+        "mention_date": dates[cols].date,
+        "mention_volume": rng.integers(1, 40, len(rows)),
+        "avg_sentiment": sentiment[rows, cols],
+    })
+    # a few weekend mentions, they fold into the monday after
+    weekend = daily.sample(frac=0.02, random_state=seed).copy()
+    weekend["mention_date"] = [d - pd.Timedelta(days=1) if d.weekday() == 0 else d for d in weekend["mention_date"]]
+    daily = pd.concat([daily, weekend[[d.weekday() == 6 for d in weekend["mention_date"]]]], ignore_index=True)
+    return names, dates, open_, close, volume, daily
+
+
+def write_csvs(folder, names, dates, open_, close, volume):
+    for i, name in enumerate(names):
+        pd.DataFrame({
+            "Date": dates.strftime("%Y-%m-%d"), "Open": open_[i].round(4), "High": np.maximum(open_[i], close[i]).round(4),
+            "Low": np.minimum(open_[i], close[i]).round(4), "Close": close[i].round(4), "Adj Close": close[i].round(4),
+            "Volume": volume[i],
+        }).to_csv(os.path.join(folder, f"{name}.csv"), index=False)
+
+
+def loop_correlations(daily, store, lags, min_periods):
+    # the per ticker version: one pandas series per ticker and one corr per lag
+    out = []
+    dates = pd.DatetimeIndex(store.dates)
+    for ticker, group in daily.groupby("ticker", sort=True):
+        history = store.history(ticker)
+        returns = np.log(history["adj_close"].astype(np.float64)).diff().reindex(dates)
+        days = dates[np.searchsorted(dates.values, pd.to_datetime(group["mention_date"]).values)]
+        weights = group["mention_volume"].to_numpy(dtype=float)
+        frame = pd.DataFrame({"day": days, "w": weights, "ws": weights * group["avg_sentiment"].to_numpy()})
+        sums = frame.groupby("day")[["w", "ws"]].sum()
+        sentiment = (sums["ws"] / sums["w"]).reindex(dates)
+        for lag in lags:
+            out.append((ticker, lag, sentiment.corr(returns.shift(-lag), min_periods=min_periods)))
+    return pd.DataFrame(out, columns=["ticker", "lag", "corr"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Price store and correlation engine benchmark")
+    parser.add_argument("--tickers", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=750, help="trading days")
+    parser.add_argument("--leaders", type=int, default=50, help="tickers whose next day return follows sentiment")
+    parser.add_argument("--lags", type=int, default=5, help="lags -n .. n")
+    args = parser.parse_args()
+
+    names, dates, open_, close, volume, daily = synthetic(args.tickers, args.days, args.leaders)
+    lags = range(-args.lags, args.lags + 1)
+    failed = False
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, "csv")
+        os.mkdir(folder)
+        write_csvs(folder, names, dates, open_, close, volume)
+        path = os.path.join(tmp, "store")
+        store = ingest([folder], path)
+
+        check = store.history(names[3])
+        failed |= not np.allclose(check["close"].to_numpy(), close[3].round(4), rtol=1e-6)
+        failed |= not (check["volume"].to_numpy() == volume[3]).all()
+
+        # a later long file: a new last day for one ticker and a new ticker
+        late = pd.DataFrame({"symbol": [names[0], names[0], "NEW"], "date": [str(dates[-1].date()), "2030-01-02", "2030-01-02"],
+                             "open": [1.0, 2.0, 3.0], "close": [1.5, 2.5, 3.5], "volume": [10, 20, 30]})
+        late.to_csv(os.path.join(tmp, "late.csv"), index=False)
+        store = ingest([os.path.join(tmp, "late.csv")], path)
+        merged = store.history(names[0])
+        failed |= merged["close"].iloc[-2] != 1.5 or merged["close"].iloc[-1] != 2.5 or len(merged) != args.days + 1
+        failed |= store.history("NEW")["close"].iloc[0] != np.float32(3.5)
+        failed |= not np.allclose(store.history(names[1])["close"].to_numpy(), close[1].round(4), rtol=1e-6)
+
+        start = time.perf_counter()
+        correlations, events = correlate.scan(daily, store, lags, "sentiment", min_periods=20)
+        vectorized = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loop = loop_correlations(daily, store, lags, 20)
+        looped = time.perf_counter() - start
+        print(f"scan {correlations['ticker'].nunique():,} tickers x {len(lags)} lags: {vectorized:.2f}s vectorized, "
+              f"{looped:.2f}s with a pandas loop per ticker ({looped / vectorized:.0f}x)")
+
+        both = correlations.merge(loop, on=["ticker", "lag"], suffixes=("", "_loop"))
+        agree = np.allclose(both["corr"], both["corr_loop"], atol=1e-6, equal_nan=True)
+        print(f"engine and loop agree on {len(both):,} (ticker, lag) pairs: {agree}")
+        failed |= not agree or len(both) != len(correlations)
+
+        best = correlations.dropna().loc[lambda c: c["ticker"].isin(names[:args.leaders])]
+        best = best.loc[best.groupby("ticker")["corr"].idxmax(), "lag"]
+        found = (best == 1).mean()
+        print(f"leaders peaking at lag 1: {found:.0%}")
+        failed |= found < 0.9
+
+        # rolling z-score against pandas on a few rows
+        x = np.where(np.random.default_rng(1).random((5, 300)) < 0.7, np.random.default_rng(2).normal(size=(5, 300)), np.nan)
+        z = correlate.rolling_zscore(x, 20, 10)
+        for row in range(5):
+            s = pd.Series(x[row])
+            trailing = s.rolling(20, min_periods=10)
+            ref = ((s - trailing.mean().shift(1)) / trailing.std().shift(1)).to_numpy()
+            failed |= not np.allclose(z[row], ref, atol=1e-9, equal_nan=True)
+        print(events.loc[-2:5].round(5).to_string())
+
+    if failed:
+        print("MISMATCH: the store or the engine gave a wrong result")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
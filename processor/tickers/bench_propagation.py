@@ -0,0 +1,129 @@
+import argparse
+import random
+import time
+import tickers
+from bench_matcher import synthetic_universe
+from matcher import TickerMatcher
+from standin import LocalDatabase
+
+"""Batch size regression check and benchmark for comment propagation
+Builds synthetic comment trees, runs them through tickers.propagate_batch with different fetchmany sizes and checks
+every batch size gives the same matches. Then stores the comments in a shuffled order (heap order once the collector
+has re-upserted them) in the SQLite stand-in, reads them back with tickers.Comment_Scan and checks that gives the same
+matches too. Exits non zero if they differ.
+Run from processor/tickers:
+    python bench_propagation.py --posts 200 --comments 50000
+"""
+
+
+def synthetic_threads(posts = 200, comments = 50000, seed = 5):
+    """
+    Returns:
+        post rows [(title, post_id)] and comment rows [(id, parent_id, post_id, body, author, created_utc)]
+        comments are in created_utc order so a parent always comes before its replies
+    """
+    rng = random.Random(seed)
+    post_rows = []
+    for p in range(posts):
+        title = rng.choice(["$GME earnings play, buying 100 shares", "what do you think about this", "NVDA 200 calls", "daily thread"])
+        post_rows.append((title, f"p{p}"))
+
+    comment_rows = []
+    by_post = {}
+    for c in range(comments):
+        post_id = rng.choice(post_rows)[1]
+        siblings = by_post.setdefault(post_id, [])
+        parent_id = rng.choice(siblings) if siblings and rng.random() < 0.7 else None
+        body = rng.choice([
+            "$TSLA to the moon, bought 40 shares",
+            "agreed, holding mine",
+            "this is the way",
+            "AMD looks cheap at 120",
+            "lol",
+            "ticker: AAPL",
+        ])
+        comment_id = f"c{c}"
+        siblings.append(comment_id)
+        comment_rows.append((comment_id, parent_id, post_id, body, f"user{rng.randint(0, 500)}", 1700000000 + c))
+    return post_rows, comment_rows
+
+
+def run(post_rows, comment_rows, ticker_set, batchSize):
+    matcher = TickerMatcher(ticker_set)
+    post_matches = {}
+    for title, post_id in post_rows:
+        mentions = matcher.mentions(title, post=True)
+        if mentions:
+            post_matches[post_id] = tickers.flat_scores(mentions)
+
+    # same as load_parent_index, one index for the whole table
+    parent_map = {r[0]: r[1] for r in comment_rows if r[1]}
+    matches_com = {}
+    matched_ls = []
+    for i in range(0, len(comment_rows), batchSize):
+        rows = comment_rows[i:i + batchSize]
+        bucketed = [matcher.mentions(r[3]) for r in rows]
+        matched_ls.append(tickers.propagate_batch(rows, bucketed, matches_com, post_matches, parent_map))
+    return matched_ls
+
+
+def scanned(comment_rows, seed = 13):
+    # the comments inserted in a random order and read back the way process_db reads them
+    shuffled = list(comment_rows)
+    random.Random(seed).shuffle(shuffled)
+    with LocalDatabase() as db:
+        db.load([], [(c, body, author, created, parent, post, 0) for c, parent, post, body, author, created in shuffled])
+        with db.connection("read") as conn:
+            curr = conn.cursor()
+            curr.execute(tickers.Comment_Scan)
+            rows = curr.fetchall()
+            curr.close()
+    return shuffled, rows
+
+
+def summarise(matched_ls):
+    return sorted((m.key[0], m.ticker, m.kind_name, m.score) for batch in matched_ls for m in batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Propagation batch size regression check")
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--comments", type=int, default=50000)
+    args = parser.parse_args()
+
+    ticker_set = synthetic_universe()
+    post_rows, comment_rows = synthetic_threads(args.posts, args.comments)
+
+    baseline = None
+    failed = False
+    for batchSize in (len(comment_rows), 500, 37, 1):
+        start = time.perf_counter()
+        matched_ls = run(post_rows, comment_rows, ticker_set, batchSize)
+        elapsed = time.perf_counter() - start
+        result = summarise(matched_ls)
+        kinds = {}
+        for batch in matched_ls:
+            for m in batch:
+                kinds[m.kind_name] = kinds.get(m.kind_name, 0) + 1
+        print(f"batchSize {batchSize:>7}: {len(comment_rows) / elapsed:,.0f} comments/sec {kinds}")
+        if baseline is None:
+            baseline = result
+        elif result != baseline:
+            print(f"  MISMATCH: {len(set(result) ^ set(baseline))} matches differ from the single batch run")
+            failed = True
+
+    shuffled, rows = scanned(comment_rows)
+    unordered = summarise(run(post_rows, shuffled, ticker_set, 500))
+    result = summarise(run(post_rows, rows, ticker_set, 500))
+    print(f"shuffled storage: {len(set(unordered) ^ set(baseline))} matches differ in heap order, "
+          f"{len(set(result) ^ set(baseline))} read back with Comment_Scan")
+    if result != baseline:
+        print("  MISMATCH: Comment_Scan does not give parents before their replies")
+        failed = True
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
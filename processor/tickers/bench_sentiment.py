@@ -0,0 +1,93 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from extract_cache import ExtractionCache
+from sentiment import SentimentScorer, VADER_VERSION
+from workers import start_pool
+
+"""Benchmark for the sentiment stage, with and without the text cache
+A share of the synthetic comments are copies of a small set of copypasta and bot replies, like the real subreddits
+    no cache     every comment is scored, copies too
+    cold         a new cache file, only the copies are saved
+    next run     a new scorer and cache on the same file, like the next cron run over the comments the collector
+                 upserted again, every score comes from disk
+    warm         the same scorer again, every score comes from its LRU
+Every mode has to give the same scores, exits non zero otherwise.
+Run from processor/tickers:
+    python bench_sentiment.py --comments 50000 --repeat-share 0.4
+"""
+
+Copypasta = [
+    "I am not a financial advisor, this is not financial advice. Do your own research before buying anything.",
+    "Your post has been removed because it does not meet the minimum karma requirement.",
+    "Apes together strong. Holding until the moon, not selling a single share.",
+    "Remember to set a stop loss, this stock is extremely volatile and can dump hard.",
+    "This is the way.",
+]
+
+Words = ("great", "terrible", "bullish", "bearish", "love", "hate", "moon", "crash", "buy", "sell", "the", "stock",
+         "is", "going", "to", "really", "not", "very", "good", "bad", "earnings", "beat", "missed", "today")
+
+
+def synthetic_bodies(comments, repeat_share, seed = 9):
+    rng = random.Random(seed)
+    bodies = []
+    for _ in range(comments):
+        if rng.random() < repeat_share:
+            bodies.append(rng.choice(Copypasta))
+        else:
+            bodies.append(" ".join(rng.choice(Words) for _ in range(rng.randint(5, 40))))
+    return bodies
+
+
+def run(scorer, bodies, batchSize):
+    start = time.perf_counter()
+    scores = []
+    for i in range(0, len(bodies), batchSize):
+        scores.extend(scorer.score(bodies[i:i + batchSize]))
+    return time.perf_counter() - start, scores
+
+
+def file_cache(path):
+    return ExtractionCache(path, "sentiment", rules=VADER_VERSION)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sentiment stage benchmark")
+    parser.add_argument("--comments", type=int, default=50000)
+    parser.add_argument("--repeat-share", type=float, default=0.4, help="share of comments that are copypasta")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    bodies = synthetic_bodies(args.comments, args.repeat_share)
+    results = {}
+    with start_pool(set(), args.workers) as pool, tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "extract_cache.sqlite")
+
+        def measure(label, scorer):
+            elapsed, results[label] = run(scorer, bodies, args.batch_size)
+            print(f"{label:<9} {len(bodies) / elapsed:>10,.0f} comments/sec  {scorer.report()}")
+
+        measure("no cache", SentimentScorer(pool))
+        scorer = SentimentScorer(pool, file_cache(path))
+        measure("cold", scorer)
+        scorer.close()
+
+        # a second collection cycle over the same comments, which is what batchUpsertComments causes, in a new process
+        scorer = SentimentScorer(pool, file_cache(path))
+        measure("next run", scorer)
+        scorer.hits = scorer.misses = scorer.cache.disk_hits = 0
+        measure("warm", scorer)
+        scorer.close()
+
+    same = all(scores == results["no cache"] for scores in results.values())
+    print(f"every mode gives the same scores: {same}")
+    if not same:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import time
+from pathlib import Path
+import tickers
+from bench_matcher import synthetic_universe
+from corpus import synthetic_reddit, describe
+from matcher import TickerMatcher
+from standin import LocalDatabase
+from universe import Universe, universe_version
+
+"""Offline benchmark suite for the processor
+Generates a synthetic Reddit corpus (see corpus.py) and times each stage on it: extract_candidates, score_potential,
+the single pass matcher, propogate_for_comment and the whole of process_db against the SQLite stand-in (standin.py),
+so nothing needs Postgres or Reddit credentials.
+Each stage runs in a fresh process so its peak RSS is its own (corpus included). Reported per stage: rows/sec,
+p50/p99 latency per document and peak RSS.
+--save writes the results as the baseline, later runs compare against it and exit non zero when a stage is slower,
+has a worse p99 or uses more memory than the baseline allows.
+Run from processor/tickers:
+    python bench_suite.py --save                 # record a baseline on this machine
+    python bench_suite.py                        # compare against it
+    python bench_suite.py --posts 200 --megathread-comments 50000 --stages matcher process_db
+"""
+
+Stages = ("extract_candidates", "score_potential", "matcher", "propagate", "process_db")
+
+Baseline = Path(__file__).resolve().parent / "bench_baseline.json"
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def timed_each(items, fn):
+    # per document latency in microseconds and the total time
+    latencies = []
+    clock = time.perf_counter_ns
+    start = time.perf_counter()
+    for item in items:
+        t = clock()
+        fn(item)
+        latencies.append((clock() - t) / 1000)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies), elapsed, latencies
+
+
+def documents(post_rows, comment_rows):
+    return [row[2] for row in post_rows] + [row[1] or "" for row in comment_rows]
+
+
+def stage_extract_candidates(universe, post_rows, comment_rows, config):
+    docs = documents(post_rows, comment_rows)
+    return timed_each(docs, lambda text: tickers.extract_candidates(text, universe))
+
+
+def stage_score_potential(universe, post_rows, comment_rows, config):
+    docs = documents(post_rows, comment_rows)
+    work = [(text, tickers.extract_candidates(text, universe)) for text in docs]
+
+    def score(item):
+        text, candidates = item
+        for candidate in candidates:
+            tickers.score_potential(text, candidate)
+
+    return timed_each(work, score)
+
+
+def stage_matcher(universe, post_rows, comment_rows, config):
+    matcher = TickerMatcher(frozenset(universe))
+    docs = documents(post_rows, comment_rows)
+    return timed_each(docs, matcher.process_text)
+
+
+def stage_propagate(universe, post_rows, comment_rows, config):
+    # everything propagation reads is built up front, only the per comment lookups are timed
+    matcher = TickerMatcher(frozenset(universe))
+    matches_post = {}
+    for row in post_rows:
+        mentions = matcher.mentions(row[2], post=True)
+        if mentions and row[2] != "The Lounge":
+            matches_post[row[0]] = tickers.flat_scores(mentions)
+
+    matches_com = {}
+    parent_map = {}
+    todo = []
+    for comment_id, body, author, created_utc, parent_id, post_id, _ in comment_rows:
+        if parent_id:
+            parent_map[comment_id] = parent_id
+        mentions = matcher.mentions(body or "")
+        if mentions:
+            matches_com[comment_id] = tickers.flat_scores(mentions)
+        else:
+            todo.append((comment_id, parent_id, post_id, body, author, created_utc))
+
+    def propagate(row):
+        tree = tickers.build_ancestor_tree(row[0], parent_map)
+        tickers.propogate_for_comment(row, matches_com, matches_post, tree)
+
+    return timed_each(todo, propagate)
+
+
+def stage_process_db(universe, post_rows, comment_rows, config):
+    # every row is matched, a warm extraction cache from an earlier run would skew the numbers (see bench_cache.py)
+    os.environ["PROCESSOR_CACHE"] = "off"
+    with LocalDatabase() as db:
+        db.load(post_rows, comment_rows)
+        del post_rows[:], comment_rows[:]
+        tickers.connection = db.connection
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            tickers.process_db(workers=config["workers"], sentiment=config["sentiment"], universe=synthetic(universe))
+        elapsed = time.perf_counter() - start
+
+        conn = db.connect()
+        curr = conn.cursor()
+        curr.execute("SELECT (SELECT count(*) FROM posts) + (SELECT count(*) FROM comments)")
+        rows = curr.fetchone()[0]
+        conn.close()
+    # no per document latency, the documents go through the pool in chunks
+    return rows, elapsed, []
+
+
+def synthetic(symbols):
+    # a Universe for the synthetic symbols, process_db would otherwise load tickers.csv
+    names = {symbol: "" for symbol in symbols}
+    return Universe(universe_version(names), frozenset(symbols), names, {})
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, the pool workers count as children
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def run_stage(stage, config, queue):
+    universe = synthetic_universe(config["universe"])
+    post_rows, comment_rows = synthetic_reddit(universe, **config["corpus"])
+    rows, elapsed, latencies = globals()[f"stage_{stage}"](universe, post_rows, comment_rows, config)
+    queue.put({
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_sec": round(rows / elapsed, 1) if elapsed else None,
+        "p50_us": round(percentile(latencies, 0.50), 2) if latencies else None,
+        "p99_us": round(percentile(latencies, 0.99), 2) if latencies else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    })
+
+
+def measure(stage, config):
+    # spawn rather than fork so the child's peak RSS does not start from this process's
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run_stage, args=(stage, config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def regressions(stage, result, baseline, tolerance, rss_tolerance):
+    problems = []
+    if result["rows_per_sec"] and baseline.get("rows_per_sec") and result["rows_per_sec"] < baseline["rows_per_sec"] * (1 - tolerance):
+        problems.append(f"rows/sec {result['rows_per_sec']:,.0f} < baseline {baseline['rows_per_sec']:,.0f}")
+    if result["p99_us"] and baseline.get("p99_us") and result["p99_us"] > baseline["p99_us"] * (1 + tolerance):
+        problems.append(f"p99 {result['p99_us']:.1f}us > baseline {baseline['p99_us']:.1f}us")
+    if baseline.get("peak_rss_mb") and result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + rss_tolerance):
+        problems.append(f"peak RSS {result['peak_rss_mb']:.0f}MB > baseline {baseline['peak_rss_mb']:.0f}MB")
+    return [f"{stage}: {p}" for p in problems]
+
+
+def fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline processor benchmarks on a synthetic Reddit corpus")
+    parser.add_argument("--stages", nargs="+", choices=Stages, default=list(Stages))
+    parser.add_argument("--universe", type=int, default=8000, help="synthetic ticker universe size")
+    parser.add_argument("--subreddits", type=int, default=4)
+    parser.add_argument("--posts", type=int, default=50, help="posts per subreddit")
+    parser.add_argument("--comments-per-post", type=int, default=200)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--mention-density", type=float, default=0.15)
+    parser.add_argument("--megathreads", type=int, default=1)
+    parser.add_argument("--megathread-comments", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2, help="pool size for process_db")
+    parser.add_argument("--sentiment", action="store_true", help="score process_db matches with VADER")
+    parser.add_argument("--baseline", type=Path, default=Baseline)
+    parser.add_argument("--save", action="store_true", help="write these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slow down in rows/sec and p99")
+    parser.add_argument("--rss-tolerance", type=float, default=0.15, help="allowed growth in peak RSS")
+    args = parser.parse_args()
+
+    config = {
+        "universe": args.universe,
+        "workers": args.workers,
+        "sentiment": args.sentiment,
+        "corpus": {
+            "subreddits": args.subreddits,
+            "posts": args.posts,
+            "comments_per_post": args.comments_per_post,
+            "depth": args.depth,
+            "fanout": args.fanout,
+            "mention_density": args.mention_density,
+            "megathreads": args.megathreads,
+            "megathread_comments": args.megathread_comments,
+            "seed": args.seed,
+        },
+    }
+    universe = synthetic_universe(args.universe)
+    print(describe(*synthetic_reddit(universe, **config["corpus"])))
+
+    results = {}
+    print(f"{'stage':<20}{'rows':>10}{'rows/sec':>14}{'p50 us':>10}{'p99 us':>10}{'peak RSS MB':>13}")
+    for stage in args.stages:
+        result = measure(stage, config)
+        results[stage] = result
+        print(f"{stage:<20}{result['rows']:>10}{fmt(result['rows_per_sec'], ',.0f'):>14}"
+              f"{fmt(result['p50_us'], '.1f'):>10}{fmt(result['p99_us'], '.1f'):>10}{result['peak_rss_mb']:>13.1f}")
+
+    if args.save:
+        saved = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        if saved.get("config") != config:
+            saved = {"config": config, "results": {}}
+        saved["results"].update(results)
+        args.baseline.write_text(json.dumps(saved, indent=2) + "\n")
+        print(f"baseline saved to {args.baseline}")
+        return
+
+    if not args.baseline.exists():
+        print(f"no baseline at {args.baseline}, run with --save to record one")
+        return
+    saved = json.loads(args.baseline.read_text())
+    if saved.get("config") != config:
+        print("baseline was recorded with a different corpus or settings, not compared")
+        return
+
+    problems = []
+    for stage, result in results.items():
+        if stage in saved["results"]:
+            problems += regressions(stage, result, saved["results"][stage], args.tolerance, args.rss_tolerance)
+    if problems:
+        print("REGRESSION")
+        for problem in problems:
+            print(f"  {problem}")
+        raise SystemExit(1)
+    print("no regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
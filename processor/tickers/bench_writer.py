@@ -0,0 +1,109 @@
+import argparse
+import random
+import time
+from db import connection
+from mentions import MentionBatch, DOLLAR, ALLCAPS, SNIPPET
+from query import insert_rows
+from writer import TickerWriter
+
+"""Benchmark for the COPY writer against the one statement per match path
+Everything happens in a scratch schema (bench_writer) that is dropped at the end, so it is safe to point at the
+normal database from .env
+Run from processor/tickers:
+    python bench_writer.py --mentions 100000
+"""
+
+Schema = "bench_writer"
+
+
+def setup_schema(conn, posts, comments):
+    # posts and comments like src/db/setup.js, the ticker tables come from the DDL through TickerWriter
+    with conn.cursor() as curr:
+        curr.execute(f"DROP SCHEMA IF EXISTS {Schema} CASCADE; CREATE SCHEMA {Schema}; SET search_path TO {Schema};")
+        curr.execute("CREATE TABLE posts(id VARCHAR(255) PRIMARY KEY, title TEXT, author TEXT, created_utc BIGINT)")
+        curr.execute("CREATE TABLE comments(id VARCHAR(255) PRIMARY KEY, parent_id VARCHAR(255) REFERENCES comments(id), "
+                     "post_id VARCHAR(255) REFERENCES posts(id), body TEXT, author TEXT, created_utc BIGINT)")
+        curr.execute("INSERT INTO posts SELECT 'p' || i, 'title', 'user', 1700000000 FROM generate_series(0, %s) i", (posts - 1,))
+        curr.execute("INSERT INTO comments SELECT 'c' || i, NULL, 'p' || (i %% %s), 'body', 'user', 1700000000 + i "
+                     "FROM generate_series(0, %s) i", (posts, comments - 1))
+    conn.commit()
+
+
+def synthetic_matches(posts, comments, seed = 3, batchSize = 500):
+    # comment MentionBatches of batchSize comments like stream_comment_matches gives, and one post batch
+    rng = random.Random(seed)
+    snippet = "bought more $GME at 20\tagain\nto the moon \\o/"
+    comment_matches = []
+    for c in range(comments):
+        if c % batchSize == 0:
+            comment_matches.append(MentionBatch())
+        batch = comment_matches[-1]
+        doc = batch.add_doc((f"c{c}", None, f"p{c % posts}", "user", 1700000000 + c), snippet)
+        batch.add(doc, rng.choice(["GME", "AMC", "TSLA"]), DOLLAR, 1.81, SNIPPET)
+    post_matches = MentionBatch()
+    for p in range(posts):
+        doc = post_matches.add_doc((f"p{p}", "user", 1700000000), "title")
+        post_matches.add(doc, "GME", ALLCAPS, 0.91, SNIPPET)
+    return comment_matches, post_matches
+
+
+def truncate(conn):
+    with conn.cursor() as curr:
+        curr.execute("TRUNCATE comment_tickers, post_tickers")
+    conn.commit()
+
+
+def count(conn):
+    with conn.cursor() as curr:
+        curr.execute("SELECT (SELECT count(*) FROM comment_tickers) + (SELECT count(*) FROM post_tickers)")
+        return curr.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="COPY writer benchmark")
+    parser.add_argument("--mentions", type=int, default=50000)
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--page-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    with connection("write") as conn:
+        run(conn, args)
+
+
+def run(conn, args):
+    try:
+        setup_schema(conn, args.posts, args.mentions)
+        comments, posts = synthetic_matches(args.posts, args.mentions)
+        total = sum(len(batch) for batch in comments) + len(posts)
+
+        writer = TickerWriter(conn, args.page_size)
+
+        truncate(conn)
+        start = time.perf_counter()
+        insert_rows(conn, comments, posts)
+        row_time = time.perf_counter() - start
+        print(f"per row: {total / row_time:>10,.0f} rows/sec ({count(conn)} rows)")
+
+        truncate(conn)
+        start = time.perf_counter()
+        with writer:
+            for batch in comments:
+                writer.add_comments(batch)
+            writer.add_posts(posts)
+        copy_time = time.perf_counter() - start
+        print(f"copy:    {total / copy_time:>10,.0f} rows/sec ({count(conn)} rows, {row_time / copy_time:.1f}x)")
+
+        # a second run has to be a no op because of ON CONFLICT DO NOTHING
+        with writer:
+            for batch in comments:
+                writer.add_comments(batch)
+        print(f"rerun:   {count(conn)} rows")
+    finally:
+        with conn.cursor() as curr:
+            curr.execute(f"DROP SCHEMA IF EXISTS {Schema} CASCADE")
+            curr.execute("RESET search_path")
+        conn.commit()
+
+
+if __name__ == "__main__":
+    main()
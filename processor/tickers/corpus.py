@@ -0,0 +1,117 @@
+import random
+
+"""Synthetic Reddit corpus for the benchmarks
+Subreddits of posts with comment trees of a given depth and fan-out, a share of the texts mention tickers, and
+optionally The Lounge style megathreads: one post with a very wide, shallow tree, like the daily threads.
+Rows come out in the column order of the posts and comments tables and in created_utc order, so a parent is always
+before its replies. The same arguments always give the same corpus.
+"""
+
+Filler = ("the", "and", "this", "that", "going", "just", "think", "market", "today", "really", "lol", "yolo",
+          "when", "calls", "puts", "week", "money", "about", "with", "from", "agreed", "holding", "nah", "wife")
+
+Context = ("buy", "sell", "shares", "moon", "earnings", "dip", "hold", "bullish", "bearish", "M&A")
+
+Numbers = ("100", "12.5", "$40", "5th", "2x", "Q3", "420.69", "3/15")
+
+Post_Columns = ("id", "subreddit", "title", "body", "author", "created_utc", "score")
+Comment_Columns = ("id", "body", "author", "created_utc", "parent_id", "post_id", "score")
+
+
+def synthetic_text(rng, symbols, mention_density, words = (5, 60)):
+    # mention_density is the chance that the text mentions a ticker at all
+    out = [rng.choice(Filler) for _ in range(rng.randint(*words))]
+    if rng.random() < mention_density:
+        for _ in range(rng.choice((1, 1, 1, 2, 3))):
+            symbol = rng.choice(symbols)
+            form = rng.random()
+            if form < 0.4:
+                mention = "$" + symbol
+            elif form < 0.8:
+                mention = symbol
+            elif form < 0.9:
+                mention = symbol.lower()
+            else:
+                mention = "ticker: " + symbol
+            out.insert(rng.randrange(len(out) + 1), mention)
+        if rng.random() < 0.5:
+            out.insert(rng.randrange(len(out) + 1), rng.choice(Context))
+        if rng.random() < 0.5:
+            out.insert(rng.randrange(len(out) + 1), rng.choice(Numbers))
+    return " ".join(out)
+
+
+def synthetic_reddit(universe, *, subreddits = 4, posts = 50, comments_per_post = 200, depth = 6, fanout = 4,
+                     mention_density = 0.15, megathreads = 1, megathread_comments = 20000, seed = 3):
+    """
+    Args:
+        universe: ticker symbols the texts mention
+        subreddits: number of subreddits
+        posts: posts per subreddit
+        comments_per_post: upper bound on the comments in a normal post's tree
+        depth: deepest reply level, top level comments are depth 1
+        fanout: most replies a comment gets, the actual number is drawn between 0 and fanout
+        mention_density: chance that a title or comment mentions a ticker
+        megathreads: The Lounge posts, one per subreddit at most
+        megathread_comments: comments in each megathread, mostly top level with short reply chains
+    Returns:
+        (post rows, comment rows) in Post_Columns / Comment_Columns order
+    """
+    rng = random.Random(seed)
+    symbols = sorted(universe)
+    post_rows = []
+    comment_rows = []
+    clock = 1700000000
+
+    def comment(post_id, parent_id):
+        nonlocal clock
+        clock += 1
+        comment_id = f"c{len(comment_rows)}"
+        body = synthetic_text(rng, symbols, mention_density)
+        comment_rows.append((comment_id, body, f"user{rng.randrange(5000)}", clock, parent_id, post_id, rng.randint(-5, 500)))
+        return comment_id
+
+    def thread(post_id, budget, max_depth, top_fanout, reply_fanout):
+        # breadth first so replies are always created after their parent
+        level = [None]
+        for _ in range(max_depth):
+            next_level = []
+            for parent_id in level:
+                replies = rng.randint(1, top_fanout) if parent_id is None else rng.randint(0, reply_fanout)
+                for _ in range(replies):
+                    if budget <= 0:
+                        return
+                    next_level.append(comment(post_id, parent_id))
+                    budget -= 1
+            if not next_level:
+                return
+            level = next_level
+
+    for s in range(subreddits):
+        subreddit = f"synthetic{s}"
+        for p in range(posts):
+            clock += 1
+            post_id = f"p{s}_{p}"
+            title = synthetic_text(rng, symbols, mention_density, words=(3, 15))
+            post_rows.append((post_id, subreddit, title, "", f"user{rng.randrange(5000)}", clock, rng.randint(0, 5000)))
+            thread(post_id, rng.randint(1, comments_per_post), depth, fanout, fanout)
+
+        if s < megathreads:
+            clock += 1
+            post_id = f"lounge{s}"
+            post_rows.append((post_id, subreddit, "The Lounge", "", "AutoModerator", clock, 0))
+            # very wide at the top, short reply chains under it
+            thread(post_id, megathread_comments, 3, max(1, megathread_comments // 2), 2)
+
+    return post_rows, comment_rows
+
+
+def describe(post_rows, comment_rows):
+    depth = {}
+    deepest = 0
+    for row in comment_rows:
+        parent_id = row[4]
+        depth[row[0]] = depth[parent_id] + 1 if parent_id else 1
+        deepest = max(deepest, depth[row[0]])
+    lounge = sum(1 for row in post_rows if row[2] == "The Lounge")
+    return f"{len(post_rows)} posts ({lounge} megathreads), {len(comment_rows)} comments, deepest reply {deepest}"
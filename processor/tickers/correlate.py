@@ -0,0 +1,251 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from prices import PriceStore
+
+"""Sentiment against price, for every ticker at once
+The daily sentiment aggregates (processed_data, or rollup.daily_rollup of a run) are laid onto the price store's
+trading days as a (tickers, days) matrix, a mention on a day the market was closed counts for the next trading day.
+Everything after that is a few vectorized passes over whole matrices instead of a Python loop per ticker:
+    lagged_correlation   Pearson correlation of the signal on day d with the log return on day d + lag, for each
+                         ticker and lag, over the days both have a value (lag > 0: sentiment leads the price)
+    rolling_zscore       each day against the trailing window of days before it
+    event_windows        abnormal returns (the return less the ticker's mean return) around the days the signal's
+                         z-score crosses a threshold, averaged over every event of every ticker
+Signals: sentiment (the mention weighted average sentiment of the day), sentiment_change (its change from the
+previous trading day) and volume (log of the day's mentions).
+Run from processor/tickers:
+    python correlate.py --lags -5 5 --signal sentiment_change --threshold 2
+"""
+
+Signals = ("sentiment", "sentiment_change", "volume")
+
+# tickers per pass, bounds the temporaries to a few hundred MB on a full universe
+CHUNK = 1024
+
+
+def read_daily(conn):
+    with conn.cursor() as curr:
+        curr.execute("SELECT ticker, mention_date, mention_volume, avg_sentiment FROM processed_data")
+        return pd.DataFrame(curr.fetchall(), columns=["ticker", "mention_date", "mention_volume", "avg_sentiment"])
+
+
+def sentiment_matrix(daily, store):
+    """
+    Args:
+        daily: DataFrame with ticker, mention_date, mention_volume, avg_sentiment (processed_data rows)
+        store: PriceStore
+    Returns:
+        (rows, sentiment, volume): store rows of the tickers that have both mentions and prices, and their mention
+        weighted sentiment and mention count per trading day, NaN / 0 on days without mentions
+    """
+    tickers = daily["ticker"].to_numpy().astype(str)
+    rows = store.rows(tickers)
+    days = store.days(pd.to_datetime(daily["mention_date"]).to_numpy().astype("datetime64[D]"), after=True)
+    keep = (rows >= 0) & (days >= 0)
+    rows, days = rows[keep], days[keep]
+    mentions = daily["mention_volume"].to_numpy(dtype=np.float64)[keep]
+    sentiment = daily["avg_sentiment"].to_numpy(dtype=np.float64)[keep]
+
+    used, local = np.unique(rows, return_inverse=True)
+    cells = local * len(store.dates) + days
+    size = len(used) * len(store.dates)
+    scored = ~np.isnan(sentiment)
+    # a weekend folds into monday as a mention weighted mean
+    weight = np.bincount(cells[scored], weights=mentions[scored], minlength=size)
+    total = np.bincount(cells[scored], weights=(sentiment * mentions)[scored], minlength=size)
+    volume = np.bincount(cells, weights=mentions, minlength=size).reshape(len(used), -1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = np.where(weight > 0, total / weight, np.nan).reshape(len(used), -1)
+    return used, average, volume
+
+
+def log_returns(close):
+    """
+    Returns:
+        log(close[d] / close[d - 1]) per row, NaN on the first day and next to a missing close
+    """
+    close = np.asarray(close, dtype=np.float64)
+    out = np.full(close.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out[:, 1:] = np.log(close[:, 1:] / close[:, :-1])
+    out[~np.isfinite(out)] = np.nan
+    return out
+
+
+def signal(kind, sentiment, volume):
+    if kind == "sentiment":
+        return sentiment
+    if kind == "sentiment_change":
+        out = np.full(sentiment.shape, np.nan)
+        out[:, 1:] = sentiment[:, 1:] - sentiment[:, :-1]
+        return out
+    if kind == "volume":
+        return np.log1p(volume)
+    raise ValueError(f"signal must be one of {Signals}")
+
+
+def _aligned(x, y, lag):
+    # x on day d against y on day d + lag
+    days = x.shape[1]
+    if lag >= 0:
+        return x[:, :days - lag], y[:, lag:]
+    return x[:, -lag:], y[:, :days + lag]
+
+
+def lagged_correlation(x, y, lags, min_periods = 20):
+    """
+    Pearson correlation per row for each lag over the days both x and y are finite
+    Args:
+        x, y: (rows, days) arrays on the same days
+        lags: lags in days, y is taken lag days after x
+        min_periods: fewer common days than this gives NaN
+    Returns:
+        (corr, n), both (rows, len(lags))
+    """
+    lags = list(lags)
+    corr = np.full((x.shape[0], len(lags)), np.nan)
+    counts = np.zeros((x.shape[0], len(lags)), dtype=np.int64)
+    for start in range(0, x.shape[0], CHUNK):
+        xs, ys = x[start:start + CHUNK], y[start:start + CHUNK]
+        for j, lag in enumerate(lags):
+            a, b = _aligned(xs, ys, lag)
+            both = np.isfinite(a) & np.isfinite(b)
+            n = both.sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                # centred on the means of the common days, not the sums of squares, so small returns keep their precision
+                a = np.where(both, a, 0.0)
+                b = np.where(both, b, 0.0)
+                a -= (a.sum(axis=1) / n)[:, None]
+                b -= (b.sum(axis=1) / n)[:, None]
+                a[~both] = 0.0
+                b[~both] = 0.0
+                r = (a * b).sum(axis=1) / np.sqrt((a * a).sum(axis=1) * (b * b).sum(axis=1))
+            corr[start:start + CHUNK, j] = np.where(n >= min_periods, r, np.nan)
+            counts[start:start + CHUNK, j] = n
+    return corr, counts
+
+
+def rolling_zscore(x, window = 20, min_periods = None):
+    """
+    Each day against the mean and standard deviation of the finite values in the window days before it
+    Returns:
+        (rows, days) z-scores, NaN where x is NaN, the window has fewer than min_periods values or no spread
+    """
+    min_periods = min_periods or max(2, window // 2)
+    finite = np.isfinite(x)
+    values = np.where(finite, x, 0.0)
+    pad = np.zeros((x.shape[0], 1))
+    # cumulative sums with a leading zero, the window before day d is [d - window, d)
+    count = np.concatenate([pad, np.cumsum(finite, axis=1)], axis=1)
+    total = np.concatenate([pad, np.cumsum(values, axis=1)], axis=1)
+    squares = np.concatenate([pad, np.cumsum(values * values, axis=1)], axis=1)
+    days = np.arange(x.shape[1])
+    lo = np.maximum(days - window, 0)
+    n = count[:, days] - count[:, lo]
+    s = total[:, days] - total[:, lo]
+    ss = squares[:, days] - squares[:, lo]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = s / n
+        std = np.sqrt(np.maximum(ss / n - mean * mean, 0.0) * n / (n - 1))
+        z = (x - mean) / std
+    z[(n < min_periods) | ~finite | ~(std > 0)] = np.nan
+    return z
+
+
+def event_windows(events, returns, before = 5, after = 10):
+    """
+    Average abnormal return around the events
+    Args:
+        events: (rows, days) bool, True on an event day
+        returns: (rows, days) log returns on the same rows
+        before, after: trading days either side of the event day
+    Returns:
+        DataFrame indexed by offset (-before .. after) with the mean abnormal return, its cumulative sum from -before
+        (the CAR) and the number of events with a return at that offset
+    """
+    with np.errstate(invalid="ignore"):
+        abnormal = returns - np.nanmean(returns, axis=1, keepdims=True)
+    rows, days = np.nonzero(events)
+    offsets = np.arange(-before, after + 1)
+    at = days[:, None] + offsets[None, :]
+    inside = (at >= 0) & (at < returns.shape[1])
+    window = np.full(at.shape, np.nan)
+    window[inside] = abnormal[np.broadcast_to(rows[:, None], at.shape)[inside], at[inside]]
+    counts = np.isfinite(window).sum(axis=0)
+    with np.errstate(invalid="ignore"):
+        mean = np.where(counts > 0, np.nansum(window, axis=0) / np.maximum(counts, 1), np.nan)
+    return pd.DataFrame({"mean_abnormal": mean, "car": np.nancumsum(mean), "events": counts},
+                        index=pd.Index(offsets, name="offset"))
+
+
+def scan(daily, store, lags = range(-5, 6), kind = "sentiment", min_periods = 20, window = 20, threshold = 2.0,
+         before = 5, after = 10):
+    """
+    Every ticker with mentions and prices, every lag
+    Args:
+        daily: processed_data rows, see sentiment_matrix
+        store: PriceStore
+        lags: see lagged_correlation
+        kind: one of Signals
+        window, threshold: an event is a day the signal's rolling z-score is at least threshold (at most -threshold
+            for a negative threshold)
+        before, after: event window
+    Returns:
+        (correlations, events): a DataFrame with ticker, lag, corr, n and t_stat per ticker and lag, and the
+        event_windows DataFrame
+    """
+    rows, sentiment, volume = sentiment_matrix(daily, store)
+    close = np.asarray(store.column("close")[rows], dtype=np.float64)
+    adjusted = np.asarray(store.column("adj_close")[rows], dtype=np.float64)
+    # adjusted closes for the tickers that have them, a split or a dividend is not a move
+    has_adjusted = np.isfinite(adjusted).any(axis=1)
+    close[has_adjusted] = adjusted[has_adjusted]
+    returns = log_returns(close)
+    x = signal(kind, sentiment, volume)
+
+    corr, n = lagged_correlation(x, returns, lags, min_periods)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t_stat = corr * np.sqrt((n - 2) / (1 - corr * corr))
+    lags = list(lags)
+    correlations = pd.DataFrame({
+        "ticker": np.repeat(store.tickers[rows], len(lags)),
+        "lag": np.tile(lags, len(rows)),
+        "corr": corr.ravel(),
+        "n": n.ravel(),
+        "t_stat": t_stat.ravel(),
+    })
+
+    z = rolling_zscore(x, window)
+    with np.errstate(invalid="ignore"):
+        hits = z >= threshold if threshold >= 0 else z <= threshold
+    return correlations, event_windows(hits, returns, before, after)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlate daily sentiment with price moves for every ticker")
+    parser.add_argument("--store", help="price store directory, defaults to PRICE_STORE or ./price_store")
+    parser.add_argument("--lags", type=int, nargs=2, default=(-5, 5), metavar=("FROM", "TO"))
+    parser.add_argument("--signal", choices=Signals, default="sentiment")
+    parser.add_argument("--min-periods", type=int, default=20)
+    parser.add_argument("--window", type=int, default=20, help="trading days in the z-score window")
+    parser.add_argument("--threshold", type=float, default=2.0, help="z-score of an event day")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--out", help="write every ticker and lag to this csv")
+    args = parser.parse_args()
+
+    from db import connection
+    with connection("read") as conn:
+        daily = read_daily(conn)
+    start = time.perf_counter()
+    correlations, events = scan(daily, PriceStore(args.store), range(args.lags[0], args.lags[1] + 1), args.signal,
+                                args.min_periods, args.window, args.threshold)
+    print(f"{correlations['ticker'].nunique()} tickers x {correlations['lag'].nunique()} lags "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    scored = correlations.dropna(subset=["corr"])
+    print(scored.reindex(scored["t_stat"].abs().sort_values(ascending=False).index).head(args.top).to_string(index=False))
+    print(events.to_string())
+    if args.out:
+        correlations.to_csv(args.out, index=False)
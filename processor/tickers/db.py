@@ -1,6 +1,13 @@
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+from contextlib import contextmanager
+import atexit
 import os
+import random
+import threading
+import time
 
 load_dotenv()
 
@@ -11,20 +18,199 @@ DB_USER = os.getenv("DB_USER")
 DB_PORT = os.getenv("DB_PORT")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-def connection():
+"""Pooled Postgres connections
+There is one pool per role. "write" is the primary from DB_HOST etc, "read" is for the scans and uses DB_READ_HOST,
+DB_READ_PORT, DB_READ_NAME, DB_READ_USER and DB_READ_PASSWORD where they are set (eg: a replica) and the primary
+settings otherwise.
+    with connection("read") as conn:
+        ...
+The connection goes back to its pool at the end of the block, anything not committed by then is rolled back.
+Connecting is retried with exponential backoff and a connection that sat idle in the pool is checked before it is
+handed out again. Failures raise, nothing is hidden behind a None.
+Tuning (environment): DB_POOL_SIZE connections per role (4), DB_POOL_TIMEOUT seconds to wait for a free one (30),
+DB_CONNECT_RETRIES (5), DB_RETRY_BACKOFF first wait in seconds (0.5), DB_HEALTHCHECK_IDLE seconds idle before a
+checkout runs SELECT 1 (30).
+"""
+
+ROLES = ("write", "read")
+
+
+def settings(role = "write"):
+    primary = {"host": DB_HOST, "dbname": DB_NAME, "user": DB_USER, "port": DB_PORT, "password": DB_PASSWORD}
+    if role == "write":
+        return primary
+    if role != "read":
+        raise ValueError(f"unknown database role {role!r}, expected one of {ROLES}")
+    return {key: os.getenv(f"DB_READ_{env}") or value
+            for (key, value), env in zip(primary.items(), ("HOST", "NAME", "USER", "PORT", "PASSWORD"))}
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of psycopg2 connections for one role, at most size are open at a time
+    getconn blocks up to timeout seconds for a free connection and raises PoolError after that
+    """
+
+    def __init__(self, role = "write", size = None, timeout = None, retries = None, backoff = None, healthcheck_idle = None):
+        self.role = role
+        self.settings = settings(role)
+        self.size = size or int(os.getenv("DB_POOL_SIZE", 4))
+        self.timeout = timeout if timeout is not None else float(os.getenv("DB_POOL_TIMEOUT", 30))
+        self.retries = retries if retries is not None else int(os.getenv("DB_CONNECT_RETRIES", 5))
+        self.backoff = backoff if backoff is not None else float(os.getenv("DB_RETRY_BACKOFF", 0.5))
+        self.healthcheck_idle = healthcheck_idle if healthcheck_idle is not None else float(os.getenv("DB_HEALTHCHECK_IDLE", 30))
+        self.max_backoff = 10.0
+        self.pid = os.getpid()
+
+        self._idle = []  # (conn, monotonic time it came back)
+        self._open = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        for attempt in range(self.retries + 1):
+            try:
+                return psycopg2.connect(**self.settings)
+            except psycopg2.OperationalError as e:
+                if attempt == self.retries:
+                    raise
+                # the wait doubles every attempt, the jitter keeps parallel runs from retrying in step
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"Could not connect to the {self.role} database (attempt {attempt + 1}), retrying in {delay:.1f}s: ", e)
+                time.sleep(delay)
+
+    def _healthy(self, conn, since):
+        if conn.closed:
+            return False
+        if time.monotonic() - since < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as curr:
+                curr.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                if self._idle:
+                    conn, since = self._idle.pop()
+                elif self._open < self.size:
+                    self._open += 1
+                    conn, since = None, None
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolError(f"no {self.role} connection free after {self.timeout:g}s ({self.size} in use)")
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._open -= 1
+                        self._cond.notify()
+                    raise
+            # the health check runs outside the lock so a slow server does not hold up the other threads
+            if self._healthy(conn, since):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, broken = False):
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        # a pooled connection always goes back clean, whatever the last user left open is rolled back
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(role = "write"):
+    with _pools_lock:
+        pool = _pools.get(role)
+        # a forked process must not share the parent's sockets, it gets its own pool
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[role] = ConnectionPool(role)
+        return pool
+
+
+@contextmanager
+def connection(role = "write"):
+    """
+    A pooled connection for the block, commit inside the block, it is rolled back on the way out
+    Args:
+        role: "write" for the primary, "read" for scans (DB_READ_* settings, the primary when unset)
+    Yields:
+        psycopg2 connection
+    """
+    pool = get_pool(role)
+    conn = pool.getconn()
+    broken = False
     try:
-        # connect to the database
-        conn = psycopg2.connect(
-            host = DB_HOST,
-            dbname = DB_NAME,
-            user = DB_USER,
-            port = DB_PORT,
-            password = DB_PASSWORD
-        )
-        print("Conenection successful")
-        return conn
-    except Exception as e:
-        print("An Error occured while connecting to the database: ", e)
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # the server went away or the socket is dead, do not hand this connection out again
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, broken=broken)
+
+
+def close_pools():
+    with _pools_lock:
+        pools = [pool for pool in _pools.values() if pool.pid == os.getpid()]
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
+
+
+atexit.register(close_pools)
+
+
+def server_cursor(conn, name, itersize = 2000):
+    """
+    Named (server side) cursor, the result set stays in postgres and comes over itersize rows at a time
+    instead of libpq pulling the whole table into memory on execute
+    """
+    curr = conn.cursor(name=name)
+    curr.itersize = itersize
+    return curr
 
 if __name__ == "__main__":
-    connection()
+    for role in ROLES:
+        with connection(role) as conn:
+            print(f"{role} connection successful: {conn.info.host}:{conn.info.port}/{conn.info.dbname}")
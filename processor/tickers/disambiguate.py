@@ -0,0 +1,277 @@
+import argparse
+import hashlib
+import os
+import time
+import zlib
+from itertools import chain
+import numpy as np
+from matcher import TickerMatcher, Word_RE, Digits_RE, window_has_number
+
+"""Lowercase ticker disambiguation
+A lowercase word that is also a ticker (tsla, but also all, now, fun, love) is a mention or just a word depending on
+the words around it. A logistic regression over hashed features of the word and its context decides:
+    t=<word>                 the ticker itself, common words end up with a negative weight
+    l1= / r1=                the words right before and after it
+    l= / r=                  the other words within Window words either side
+    ctx / num                the text has a context word (rules.Context_Words) / a number within 50 characters
+Features are hashed into Dim buckets with crc32, so there is no vocabulary to keep and the model is one float32 array.
+Training is offline and needs no labelling: the dollar, symbol and allcaps matches that score over the threshold are
+the positives (their context looks exactly the same once lowercased), every lowercase candidate of a text that has no
+sure match of that ticker is a negative.
+Scoring a set of candidates is a sparse matrix vector product: np.bincount over the hashed indices of all the rows.
+The model is PROCESSOR_LOWERCASE_MODEL (./lowercase_model.npz, "off" to turn it off), the workers load it when the
+file exists and then look for lowercase candidates in every text.
+Run from processor/tickers:
+    python disambiguate.py train --limit 500000
+"""
+
+Dim = 1 << 18
+Window = 3
+# characters either side to find the context words in
+Span = 40
+# feature name -> bucket lookups kept per model, the same names come up again and again
+Memo_Size = 500000
+
+
+def feature_names(text, start, end, ticker, has_context, has_number):
+    """
+    Args:
+        text: the whole text
+        start, end: the ticker word in the text, without a $ or ticker: in front
+        ticker: the uppercase ticker
+        has_context, has_number: see matcher.Scan, the number only counts within 50 characters
+    Returns:
+        the feature strings of the candidate
+    """
+    left = Word_RE.findall(text, max(0, start - Span), start)
+    if start > Span and left:
+        left = left[1:]  # cut off by the window
+    right = Word_RE.findall(text, end, end + Span)
+    if end + Span < len(text) and right:
+        right = right[:-1]
+    left = [w.lower() if w.isalpha() else Digits_RE.sub("0", w.lower()) for w in left[-Window:]]
+    right = [w.lower() if w.isalpha() else Digits_RE.sub("0", w.lower()) for w in right[:Window]]
+
+    names = ["t=" + ticker.lower(), "l1=" + (left[-1] if left else "^"), "r1=" + (right[0] if right else "$")]
+    names.extend("l=" + w for w in left[:-1])
+    names.extend("r=" + w for w in right[1:])
+    if has_context:
+        names.append("ctx")
+    if has_number:
+        names.append("num")
+    return names
+
+
+class LowercaseClassifier:
+    """
+    weights: float32 array, one weight per hashed feature, its length is the number of buckets (a power of two)
+    bias: intercept
+    meta: anything to save with the model, eg: how it was trained
+    """
+
+    def __init__(self, weights, bias = 0.0, meta = None):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = float(bias)
+        self.meta = meta or {}
+        self.version = hashlib.blake2b(self.weights.tobytes() + repr(self.bias).encode(), digest_size=8).hexdigest()
+        self._buckets = {}
+
+    def features(self, text, candidate, scan):
+        """
+        Args:
+            candidate: (ticker, kind, pos, raw) from matcher.Scan, any kind
+            scan: the matcher.Scan of the text
+        Returns:
+            hashed feature indices of the candidate, one row for predict
+        """
+        ticker, kind, pos, raw = candidate
+        end = pos + len(raw)
+        start = end - len(ticker)
+        near = bool(scan.numbers) and window_has_number(scan.numbers, max(0, pos - 50), min(len(text), pos + 50))
+        buckets = self._buckets
+        if len(buckets) > Memo_Size:
+            buckets.clear()
+        mask = len(self.weights) - 1
+        row = []
+        for name in feature_names(text, start, end, ticker, scan.has_context, near):
+            bucket = buckets.get(name)
+            if bucket is None:
+                bucket = buckets[name] = zlib.crc32(name.encode()) & mask
+            row.append(bucket)
+        return row
+
+    def predict(self, rows):
+        """
+        Args:
+            rows: list of hashed feature rows
+        Returns:
+            probability that each row is a ticker mention, all of them in one sparse product
+        """
+        if not rows:
+            return np.zeros(0)
+        owner, indices = _flatten(rows)
+        z = np.bincount(owner, weights=self.weights[indices], minlength=len(rows)) + self.bias
+        return _sigmoid(z)
+
+    def save(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, weights=self.weights, bias=self.bias, meta=repr(self.meta))
+        os.replace(tmp, path)
+
+
+def _flatten(rows):
+    # the rows as one sparse matrix: the row of each entry and its column
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+    indices = np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=int(lengths.sum()))
+    return np.repeat(np.arange(len(rows)), lengths), indices
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -35, 35)))
+
+
+def load_classifier(path):
+    with np.load(path) as data:
+        return LowercaseClassifier(data["weights"], float(data["bias"]), {"path": str(path)})
+
+
+def model_path():
+    # None when the model is turned off
+    path = os.getenv("PROCESSOR_LOWERCASE_MODEL", "./lowercase_model.npz")
+    if path.lower() in ("", "off", "0", "false"):
+        return None
+    return path
+
+
+def open_classifier():
+    """
+    The run's model from PROCESSOR_LOWERCASE_MODEL
+    Returns:
+        LowercaseClassifier, None when it is off or there is no model file
+    """
+    path = model_path()
+    if path is None or not os.path.exists(path):
+        return None
+    return load_classifier(path)
+
+
+def model_version():
+    # for the extraction cache, a different model gives different matches
+    classifier = open_classifier()
+    return classifier.version if classifier else ""
+
+
+def examples(texts, matcher, threshold = 0.9, dim = Dim):
+    """
+    Weakly labelled rows from raw texts, see the module docstring
+    Args:
+        texts: comment bodies and post titles
+        matcher: TickerMatcher without a classifier
+        threshold: score a dollar, symbol or allcaps match needs to count as a positive
+    Returns:
+        (rows, labels)
+    """
+    rows = []
+    labels = []
+    model = LowercaseClassifier(np.zeros(dim, dtype=np.float32))
+    for text in texts:
+        if not text:
+            continue
+        scan = matcher.scan(text, True)
+        if not scan.candidates and not scan.lowercase:
+            continue
+        sure = {(pos, ticker) for ticker, kind, score, pos in matcher.scored(text, threshold=threshold)}
+        for candidate in scan.candidates:
+            if (candidate[2], candidate[0]) in sure:
+                rows.append(model.features(text, candidate, scan))
+                labels.append(1)
+        found = {ticker for _, ticker in sure}
+        for candidate in scan.lowercase:
+            if candidate[0] not in found:
+                rows.append(model.features(text, candidate, scan))
+                labels.append(0)
+    return rows, np.array(labels, dtype=np.float64)
+
+
+def fit(rows, labels, dim = Dim, epochs = 150, rate = 0.5, l2 = 1e-6):
+    """
+    Logistic regression by full batch gradient descent with AdaGrad steps, the two classes weighted to the same total
+    Args:
+        rows: hashed feature rows from examples
+        labels: 1 for a mention, 0 otherwise
+    Returns:
+        LowercaseClassifier
+    """
+    n = len(rows)
+    positives = labels.sum()
+    if not positives or positives == n:
+        raise ValueError("need both mentions and non mentions to train on")
+    owner, indices = _flatten(rows)
+    balance = np.where(labels == 1, n / (2 * positives), n / (2 * (n - positives))) / n
+
+    weights = np.zeros(dim)
+    bias = 0.0
+    squares = np.zeros(dim)
+    bias_squares = 0.0
+    for _ in range(epochs):
+        z = np.bincount(owner, weights=weights[indices], minlength=n) + bias
+        error = balance * (_sigmoid(z) - labels)
+        grad = np.bincount(indices, weights=error[owner], minlength=dim) + l2 * weights
+        squares += grad * grad
+        weights -= rate * grad / (np.sqrt(squares) + 1e-8)
+        bias_grad = error.sum()
+        bias_squares += bias_grad * bias_grad
+        bias -= rate * bias_grad / (np.sqrt(bias_squares) + 1e-8)
+    return LowercaseClassifier(weights, bias, {"examples": n, "positives": int(positives), "epochs": epochs})
+
+
+def precision_recall(probabilities, labels, threshold):
+    predicted = probabilities > threshold
+    hits = (predicted & (labels == 1)).sum()
+    precision = hits / predicted.sum() if predicted.any() else 0.0
+    recall = hits / (labels == 1).sum() if (labels == 1).any() else 0.0
+    return float(precision), float(recall)
+
+
+def read_texts(conn, limit = None):
+    from db import server_cursor
+    curr = server_cursor(conn, "lowercase_texts")
+    curr.execute("SELECT title FROM posts UNION ALL SELECT body FROM comments" + (f" LIMIT {int(limit)}" if limit else ""))
+    texts = [row[0] for row in curr]
+    curr.close()
+    return texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lowercase ticker disambiguation model")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train_parser = commands.add_parser("train", help="train on the posts and comments in the database")
+    train_parser.add_argument("--limit", type=int, help="texts to read, all of them by default")
+    train_parser.add_argument("--out", help="model file, defaults to PROCESSOR_LOWERCASE_MODEL or ./lowercase_model.npz")
+    train_parser.add_argument("--epochs", type=int, default=150)
+    train_parser.add_argument("--threshold", type=float, default=0.9)
+    args = parser.parse_args()
+
+    from db import connection
+    from universe import load_universe
+    universe = load_universe()
+    with connection("read") as conn:
+        texts = read_texts(conn, args.limit)
+    start = time.perf_counter()
+    rows, labels = examples(texts, TickerMatcher(frozenset(universe.symbols)), args.threshold)
+    print(f"{len(texts):,} texts: {int(labels.sum()):,} mentions, {int(len(labels) - labels.sum()):,} other lowercase "
+          f"candidates in {time.perf_counter() - start:.2f}s")
+
+    # every tenth row is held out for the report
+    held = np.arange(len(rows)) % 10 == 0
+    start = time.perf_counter()
+    classifier = fit([r for r, h in zip(rows, held) if not h], labels[~held], epochs=args.epochs)
+    print(f"trained in {time.perf_counter() - start:.2f}s")
+    probabilities = classifier.predict([r for r, h in zip(rows, held) if h])
+    for threshold in (0.5, args.threshold):
+        precision, recall = precision_recall(probabilities, labels[held], threshold)
+        print(f"held out at {threshold}: precision {precision:.3f} recall {recall:.3f}")
+
+    classifier = fit(rows, labels, epochs=args.epochs)
+    classifier.save(args.out or model_path() or "./lowercase_model.npz")
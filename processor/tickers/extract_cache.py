@@ -0,0 +1,243 @@
+import hashlib
+import marshal
+import os
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from mentions import Kinds
+
+"""Extraction cache
+The collector upserts the same comments again every cycle and bots and copypasta repeat the same texts, so most
+bodies the processor sees have been matched before. Results are cached by a hash of the text together with the
+ticker universe version and the rules version, so a changed universe or a change to rules.py / matcher.py can never
+serve a stale result.
+Lookups go to an in process LRU first and then to a SQLite file, a hit costs a blake2b of the text and a dict or
+index lookup instead of a matcher pass. New results are written in one transaction every flush_every entries.
+The file is bounded to max_entries: every flush stamps the rows it touched with a new generation and the oldest
+generations are deleted once the file grows past the bound.
+Settings (environment): PROCESSOR_CACHE path of the SQLite file (./extract_cache.sqlite, "off" to turn it off),
+PROCESSOR_CACHE_MEMORY entries in the LRU (200000), PROCESSOR_CACHE_ENTRIES entries on disk (2000000).
+The VADER scores of sentiment.py are kept in the same file, under their own key prefix.
+"""
+
+# anything that changes what the matcher returns for a text has to change this
+RULE_FILES = ("rules.py", "matcher.py", "disambiguate.py")
+
+
+def rules_version():
+    digest = hashlib.blake2b(repr(Kinds).encode(), digest_size=8)
+    here = Path(__file__).resolve().parent
+    for name in RULE_FILES:
+        digest.update((here / name).read_bytes())
+    return digest.hexdigest()
+
+
+RULES_VERSION = rules_version()
+
+# stands in for a miss, None and [] are both results
+MISSING = object()
+
+Schema = """
+CREATE TABLE IF NOT EXISTS extractions (key BLOB PRIMARY KEY, value BLOB NOT NULL, generation INTEGER NOT NULL) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_extractions_generation ON extractions (generation);
+"""
+
+
+class ExtractionCache:
+    """
+    path: SQLite file, only the in process LRU is used when it is None
+    universe: version of the ticker universe the cached results were matched with
+    memory_size: entries kept in the LRU, 0 turns it off
+    max_entries: rows kept in the file, the least recently used generations go first
+    flush_every: new entries and touched keys buffered before a write
+    rules: version of the code that computes the values, RULES_VERSION for the matcher's results
+    """
+
+    def __init__(self, path = None, universe = "", memory_size = 200000, max_entries = 2000000, flush_every = 5000,
+                 rules = RULES_VERSION):
+        self.path = path
+        self.universe = universe
+        self.rules = rules
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.memory = OrderedDict()
+        self.pending = {}
+        self.touched = set()
+        self.prefixes = {}
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, timeout=30)
+            # several processes on one host can share the file
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(Schema)
+            self.generation = (self.db.execute("SELECT max(generation) FROM extractions").fetchone()[0] or 0) + 1
+            self.entries = self.db.execute("SELECT count(*) FROM extractions").fetchone()[0]
+
+    def key(self, namespace, text):
+        """
+        Args:
+            namespace: what was computed from the text, eg: the worker function name and its flags
+            text: the comment body or post title
+        Returns:
+            16 byte key of (text, namespace, universe version, rules version)
+        """
+        prefix = self.prefixes.get(namespace)
+        if prefix is None:
+            prefix = self.prefixes[namespace] = hashlib.blake2b(
+                f"{self.universe}\0{self.rules}\0{namespace}".encode(), digest_size=32).digest()
+        return hashlib.blake2b((text or "").encode("utf-8", "surrogatepass"), digest_size=16, key=prefix).digest()
+
+    def _remember(self, key, value):
+        if not self.memory_size:
+            return
+        self.memory[key] = value
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Returns:
+            the cached value for each key, MISSING where there is none
+        """
+        values = [MISSING] * len(keys)
+        cold = {}
+        for i, key in enumerate(keys):
+            value = self.memory.get(key, MISSING)
+            if value is MISSING:
+                value = self.pending.get(key, MISSING)
+            if value is not MISSING:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    if self.db is not None:
+                        # still in use, keeps its row on disk from being evicted
+                        self.touched.add(key)
+                values[i] = value
+                self.memory_hits += 1
+            else:
+                cold.setdefault(key, []).append(i)
+
+        if cold and self.db is not None:
+            found = {}
+            wanted = list(cold)
+            # sqlite takes at most 999 parameters in older builds
+            for start in range(0, len(wanted), 900):
+                chunk = wanted[start:start + 900]
+                found.update(self.db.execute(
+                    f"SELECT key, value FROM extractions WHERE key IN ({','.join('?' * len(chunk))})", chunk))
+            for key, blob in found.items():
+                value = marshal.loads(blob)
+                for i in cold.pop(key):
+                    values[i] = value
+                    self.disk_hits += 1
+                self._remember(key, value)
+                self.touched.add(key)
+
+        if self.db is not None and len(self.touched) >= self.flush_every:
+            self.flush()
+        self.misses += sum(len(positions) for positions in cold.values())
+        return values
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def put_many(self, items):
+        # items: (key, value), values have to be marshal-able (tuples, lists, str, int, float)
+        for key, value in items:
+            self._remember(key, value)
+            if self.db is not None:
+                self.pending[key] = value
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def lookup(self, namespace, texts):
+        """
+        Returns:
+            (keys, values) for the texts, values are MISSING for the misses
+        """
+        keys = [self.key(namespace, text) for text in texts]
+        return keys, self.get_many(keys)
+
+    def flush(self):
+        if self.db is None or not (self.pending or self.touched):
+            return
+        generation = self.generation
+        self.generation += 1
+        with self.db:
+            if self.touched:
+                self.db.executemany("UPDATE extractions SET generation = ? WHERE key = ?",
+                                    [(generation, key) for key in self.touched])
+            if self.pending:
+                before = self.db.total_changes
+                self.db.executemany("INSERT OR IGNORE INTO extractions (key, value, generation) VALUES (?, ?, ?)",
+                                    [(key, marshal.dumps(value), generation) for key, value in self.pending.items()])
+                self.entries += self.db.total_changes - before
+            # a tenth of slack so the delete does not run on every flush once the file is full
+            if self.entries > self.max_entries * 1.1:
+                # other processes may share the file, the count here only knows this one's inserts
+                self.entries = self.db.execute("SELECT count(*) FROM extractions").fetchone()[0]
+            if self.entries > self.max_entries * 1.1:
+                excess = self.entries - self.max_entries
+                self.db.execute("DELETE FROM extractions WHERE key IN "
+                                "(SELECT key FROM extractions ORDER BY generation LIMIT ?)", (excess,))
+                self.evicted += excess
+                self.entries -= excess
+        self.pending.clear()
+        self.touched.clear()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def report(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        rate = (self.memory_hits + self.disk_hits) / total if total else 0.0
+        return (f"extraction cache: {self.memory_hits} memory hits, {self.disk_hits} disk hits, {self.misses} misses "
+                f"({rate:.0%} hit rate), {self.evicted} evicted")
+
+
+def cache_path():
+    # None when PROCESSOR_CACHE is "off"
+    path = os.getenv("PROCESSOR_CACHE", "./extract_cache.sqlite")
+    if path.lower() in ("", "off", "0", "false"):
+        return None
+    return path
+
+
+def open_cache(universe):
+    """
+    The run's cache from the PROCESSOR_CACHE settings
+    Args:
+        universe: version of the ticker universe the run matches with
+    Returns:
+        ExtractionCache, None when PROCESSOR_CACHE is "off"
+    """
+    path = cache_path()
+    if path is None:
+        return None
+    # the workers match lowercase tickers with the model when there is one, its results are kept apart
+    from disambiguate import model_version
+    lowercase = model_version()
+    if lowercase:
+        universe = f"{universe}:{lowercase}"
+    return ExtractionCache(path, universe,
+                           memory_size=int(os.getenv("PROCESSOR_CACHE_MEMORY", 200000)),
+                           max_entries=int(os.getenv("PROCESSOR_CACHE_ENTRIES", 2000000)))
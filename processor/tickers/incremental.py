@@ -0,0 +1,297 @@
+import argparse
+import time
+from pathlib import Path
+from sys import intern
+from db import connection, server_cursor
+from tickers import path, propagate_batch, post_mentions
+from workers import start_pool, fetch_batches, match_batches, match_comment, match_post, StageStats
+from writer import TickerWriter
+from sentiment import SentimentScorer, open_sentiment_cache
+from universe import load_universe
+from extract_cache import open_cache
+from metrics import open_metrics
+
+"""Incremental processing
+Only the posts and comments inserted since the last run are matched. Rows are found by the transaction that inserted
+them (the xact column, see queries/collector_xact.sql) and not by inserted_at: now() is the start of the collector's
+transaction, so a transaction still open when a run reads the table commits rows behind any time based mark. Each run
+takes the oldest transaction still running (pg_snapshot_xmin) before it reads, every row it can not see has an xact at
+or above that horizon and the next run starts from it. Rows of transactions that were already done but newer than
+the oldest running one are read again by the next run, the writes skip matches that are already stored.
+Within a run the new rows are taken oldest first, (created_utc, id) like tickers.Comment_Scan, so a parent comes before
+its replies whatever order the collector inserted them in. The run's horizon and the (created_utc, id) of its last
+row are saved in processor_checkpoints in the same transaction that writes the matches of a batch, so a crash part
+way through resumes from the last whole batch with the horizon it started with and nothing is written twice.
+Propagation only fetches what the new comments need: the ancestors of the new comments, their stored matches in
+comment_tickers and the stored post matches in post_tickers.
+Run from processor/tickers:
+    python incremental.py
+"""
+
+Queries = Path(__file__).resolve().parent.parent / "queries"
+
+# rows inserted from the last run's horizon on, after the last row a stopped run wrote, oldest first
+New_Posts = """
+SELECT title, id, author, created_utc FROM posts
+WHERE NOT title = 'The Lounge'
+  AND (xact >= %(since)s::xid8 {before_xact})
+  AND (%(after_created)s::bigint IS NULL OR (created_utc, id) > (%(after_created)s, %(after_last_id)s))
+ORDER BY created_utc, id
+"""
+
+New_Comments = """
+SELECT id, parent_id, post_id, body, author, created_utc FROM comments
+WHERE (xact >= %(since)s::xid8 {before_xact})
+  AND (%(after_created)s::bigint IS NULL OR (created_utc, id) > (%(after_created)s, %(after_last_id)s))
+ORDER BY created_utc, id
+"""
+
+# the rows from before the xact column have none, the first run takes them by the old (inserted_at, id) mark
+Before_Xact = "OR (xact IS NULL AND (inserted_at, id) > (%(after)s, %(after_id)s))"
+
+# before the first run every row is newer than this
+Start = ("-infinity", "")
+
+
+def ensure_checkpoints(conn):
+    with conn.cursor() as curr:
+        curr.execute((Queries / "processor_checkpoints.sql").read_text())
+
+
+def ensure_collector_xact(conn):
+    # the DDL locks posts and comments and would wait behind the collector, so only when the column is missing
+    with conn.cursor() as curr:
+        curr.execute("SELECT count(*) FROM information_schema.columns "
+                     "WHERE table_name IN ('posts', 'comments') AND column_name = 'xact'")
+        if curr.fetchone()[0] < 2:
+            curr.execute((Queries / "collector_xact.sql").read_text())
+    conn.commit()
+
+
+def load_checkpoint(conn, table):
+    with conn.cursor() as curr:
+        curr.execute("SELECT last_inserted_at, last_id FROM processor_checkpoints WHERE table_name = %s", (table,))
+        row = curr.fetchone()
+    return row if row else Start
+
+
+def save_checkpoint(conn, table, inserted_at, last_id):
+    # not committed here, the caller commits it together with the matches of the batch
+    with conn.cursor() as curr:
+        curr.execute("""
+            INSERT INTO processor_checkpoints (table_name, last_inserted_at, last_id, updated_at)
+            VALUES (%s, %s, %s, now())
+            ON CONFLICT (table_name) DO UPDATE
+            SET last_inserted_at = EXCLUDED.last_inserted_at,
+                last_id = EXCLUDED.last_id,
+                updated_at = EXCLUDED.updated_at
+        """, (table, inserted_at, last_id))
+
+
+def load_scan(conn, table):
+    """
+    Returns:
+        (since, run, run_created_utc, run_last_id, last_inserted_at, last_id): the horizon of the last finished run,
+        the horizon and last row of a run that stopped part way (None when there is none) and the old inserted_at mark
+    """
+    with conn.cursor() as curr:
+        curr.execute("""
+            SELECT since_xact::text, run_xact::text, run_created_utc, run_last_id, last_inserted_at, last_id
+            FROM processor_checkpoints WHERE table_name = %s
+        """, (table,))
+        row = curr.fetchone()
+    return row if row else (None, None, None, None) + Start
+
+
+def save_scan(conn, table, since, run = None, created_utc = None, last_id = None):
+    # not committed here, the caller commits it together with the matches of the batch
+    with conn.cursor() as curr:
+        curr.execute("""
+            INSERT INTO processor_checkpoints (table_name, last_inserted_at, last_id, since_xact, run_xact,
+                                               run_created_utc, run_last_id, updated_at)
+            VALUES (%s, '-infinity', '', %s, %s, %s, %s, now())
+            ON CONFLICT (table_name) DO UPDATE
+            SET since_xact = EXCLUDED.since_xact,
+                run_xact = EXCLUDED.run_xact,
+                run_created_utc = EXCLUDED.run_created_utc,
+                run_last_id = EXCLUDED.run_last_id,
+                updated_at = EXCLUDED.updated_at
+        """, (table, since, run, created_utc, last_id))
+
+
+def horizon(conn):
+    # oldest transaction still running, a row that a later snapshot can not see was inserted at or after it
+    with conn.cursor() as curr:
+        curr.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text")
+        return curr.fetchone()[0]
+
+
+def open_scan(read_conn, write_conn, table, query, batchSize):
+    """
+    Starts a run over the new rows of a table, or resumes the one that stopped part way
+    Returns:
+        (server side cursor over the rows, since, run): since and run are saved with each batch, see save_scan
+    """
+    since, run, created_utc, last_id, after, after_id = load_scan(write_conn, table)
+    if run is None:
+        run, created_utc, last_id = horizon(read_conn), None, None
+    curr = server_cursor(read_conn, f"new_{table}", batchSize)
+    curr.execute(query.format(before_xact="" if since else Before_Xact), {
+        "since": since or "0", "after": after, "after_id": after_id,
+        "after_created": created_utc, "after_last_id": last_id or "",
+    })
+    return curr, since, run
+
+
+class Context:
+    """
+    What propagation needs for the new comments, filled in from the database one batch at a time
+    parent_map: comment_id -> parent_id for the new comments and up to three of their ancestors
+    matches_com / matches_post: id -> (ticker, score, ticker, score, ...), from this run or looked up in the ticker tables
+    """
+
+    def __init__(self, conn, matches_post, max_depth = 3):
+        self.conn = conn
+        self.max_depth = max_depth
+        self.parent_map = {}
+        self.matches_com = {}
+        self.matches_post = matches_post
+        # ids already looked up, so nothing is fetched twice
+        self.seen_parents = set()
+        self.seen_comments = set()
+        self.seen_posts = set(matches_post)
+
+    def prepare(self, rows):
+        curr = self.conn.cursor()
+        try:
+            for row in rows:
+                comment_id, parent_id = intern(row[0]), row[1]
+                self.seen_parents.add(comment_id)
+                if parent_id:
+                    self.parent_map[comment_id] = intern(parent_id)
+
+            # walk up from the new comments one level per query
+            ancestors = set()
+            frontier = {row[1] for row in rows if row[1]}
+            for _ in range(self.max_depth):
+                ancestors |= frontier
+                missing = [c for c in frontier if c not in self.seen_parents]
+                if missing:
+                    curr.execute("SELECT id, parent_id FROM comments WHERE id = ANY(%s)", (missing,))
+                    for comment_id, parent_id in curr.fetchall():
+                        if parent_id:
+                            self.parent_map[intern(comment_id)] = intern(parent_id)
+                    self.seen_parents.update(missing)
+                frontier = {self.parent_map[c] for c in frontier if c in self.parent_map}
+                if not frontier:
+                    break
+
+            # stored matches of ancestors from earlier runs
+            missing = [c for c in ancestors if c not in self.matches_com and c not in self.seen_comments]
+            if missing:
+                curr.execute("SELECT comment_id, ticker, confidence FROM comment_tickers WHERE comment_id = ANY(%s)", (missing,))
+                for comment_id, ticker, confidence in curr.fetchall():
+                    self._keep(self.matches_com, comment_id, ticker, confidence)
+                self.seen_comments.update(missing)
+
+            # stored matches of parent posts from earlier runs
+            missing = list({row[2] for row in rows if row[2] and row[2] not in self.seen_posts})
+            if missing:
+                curr.execute("SELECT post_id, ticker, confidence FROM post_tickers WHERE post_id = ANY(%s)", (missing,))
+                for post_id, ticker, confidence in curr.fetchall():
+                    self._keep(self.matches_post, post_id, ticker, confidence)
+                self.seen_posts.update(missing)
+        finally:
+            curr.close()
+
+    @staticmethod
+    def _keep(index, key, ticker, confidence):
+        # every stored ticker of the comment or post, propagation picks the ones that qualify
+        index[key] = index.get(key, ()) + (ticker, confidence)
+
+
+def process_incremental(batchSize = 500, *, workers = None, chunksize = None, sentiment = True):
+    """
+    Matches and writes only the posts and comments added since the last run
+    Args:
+        batchSize: rows per round trip, per write and per checkpoint
+        workers, chunksize: pool settings, see workers.py
+        sentiment: score each match with VADER
+    Returns:
+        dict of rows processed per table
+    """
+    stats = StageStats(open_metrics("incremental"))
+    processed = {"posts": 0, "comments": 0}
+    universe = load_universe(path)
+    cache = open_cache(universe.version)
+
+    # reads come through server side cursors which a commit would close, so the writes get their own connection
+    # the read side can be a replica, the checkpoints and the matches go to the primary
+    with connection("read") as read_conn, connection("write") as write_conn:
+        ensure_checkpoints(write_conn)
+        ensure_collector_xact(write_conn)
+        writer = TickerWriter(write_conn, page_size=batchSize, commit_pages=False, universe=universe.version, stats=stats)
+
+        with start_pool(universe.symbols, workers) as pool:
+            scorer = SentimentScorer(pool, open_sentiment_cache()) if sentiment else None
+
+            # ---------- posts ----------
+            matches_post = {}
+            curr, since, run = open_scan(read_conn, write_conn, "posts", New_Posts, batchSize)
+            for rows, bucketed in match_batches(pool, fetch_batches(curr, batchSize, stats), match_post, 0, chunksize, stats, cache):
+                found = post_mentions(rows, bucketed, matches_post)
+                stats.mentions("post", found)
+                if scorer:
+                    scorer.annotate(found)
+                writer.add_posts(found)
+                save_scan(write_conn, "posts", since, run, rows[-1][3], rows[-1][1])
+                writer.commit()
+                processed["posts"] += len(rows)
+            curr.close()
+            save_scan(write_conn, "posts", run)
+            write_conn.commit()
+
+            # ---------- comments ----------
+            context = Context(read_conn, matches_post)
+            curr, since, run = open_scan(read_conn, write_conn, "comments", New_Comments, batchSize)
+            for rows, bucketed in match_batches(pool, fetch_batches(curr, batchSize, stats), match_comment, 3, chunksize, stats, cache):
+                start = time.perf_counter()
+                context.prepare(rows)
+                stats.add("context", len(rows), time.perf_counter() - start)
+
+                start = time.perf_counter()
+                found = propagate_batch(rows, bucketed, context.matches_com, context.matches_post, context.parent_map)
+                stats.add("propagate", len(rows), time.perf_counter() - start)
+                stats.mentions("comment", found)
+
+                if scorer:
+                    start = time.perf_counter()
+                    scorer.annotate(found)
+                    stats.add("sentiment", len(found.docs), time.perf_counter() - start)
+
+                writer.add_comments(found)
+                save_scan(write_conn, "comments", since, run, rows[-1][5], rows[-1][0])
+                writer.commit()
+                processed["comments"] += len(rows)
+            curr.close()
+            save_scan(write_conn, "comments", run)
+            write_conn.commit()
+
+    print(stats.report())
+    if scorer:
+        scorer.close()
+        print(scorer.report())
+    if cache:
+        cache.close()
+        print(cache.report())
+    stats.finish(scorer, cache)
+    print(f"processed {processed['posts']} new posts and {processed['comments']} new comments")
+    return processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process the posts and comments added since the last run")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+    process_incremental(args.batch_size, workers=args.workers)
@@ -0,0 +1,267 @@
+import re
+from collections import namedtuple
+from rules import Symbol_RE, Context_Words, Redlist
+from mentions import Kind_Codes
+from extract_cache import MISSING
+
+"""Single pass ticker matcher
+The regex path in tickers.py sweeps every text four times (dollar, symbol, allcaps, lowercase) and then runs
+context_RE and a Numerical_RE window search again for every candidate.
+Every one of those rules is anchored on word boundaries, so here we walk the word runs of the text once and work out
+all the candidates, the context flag and the positions of the numbers in that single walk.
+The output of TickerMatcher.process_text is the same as tickers.process_text on the regex path.
+The pipeline uses TickerMatcher.mentions instead, every ticker of the text once as a small tuple (see mentions.py).
+Lowercase candidates (tsla) are only looked for when allow_lowercase is set. With a disambiguate.LowercaseClassifier
+they are scored by the model, TickerMatcher.mentions_many scores all of them for a list of texts in one go.
+"""
+
+# one maximal run of word characters, every rule in rules.py is decided on these
+Word_RE = re.compile(r"\w+")
+Digits_RE = re.compile(r"\d+")
+
+# fallbacks for non ascii words so re.I case folding (eg: the kelvin sign for k) behaves exactly like the regexes
+Symbol_Key_RE = re.compile(r"ticker|symbol", re.I)
+Context_Word_RE = re.compile(r"(?:" + "|".join(re.escape(w) for w in Context_Words if w.isalpha()) + r")", re.I)
+
+Context_Set = frozenset(w.lower() for w in Context_Words if w.isalpha())
+Symbol_Keys = ("ticker", "symbol")
+
+# an ascii text with none of $, a digit, two capitals in a row or the symbol keywords can not give a candidate
+# (unless lowercase tickers are allowed on context alone), separate single class patterns are a lot faster than
+# one alternation
+Dollar_Digit_RE = re.compile(r"[$0-9]")
+Two_Caps_RE = re.compile(r"[A-Z][A-Z]")
+
+
+def maybe_ticker(text):
+    # non ascii texts always get the full walk, unicode digits and re.I case folding are handled there
+    if not text.isascii() or Dollar_Digit_RE.search(text) or Two_Caps_RE.search(text):
+        return True
+    lowered = text.lower()
+    return "ticker" in lowered or "symbol" in lowered
+
+# what a single walk over a text gives back
+# candidates: [(ticker, kind, pos, raw)], lowercase: the lowercase ones, only looked for when allow_lowercase is set
+# has_context: context_RE would match, numbers: [(start, end, open_left, open_right)]
+Scan = namedtuple("Scan", ["candidates", "lowercase", "has_context", "has_number", "numbers"])
+
+
+def window_has_number(numbers, start, end):
+    """
+    Same answer as Numerical_RE.search(text[start:end]) using the digit runs from a scan
+    A digit run that sits inside a longer word only counts when the window cuts the word right at the digits
+    Args:
+        numbers: digit runs from TickerMatcher.scan, sorted by position
+        start, end: the window in the text
+    Returns:
+        True if there is a number in the window
+    """
+    for d_start, d_end, open_left, open_right in numbers:
+        if d_start >= end:
+            break
+        if d_end <= start:
+            continue
+        if (open_left or start >= d_start) and (open_right or end <= d_end):
+            return True
+    return False
+
+
+class TickerMatcher:
+    """
+    Built once from the ticker universe and reused for every text
+    ticker_set: anything that supports `in` with uppercase tickers
+    cache: extract_cache.ExtractionCache made for the same universe, scored results are looked up there first
+    classifier: disambiguate.LowercaseClassifier, scores the lowercase candidates instead of the context / number rule
+    """
+
+    def __init__(self, ticker_set, redlist=Redlist, cache=None, classifier=None):
+        self.ticker_set = ticker_set
+        self.redlist = redlist
+        self.cache = cache
+        self.classifier = classifier
+
+    def scan(self, text, allow_lowercase = False):
+        ticker_set = self.ticker_set
+        redlist = self.redlist
+
+        candidates = []
+        lowercase = []
+        numbers = []
+        has_context = False
+        has_number = False
+        symbol_end = 0
+        prev_word, prev_end = None, -1
+
+        for m in Word_RE.finditer(text):
+            w = m.group()
+            start, end = m.span()
+            n = len(w)
+
+            if w.isdecimal():
+                # a whole number, nothing else can match on it
+                numbers.append((start, end, True, True))
+                has_number = True
+                prev_word, prev_end = w, end
+                continue
+
+            ascii_word = w.isascii()
+            alpha = w.isalpha()
+            if not alpha:
+                for d in Digits_RE.finditer(w):
+                    numbers.append((start + d.start(), start + d.end(), d.start() == 0, d.end() == n))
+
+            if not has_context:
+                if ascii_word:
+                    has_context = w.lower() in Context_Set
+                else:
+                    has_context = Context_Word_RE.fullmatch(w) is not None
+                # M&A is the only context word that spans two runs
+                if not has_context and n == 1 and w in "aA" and start >= 2 and text[start - 1] == "&" \
+                        and prev_end == start - 1 and prev_word in ("m", "M"):
+                    has_context = True
+
+            # $TSLA
+            if n <= 5 and alpha and ascii_word and start and text[start - 1] == "$":
+                t = w.upper()
+                if t in ticker_set:
+                    candidates.append((t, "dollar", start - 1, "$" + w))
+
+            # ticker: TSLA, the regex has to start on this run and not inside the previous symbol match
+            if n >= 6 and start >= symbol_end and (w[:6].lower() in Symbol_Keys if ascii_word else Symbol_Key_RE.match(w)):
+                sm = Symbol_RE.match(text, start)
+                if sm:
+                    symbol_end = sm.end()
+                    t = sm.group(1).upper()
+                    if t in ticker_set:
+                        candidates.append((t, "symbol_prefix", start, sm.group(0)))
+
+            # TSLA, the last 2-5 ascii capitals of the run
+            if n >= 2 and "A" <= w[-1] <= "Z" and "A" <= w[-2] <= "Z":
+                k = n - 2
+                limit = max(0, n - 5)
+                while k > limit and "A" <= w[k - 1] <= "Z":
+                    k -= 1
+                t = w[k:]
+                if t in ticker_set and t not in redlist:
+                    candidates.append((t, "allcaps", start + k, t))
+
+            # tsla
+            elif allow_lowercase and 3 <= n <= 5 and ascii_word and alpha and w.islower():
+                t = w.upper()
+                if t in ticker_set:
+                    lowercase.append((t, "lowercase_with_context", start, w))
+
+            prev_word, prev_end = w, end
+
+        return Scan(candidates, lowercase, has_context, has_number, numbers)
+
+    def extract_candidates(self, text, allow_lowercase = False):
+        # lowercase candidates count when the text has context or a number, same as tickers.extract_candidates
+        scan = self.scan(text, allow_lowercase)
+        if scan.lowercase and (scan.has_context or scan.has_number):
+            return scan.candidates + scan.lowercase
+        return scan.candidates
+
+    def scored(self, text, *, allow_lowercase = False, threshold = 0.9, post = False):
+        # (ticker, kind, score, pos) of every candidate over the threshold, in the order they were found
+        if self.cache is None:
+            return self._scored(text, allow_lowercase, threshold, post)
+        key = self.cache.key(f"scored:{allow_lowercase}:{threshold!r}:{post}", text)
+        results = self.cache.get(key)
+        if results is MISSING:
+            results = self._scored(text, allow_lowercase, threshold, post)
+            self.cache.put(key, results)
+        return results
+
+    def _scored(self, text, allow_lowercase, threshold, post):
+        # most comments mention nothing, one C level search rules them out without walking the words
+        if not allow_lowercase and not maybe_ticker(text):
+            return []
+        scan = self.scan(text, allow_lowercase)
+        results = self._score(text, scan, scan.candidates, threshold, post)
+        if not scan.lowercase:
+            return results
+        if self.classifier is not None:
+            rows = [self.classifier.features(text, candidate, scan) for candidate in scan.lowercase]
+            results.extend(_resolved(scan.lowercase, self.classifier.predict(rows), threshold))
+        elif scan.has_context or scan.has_number:
+            results.extend(self._score(text, scan, scan.lowercase, threshold, post))
+        return results
+
+    def _score(self, text, scan, candidates, threshold, post):
+        has_context, numbers = scan.has_context, scan.numbers
+        results = []
+        length = len(text)
+        for ticker, kind, pos, raw in candidates:
+            # same arithmetic as tickers.score_potential so the floats come out identical
+            score = 0.0
+            if kind == "dollar" or kind == "symbol_prefix":
+                score += 0.91
+            elif kind == "allcaps":
+                score += 0.7
+                if post:
+                    score = 0.91
+            elif kind == "lowercase_with_context":
+                score = 0
+
+            if has_context:
+                score += 0.4
+            if numbers and window_has_number(numbers, max(0, pos - 50), min(length, pos + 50)):
+                score += 0.5
+
+            if score > threshold:
+                results.append((ticker, kind, score, pos))
+        return results
+
+    def process_text(self, text, *, allow_lowercase = False, threshold = 0.9, post = False):
+        return [{"ticker": ticker, "kind": kind, "score": score, "snippet": text[:200], "inferred_from": None}
+                for ticker, kind, score, _ in self.scored(text, allow_lowercase=allow_lowercase, threshold=threshold, post=post)]
+
+    def mentions(self, text, *, allow_lowercase = False, threshold = 0.9, post = False):
+        """
+        Every ticker of the text once, with its best scoring candidate (the first one found on a tie)
+        Returns:
+            [(ticker, kind code from mentions.Kinds, score, pos)], small tuples so they are cheap to send back from a worker
+        """
+        return _best(self.scored(text, allow_lowercase=allow_lowercase, threshold=threshold, post=post))
+
+    def mentions_many(self, texts, *, allow_lowercase = False, threshold = 0.9, post = False):
+        """
+        mentions for every text of a list, eg: one worker task
+        With a classifier the lowercase candidates of all the texts are scored together in one predict call
+        Returns:
+            [mentions of texts[i]]
+        """
+        if self.classifier is None or not allow_lowercase:
+            return [self.mentions(text or "", allow_lowercase=allow_lowercase, threshold=threshold, post=post)
+                    for text in texts]
+        results = []
+        rows = []
+        owners = []
+        for i, text in enumerate(texts):
+            text = text or ""
+            scan = self.scan(text, True)
+            results.append(self._score(text, scan, scan.candidates, threshold, post))
+            for candidate in scan.lowercase:
+                rows.append(self.classifier.features(text, candidate, scan))
+                owners.append((i, candidate))
+        if rows:
+            probabilities = self.classifier.predict(rows)
+            for (i, candidate), p in zip(owners, probabilities):
+                if p > threshold:
+                    results[i].append((candidate[0], candidate[1], float(p), candidate[2]))
+        return [_best(scored) for scored in results]
+
+
+def _resolved(candidates, probabilities, threshold):
+    # (ticker, kind, score, pos) of the lowercase candidates the model is sure enough of
+    return [(ticker, kind, float(p), pos) for (ticker, kind, pos, raw), p in zip(candidates, probabilities) if p > threshold]
+
+
+def _best(scored):
+    # every ticker once, with its best scoring candidate (the first one found on a tie)
+    best = {}
+    for ticker, kind, score, pos in scored:
+        if ticker not in best or score > best[ticker][2]:
+            best[ticker] = (ticker, Kind_Codes[kind], score, pos)
+    return list(best.values())
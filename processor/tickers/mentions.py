@@ -0,0 +1,145 @@
+import math
+from array import array
+from sys import intern
+
+"""Compact mention records
+Every ticker a document qualifies for is kept, not just the best one. The mentions of a batch of documents are held
+as parallel arrays (one slot per document and ticker) instead of a dict per match:
+    docs / texts   one entry per document with a mention, its key and its text (not copied, trim cuts long ones down)
+    doc            index into docs for each mention
+    ticker         interned ticker
+    kind           code into Kinds
+    score          float32 confidence
+    snippet        the snippet is text[:snippet], kept as a length instead of a copied string
+    inferred_from  comment or post id a propagated mention came from, None for a direct one
+    hops           ancestor depth of a comment propagation, 0 for a direct mention and -1 for a post propagation
+    sentiment      float32 VADER compound per document, NaN until the batch is scored
+Document keys end with (author, created_utc), comments use tickers.comment_key and posts (post_id, author, created_utc).
+Iterating a batch gives Mention views for code that wants one record at a time.
+"""
+
+Kinds = ("dollar", "symbol_prefix", "allcaps", "lowercase_with_context", "propagated_comment", "propagated_post")
+Kind_Codes = {kind: code for code, kind in enumerate(Kinds)}
+DOLLAR, SYMBOL_PREFIX, ALLCAPS, LOWERCASE, PROPAGATED_COMMENT, PROPAGATED_POST = range(len(Kinds))
+
+# same lengths as the snippets the dict matches used to copy
+SNIPPET = 200
+PROPAGATED_SNIPPET = 300
+
+POST_HOPS = -1
+
+
+class Mention:
+    # one mention of a MentionBatch
+    __slots__ = ("key", "ticker", "kind", "score", "snippet", "inferred_from", "hops", "sentiment")
+
+    def __init__(self, key, ticker, kind, score, snippet, inferred_from, hops, sentiment):
+        self.key = key
+        self.ticker = ticker
+        self.kind = kind
+        self.score = score
+        self.snippet = snippet
+        self.inferred_from = inferred_from
+        self.hops = hops
+        self.sentiment = sentiment
+
+    @property
+    def kind_name(self):
+        return Kinds[self.kind]
+
+    def __repr__(self):
+        return f"Mention({self.key[0]!r}, {self.ticker!r}, {self.kind_name}, {self.score:.3f})"
+
+
+class MentionBatch:
+    """
+    The mentions of one batch of documents, see the module docstring for the columns
+    """
+
+    __slots__ = ("docs", "texts", "sentiment", "doc", "ticker", "kind", "score", "snippet", "inferred_from", "hops")
+
+    def __init__(self):
+        self.docs = []
+        self.texts = []
+        self.sentiment = array("f")
+        self.doc = array("I")
+        self.ticker = []
+        self.kind = array("B")
+        self.score = array("f")
+        self.snippet = array("H")
+        self.inferred_from = []
+        self.hops = array("b")
+
+    def add_doc(self, key, text):
+        self.docs.append(key)
+        self.texts.append(text)
+        self.sentiment.append(math.nan)
+        return len(self.docs) - 1
+
+    def add(self, doc, ticker, kind, score, snippet, inferred_from = None, hops = 0):
+        self.doc.append(doc)
+        self.ticker.append(intern(ticker))
+        self.kind.append(kind)
+        self.score.append(score)
+        self.snippet.append(snippet)
+        self.inferred_from.append(inferred_from)
+        self.hops.append(hops)
+
+    def __len__(self):
+        return len(self.doc)
+
+    def snippet_text(self, i):
+        return (self.texts[self.doc[i]] or "")[:self.snippet[i]]
+
+    def doc_sentiment(self, doc):
+        compound = self.sentiment[doc]
+        return None if math.isnan(compound) else compound
+
+    def set_sentiment(self, scores):
+        # one score per document, in the order of docs
+        self.sentiment = array("f", (math.nan if s is None else s for s in scores))
+
+    def trim(self):
+        # once the texts are scored only the snippets are read, a long text is cut down so a kept batch never holds a
+        # whole essay for a 300 character snippet
+        longest = {}
+        for doc, length in zip(self.doc, self.snippet):
+            longest[doc] = max(longest.get(doc, 0), length)
+        for doc, length in longest.items():
+            text = self.texts[doc]
+            if text and len(text) > length:
+                self.texts[doc] = text[:length]
+        return self
+
+    def __getitem__(self, i):
+        doc = self.doc[i]
+        return Mention(self.docs[doc], self.ticker[i], self.kind[i], self.score[i], self.snippet_text(i),
+                       self.inferred_from[i], self.hops[i], self.doc_sentiment(doc))
+
+    def __iter__(self):
+        for i in range(len(self.doc)):
+            yield self[i]
+
+
+def frame(batches):
+    """
+    The mentions of several batches as the DataFrame rollup.daily_rollup reads
+    Returns:
+        DataFrame with ticker, created_utc, author and sentiment_real, one row per mention
+    """
+    import numpy as np
+    import pandas as pd
+
+    tickers, authors, created, sentiment = [], [], [], []
+    for batch in batches:
+        tickers.extend(batch.ticker)
+        docs = batch.docs
+        authors.extend(docs[d][-2] for d in batch.doc)
+        created.extend(docs[d][-1] for d in batch.doc)
+        sentiment.append(np.frombuffer(batch.sentiment, dtype=np.float32)[np.frombuffer(batch.doc, dtype=np.uint32)])
+    return pd.DataFrame({
+        "ticker": tickers,
+        "created_utc": created,
+        "author": authors,
+        "sentiment_real": np.concatenate(sentiment) if sentiment else np.empty(0, dtype=np.float32),
+    })
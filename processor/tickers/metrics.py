@@ -0,0 +1,344 @@
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mentions import Kinds
+
+"""Run metrics and an opt in sampling profiler
+The stages report into workers.StageStats as before, when a run has a Metrics attached every StageStats.add also lands
+here and the run gets:
+    processor_stage_seconds          histogram per stage (fetch, cache, match, propagate, sentiment, write, ...), one
+                                     observation per batch
+    processor_stage_rows_total       rows through each stage
+    processor_mentions_total         mentions by source (comment / post) and kind
+    processor_pool_pending_rows      rows sent to the pool and not yet collected (the queue depth of the imap pipeline),
+                                     and its high-water mark in processor_pool_pending_rows_max
+    processor_pool_busy_seconds_total, processor_pool_utilization   time the workers spent matching, and that over
+                                     workers x run time
+    processor_errors_total           errors by stage and exception type
+    processor_cache_total            extraction and sentiment cache hits and misses
+    processor_shards_total           shards done, lost to another worker or failed (shards.py)
+    processor_run_seconds, processor_last_run_timestamp_seconds
+Everything is exported once when the run finishes, the cron jobs are too short lived to be scraped.
+Settings (environment), instrumentation is off unless one of them is set:
+    PROCESSOR_METRICS          file to write, a .jsonl file gets one JSON line per series appended every run, anything
+                               else gets the Prometheus text format (written whole, for the node_exporter textfile
+                               collector)
+    PROCESSOR_METRICS_PORT     serves the Prometheus text on :port/metrics while the run lasts
+    PROCESSOR_PROFILE          file for the profiler's hot spots, PROCESSOR_PROFILE_INTERVAL ms between samples (5)
+With none of them set StageStats.metrics is None and a stage costs the two dict updates it always did.
+"""
+
+# seconds, a stage takes a few ms to a few seconds per batch
+Buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Help = {
+    "processor_stage_seconds": ("histogram", "Seconds per batch spent in each stage"),
+    "processor_stage_rows_total": ("counter", "Rows through each stage"),
+    "processor_mentions_total": ("counter", "Mentions found by source and kind"),
+    "processor_pool_pending_rows": ("gauge", "Rows sent to the pool and not yet collected"),
+    "processor_pool_pending_rows_max": ("gauge", "Most rows sent to the pool and not yet collected at once"),
+    "processor_pool_busy_seconds_total": ("counter", "Seconds the pool workers spent matching"),
+    "processor_pool_workers": ("gauge", "Processes in the pool"),
+    "processor_pool_utilization": ("gauge", "Busy seconds over workers times run seconds"),
+    "processor_errors_total": ("counter", "Errors by stage and exception type"),
+    "processor_cache_total": ("counter", "Cache lookups by cache and result"),
+    "processor_shards_total": ("counter", "Shards by outcome (done, lost, failed)"),
+    "processor_run_seconds": ("gauge", "Wall clock seconds of the last run"),
+    "processor_last_run_timestamp_seconds": ("gauge", "Unix time the last run finished"),
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(Buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(Buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for le, count in zip(Buckets + (float("inf"),), self.counts):
+            total += count
+            yield le, total
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of one run, keyed by name and labels
+    job: added as a label to every series, eg: process_db, incremental, shard_work
+    path / port / profile: see the module docstring, open_metrics fills them in from the environment
+    """
+
+    def __init__(self, job, path = None, port = None, profile = None, profile_interval = 0.005):
+        self.job = job
+        self.path = path
+        self.port = port
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # the http thread reads while the run writes
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.server = None
+        self.profiler = SamplingProfiler(profile, profile_interval) if profile else None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def adjust(self, name, delta, **labels):
+        # moves a gauge up or down and keeps its high-water mark in name_max
+        key = self._key(name, labels)
+        peak = self._key(name + "_max", labels)
+        with self.lock:
+            value = self.gauges[key] = self.gauges.get(key, 0) + delta
+            if value > self.gauges.get(peak, 0):
+                self.gauges[peak] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def stage(self, stage, rows, seconds):
+        self.observe("processor_stage_seconds", seconds, stage=stage)
+        self.inc("processor_stage_rows_total", rows, stage=stage)
+
+    def mentions(self, source, batch):
+        # one pass over the kind codes of the batch per kind, the codes are a byte array
+        kinds = bytes(batch.kind)
+        for code, kind in enumerate(Kinds):
+            count = kinds.count(code)
+            if count:
+                self.inc("processor_mentions_total", count, source=source, kind=kind)
+
+    def error(self, stage, exc):
+        self.inc("processor_errors_total", stage=stage, type=type(exc).__name__)
+
+    def caches(self, scorer = None, cache = None):
+        if cache is not None:
+            self.inc("processor_cache_total", cache.memory_hits, cache="extraction", result="memory_hit")
+            self.inc("processor_cache_total", cache.disk_hits, cache="extraction", result="disk_hit")
+            self.inc("processor_cache_total", cache.misses, cache="extraction", result="miss")
+        if scorer is not None:
+            self.inc("processor_cache_total", scorer.hits, cache="sentiment", result="hit")
+            self.inc("processor_cache_total", scorer.misses, cache="sentiment", result="miss")
+
+    # ---------- export ----------
+
+    def _labels(self, labels, extra = ()):
+        pairs = (("job", self.job),) + labels + extra
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+    def prometheus(self):
+        """
+        Returns:
+            every series in the Prometheus text exposition format
+        """
+        with self.lock:
+            series = {}
+            for (name, labels), value in self.counters.items():
+                series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), value in self.gauges.items():
+                series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), histogram in self.histograms.items():
+                lines = series.setdefault(name, [])
+                for le, count in histogram.cumulative():
+                    lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf' if le == float('inf') else le),))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        out = []
+        for name, lines in series.items():
+            kind, text = Help.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+    def json_lines(self):
+        """
+        Returns:
+            one JSON object per series, each with the time, job, name, labels and value (histograms: count, sum, buckets)
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        lines = []
+        with self.lock:
+            for kind, items in (("counter", self.counters), ("gauge", self.gauges)):
+                for (name, labels), value in items.items():
+                    lines.append({"time": now, "job": self.job, "name": name, "type": kind, "labels": dict(labels), "value": value})
+            for (name, labels), histogram in self.histograms.items():
+                lines.append({"time": now, "job": self.job, "name": name, "type": "histogram", "labels": dict(labels),
+                              "count": histogram.count, "sum": histogram.sum,
+                              "buckets": {("+Inf" if le == float("inf") else str(le)): n for le, n in histogram.cumulative()}})
+        return "\n".join(json.dumps(line) for line in lines) + "\n"
+
+    def export(self):
+        if not self.path:
+            return
+        if self.path.endswith(".jsonl"):
+            with open(self.path, "a") as f:
+                f.write(self.json_lines())
+        else:
+            # written next to the target and moved over it, the collector never reads half a file
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(self.prometheus())
+            os.replace(tmp, self.path)
+
+    # ---------- run ----------
+
+    def start(self):
+        if self.port:
+            metrics = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.rstrip("/") != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = metrics.prometheus().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer(("", int(self.port)), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if self.profiler:
+            self.profiler.start()
+        return self
+
+    def finish(self, scorer = None, cache = None, export = True):
+        """
+        Records the cache counters, and unless export is False the run time, then exports and stops the server and the
+        profiler
+        export: False when the run is part of a bigger one that finishes the metrics itself
+        """
+        self.caches(scorer, cache)
+        if not export:
+            return
+        elapsed = time.perf_counter() - self.started
+        self.set("processor_run_seconds", elapsed)
+        self.set("processor_last_run_timestamp_seconds", time.time())
+        workers = self.gauges.get(("processor_pool_workers", ()))
+        busy = self.counters.get(("processor_pool_busy_seconds_total", ()))
+        if workers and busy is not None and elapsed:
+            self.set("processor_pool_utilization", busy / (workers * elapsed))
+        if self.profiler:
+            self.profiler.stop()
+            self.profiler.dump()
+        self.export()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the thread that started it every interval seconds and counts where it is
+    Only that thread is sampled: the matching happens in the pool workers, in the run's own thread it shows up as
+    time waiting in workers._collect.
+    path: file the hot spots are written to by dump
+    """
+
+    def __init__(self, path, interval = 0.005, top = 30):
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.target = None
+        self.samples = 0
+        self.own = {}
+        self.total = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.target = threading.get_ident()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            self.samples += 1
+            leaf = True
+            seen = set()
+            while frame is not None:
+                code = frame.f_code
+                where = (code.co_filename, code.co_firstlineno, code.co_name)
+                if leaf:
+                    self.own[where] = self.own.get(where, 0) + 1
+                    leaf = False
+                # a recursive function is counted once per sample
+                if where not in seen:
+                    seen.add(where)
+                    self.total[where] = self.total.get(where, 0) + 1
+                frame = frame.f_back
+
+    def report(self):
+        if not self.samples:
+            return "profile: no samples"
+        lines = [f"profile: {self.samples} samples every {self.interval * 1000:.0f}ms",
+                 f"{'own':>7} {'total':>7}  function"]
+        # by total first, the run's own thread spends most samples in a wait, what matters is which stage it waits in
+        ranked = sorted(self.total, key=lambda w: (self.total[w], self.own.get(w, 0)), reverse=True)[:self.top]
+        for where in ranked:
+            filename, line, name = where
+            lines.append(f"{self.own.get(where, 0) / self.samples:>7.1%} {self.total[where] / self.samples:>7.1%}  "
+                         f"{name} ({os.path.basename(filename)}:{line})")
+        return "\n".join(lines)
+
+    def dump(self):
+        with open(self.path, "w") as f:
+            f.write(self.report() + "\n")
+
+
+def open_metrics(job):
+    """
+    The run's metrics from the PROCESSOR_METRICS settings, started
+    Args:
+        job: name of the run, a label on every series
+    Returns:
+        Metrics, None when instrumentation is off
+    """
+    path = os.getenv("PROCESSOR_METRICS") or None
+    port = os.getenv("PROCESSOR_METRICS_PORT") or None
+    profile = os.getenv("PROCESSOR_PROFILE") or None
+    if not (path or port or profile):
+        return None
+    interval = float(os.getenv("PROCESSOR_PROFILE_INTERVAL", 5)) / 1000
+    return Metrics(job, path, port, profile, interval).start()
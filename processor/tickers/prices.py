@@ -0,0 +1,290 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+"""Local columnar price store
+Daily OHLCV from local CSV files, kept as one .npy matrix per column (open, high, low, close, adj_close, volume) of
+shape (tickers, trading days) that is opened with mmap, so a process only pages in the rows it reads and a whole
+universe scan is a handful of vectorized passes over contiguous memory. A row is one ticker's history in date order,
+a missing day is NaN.
+    meta.json        tickers (sorted, the row order), columns and dtypes, ingest stats
+    dates.npy        datetime64[D] trading days, the column order
+    <column>.npy     float32 prices, float64 volume
+CSV files are either one ticker per file (Date, Open, High, Low, Close, Adj Close, Volume like a Yahoo or Stooq export,
+the ticker is the file name) or long files with a ticker / symbol column. Column names are matched case insensitively.
+An ingest merges into what the store already holds (the new rows win), writes the new store next to the old one and
+swaps it in, readers that already have the old files open keep reading them.
+Run from processor/tickers:
+    python prices.py ingest ~/prices/*.csv       # or a directory of csv files
+    python prices.py fill                        # price columns of processed_data from the store
+The store is PRICE_STORE (./price_store) unless --store is given.
+"""
+
+Columns = {"open": np.float32, "high": np.float32, "low": np.float32, "close": np.float32, "adj_close": np.float32,
+           "volume": np.float64}
+
+# csv header (lowercased, spaces and dashes to _) -> store column
+Aliases = {"date": "date", "timestamp": "date", "ticker": "ticker", "symbol": "ticker", "open": "open", "high": "high",
+           "low": "low", "close": "close", "adj_close": "adj_close", "adjclose": "adj_close", "adjusted_close": "adj_close",
+           "volume": "volume", "vol": "volume"}
+
+
+def store_path(path = None):
+    return Path(path or os.getenv("PRICE_STORE", "./price_store"))
+
+
+def read_csv(path):
+    """
+    Args:
+        path: one csv file
+    Returns:
+        DataFrame with ticker, date (datetime64[D]) and whichever of the store columns the file has
+    """
+    frame = pd.read_csv(path)
+    frame.columns = [Aliases.get(c.strip().lower().replace(" ", "_").replace("-", "_"), c) for c in frame.columns]
+    if "date" not in frame:
+        raise ValueError(f"{path}: no date column")
+    if "ticker" in frame:
+        # cleaned once per distinct ticker, not once per row
+        codes, names = pd.factorize(frame["ticker"].astype(str))
+        frame["ticker"] = np.array([n.strip().upper() for n in names], dtype=object)[codes]
+    else:
+        frame["ticker"] = Path(path).stem.strip().upper()
+    try:
+        dates = pd.to_datetime(frame["date"], utc=True, format="ISO8601")
+    except ValueError:
+        dates = pd.to_datetime(frame["date"], utc=True)
+    frame["date"] = dates.dt.tz_localize(None).to_numpy().astype("datetime64[D]")
+    return frame[["ticker", "date"] + [c for c in Columns if c in frame]]
+
+
+def csv_files(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.iterdir() if p.suffix.lower() == ".csv")
+        else:
+            yield path
+
+
+class PriceStore:
+    """
+    A store written by ingest, the columns are memory mapped read only
+    path: the store directory
+    """
+
+    def __init__(self, path = None):
+        self.path = store_path(path)
+        self.meta = json.loads((self.path / "meta.json").read_text())
+        self.tickers = np.array(self.meta["tickers"])
+        self.index = {ticker: i for i, ticker in enumerate(self.meta["tickers"])}
+        self.dates = np.load(self.path / "dates.npy")
+        self._columns = {}
+
+    def column(self, name):
+        """
+        Returns:
+            (tickers, dates) memmap of the column
+        """
+        if name not in self._columns:
+            self._columns[name] = np.load(self.path / f"{name}.npy", mmap_mode="r")
+        return self._columns[name]
+
+    def rows(self, tickers):
+        """
+        Returns:
+            row of each ticker, -1 for tickers not in the store
+        """
+        codes, names = pd.factorize(np.asarray(tickers, dtype=object))
+        return np.array([self.index.get(t, -1) for t in names], dtype=np.int64)[codes]
+
+    def days(self, dates, after = False):
+        """
+        Args:
+            dates: dates to look up
+            after: map a day that is not a trading day to the next trading day instead of -1, eg: weekend posts go
+                to Monday
+        Returns:
+            column of each date, -1 when there is none
+        """
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        found = np.searchsorted(self.dates, dates)
+        inside = found < len(self.dates)
+        if after:
+            return np.where(inside, found, -1)
+        exact = inside & (self.dates[np.minimum(found, len(self.dates) - 1)] == dates)
+        return np.where(exact, found, -1)
+
+    def history(self, ticker):
+        """
+        Returns:
+            DataFrame of one ticker indexed by date, the days it traded
+        """
+        row = self.index[ticker]
+        frame = pd.DataFrame({name: self.column(name)[row] for name in Columns}, index=pd.Index(self.dates, name="date"))
+        return frame.dropna(how="all")
+
+    def __len__(self):
+        return len(self.tickers)
+
+
+def _existing(path):
+    # the rows already in the store as a long frame, so an ingest can merge into them
+    if not (path / "meta.json").exists():
+        return None
+    store = PriceStore(path)
+    data = {name: store.column(name) for name in Columns}
+    held = np.zeros(data["close"].shape, dtype=bool)
+    for values in data.values():
+        held |= ~np.isnan(values)
+    rows, days = np.nonzero(held)
+    frame = pd.DataFrame({"ticker": store.tickers[rows], "date": store.dates[days]})
+    for name, values in data.items():
+        frame[name] = values[rows, days]
+    return frame
+
+
+def ingest(paths, store = None, replace = False):
+    """
+    Reads the csv files and writes them into the store
+    Args:
+        paths: csv files or directories of them
+        store: store directory, defaults to PRICE_STORE
+        replace: drop what the store held instead of merging into it
+    Returns:
+        PriceStore of the new store
+    """
+    path = store_path(store)
+    start = time.perf_counter()
+    files = list(csv_files(paths))
+    frames = [read_csv(f) for f in files]
+    if not replace:
+        frames.insert(0, _existing(path))
+    frames = [f for f in frames if f is not None and not f.empty]
+    if not frames:
+        raise ValueError("no price rows to ingest")
+    prices = pd.concat(frames, ignore_index=True)
+    # a later file (and anything newer than the store) wins for the same ticker and day, column by column, so a file
+    # without an adjusted close does not blank the one the store has
+    if prices.duplicated(["ticker", "date"]).any():
+        prices = prices.groupby(["ticker", "date"], sort=False, as_index=False).last()
+
+    tickers = np.unique(prices["ticker"].to_numpy().astype(str))
+    dates = np.unique(prices["date"].to_numpy().astype("datetime64[D]"))
+    rows = np.searchsorted(tickers, prices["ticker"].to_numpy().astype(str))
+    days = np.searchsorted(dates, prices["date"].to_numpy().astype("datetime64[D]"))
+
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    np.save(tmp / "dates.npy", dates)
+    for name, dtype in Columns.items():
+        out = np.lib.format.open_memmap(tmp / f"{name}.npy", mode="w+", dtype=dtype, shape=(len(tickers), len(dates)))
+        out[:] = np.nan
+        if name in prices:
+            out[rows, days] = prices[name].to_numpy(dtype=np.float64)
+        out.flush()
+        del out
+    (tmp / "meta.json").write_text(json.dumps({
+        "tickers": tickers.tolist(),
+        "columns": {name: np.dtype(dtype).name for name, dtype in Columns.items()},
+        "first": str(dates[0]), "last": str(dates[-1]),
+        "rows": int(len(prices)), "files": len(files),
+        "ingested_at": datetime.now(timezone.utc).isoformat(),
+    }))
+
+    # swap the new store in, the old files stay readable for whoever has them mapped
+    old = path.with_name(path.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if path.exists():
+        path.rename(old)
+    tmp.rename(path)
+    shutil.rmtree(old, ignore_errors=True)
+
+    print(f"ingested {len(files)} files: {len(prices):,} rows, {len(tickers):,} tickers x {len(dates):,} days "
+          f"({dates[0]} to {dates[-1]}) in {time.perf_counter() - start:.2f}s")
+    return PriceStore(path)
+
+
+def fill_processed_data(conn, store, every = False):
+    """
+    Sets price_open, price_close, price_change_pct and volume_traded of processed_data from the store, for the rows
+    whose mention_date is a trading day of the ticker. Nothing is committed here.
+    Args:
+        conn: psycopg2 connection
+        store: PriceStore
+        every: refill rows that already have a price, eg: after a re-ingest
+    Returns:
+        number of rows updated
+    """
+    where = "" if every else "WHERE price_close IS NULL"
+    with conn.cursor() as curr:
+        curr.execute(f"SELECT ticker, mention_date FROM processed_data {where}")
+        keys = curr.fetchall()
+    if not keys:
+        return 0
+
+    rows = store.rows([k[0] for k in keys])
+    days = store.days([k[1] for k in keys])
+    found = (rows >= 0) & (days >= 0)
+    rows, days = rows[found], days[found]
+    open_ = store.column("open")[rows, days].astype(np.float64)
+    close = store.column("close")[rows, days].astype(np.float64)
+    volume = store.column("volume")[rows, days]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = (close - open_) / open_ * 100
+    frame = pd.DataFrame({
+        "ticker": [k[0] for k, f in zip(keys, found) if f],
+        "mention_date": [k[1] for k, f in zip(keys, found) if f],
+        "price_open": open_, "price_close": close,
+        "price_change_pct": np.where(np.isfinite(change), change, np.nan),
+        "volume_traded": pd.array(np.where(np.isnan(volume), np.nan, np.round(volume)), dtype="Int64"),
+    })
+    frame = frame[frame["price_close"].notna()]
+    if frame.empty:
+        return 0
+
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    with conn.cursor() as curr:
+        curr.execute("""CREATE TEMP TABLE IF NOT EXISTS price_stage (
+            ticker TEXT, mention_date DATE, price_open NUMERIC, price_close NUMERIC, price_change_pct NUMERIC,
+            volume_traded BIGINT) ON COMMIT DELETE ROWS""")
+        curr.execute("TRUNCATE price_stage")
+        curr.copy_expert("COPY price_stage FROM STDIN WITH (FORMAT csv)", buffer)
+        curr.execute("""
+            UPDATE processed_data p
+            SET price_open = s.price_open, price_close = s.price_close,
+                price_change_pct = s.price_change_pct, volume_traded = s.volume_traded
+            FROM price_stage s
+            WHERE p.ticker = s.ticker AND p.mention_date = s.mention_date
+        """)
+        return curr.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local columnar price store")
+    parser.add_argument("--store", help="store directory, defaults to PRICE_STORE or ./price_store")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = commands.add_parser("ingest", help="bulk load daily OHLCV csv files")
+    ingest_parser.add_argument("paths", nargs="+", help="csv files or directories of them")
+    ingest_parser.add_argument("--replace", action="store_true", help="drop what the store held")
+    fill_parser = commands.add_parser("fill", help="fill the price columns of processed_data")
+    fill_parser.add_argument("--all", action="store_true", help="refill rows that already have a price")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        ingest(args.paths, args.store, args.replace)
+    else:
+        from db import connection
+        with connection("write") as conn:
+            updated = fill_processed_data(conn, PriceStore(args.store), args.all)
+            conn.commit()
+        print(f"filled prices for {updated} processed_data rows")
@@ -1,58 +1,74 @@
 import tickers
 from db import connection
-from pathlib import Path
+from universe import load_universe
+from writer import TickerWriter, comment_rows, post_rows
+from workers import StageStats
+from metrics import open_metrics
+from shards import ensure_leases
 
+# one statement per match, kept for comparison against the COPY writer (see bench_writer.py)
 insert_comment = """
 INSERT INTO comment_tickers(
     comment_id, parent_id, post_id, ticker, detected_by, confidence, context_snippet,
-     inferred_from, author, created_utc
+     inferred_from_id, author, created_utc, sentiment_real, universe_version
     )
-VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT(comment_id) DO NOTHING;
+VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT(comment_id, ticker) DO NOTHING;
 """
 
 insert_post = """
 INSERT INTO post_tickers(
-    post_id, ticker, detected_by, confidence, body,  author, created_utc
+    post_id, ticker, detected_by, confidence, body,  author, created_utc, sentiment_real, universe_version
 )
-VALUES(%s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT(post_id) DO NOTHING;
+VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT(post_id, ticker) DO NOTHING;
 """
 
 def gettickers():
     comments, posts = tickers.process_db()
     return (comments, posts)
 
-def querys():
+def insert_rows(conn, comments, posts, universe = None):
+    """
+    The per row path, one execute per match and one commit at the end
+    Args:
+        conn: psycopg2 connection
+        comments, posts: from tickers.process_db, a list of comment MentionBatches and the post MentionBatch
+        universe: version of the ticker universe the matches came from
+    Returns:
+        None
+    """
+    curr = conn.cursor()
+    for batch in comments:
+        for row in comment_rows(batch, universe):
+            curr.execute(insert_comment, row)
+    for row in post_rows(posts, universe):
+        curr.execute(insert_post, row)
+    conn.commit()
+    curr.close()
+
+def querys(page_size = 5000):
     """
     Gets all the matches from the data base
     Creates new tables (post_tickers and comment_tickers) if they do not exists yet
     populates both tables with the matches data
+    The comment matches go straight from the processing stream into the writer a page at a time
     Args:
-        None
+        page_size: rows per COPY and per transaction
     Returns:
         None
     """
-    comments, posts = tickers.process_db()
-    sql_comments = Path("queries/comment_tickers.sql").read_text()
-    sql_posts = Path("queries/post_ticker.sql").read_text()
-    conn = connection()
-    curr = conn.cursor()
-    curr.execute(sql_posts)
-    curr.execute(sql_comments)
-    for comment in comments:
-        id, parent_id, post_id, body, author, created_utc = comment["comment"]
-        ticker = comment["match_details"]["ticker"]
-        mention_kind = comment["match_details"]["kind"]
-        confidence = comment["match_details"]["score"]
-        inferred_from = comment["match_details"]["inferred_from"]
-        curr.execute(sql_comments,(
-            id, parent_id, post_id, ticker, mention_kind, confidence, body[:300], inferred_from, author, created_utc
-        ))
-    for post in posts:
-        ...
-# INSERT INTO comment_tickers(
-#     comment_id, parent_id, post_id, ticker, detected_by, confidence, context_snippet,
-#      inferred_from, author, created_utc
-#     )
+    universe = load_universe(tickers.path)
+    # the processing and the writes report into the same run metrics
+    stats = StageStats(open_metrics("process_db"))
+    with connection("write") as conn:
+        # the indexes the comment scan reads in order are with the shards' ones
+        ensure_leases(conn)
+        with TickerWriter(conn, page_size, universe=universe.version, stats=stats) as writer:
+            comments, posts = tickers.process_db(sink=writer.add_comments, universe=universe, stats=stats)
+            writer.add_posts(posts)
+        print(writer.report())
+    stats.finish()
 
+if __name__ == "__main__":
+    querys()
@@ -0,0 +1,231 @@
+import argparse
+import io
+import time
+import numpy as np
+import pandas as pd
+from db import connection
+from incremental import ensure_checkpoints, load_checkpoint, save_checkpoint
+from mentions import frame as mention_frame
+from writer import Queries
+
+"""Daily rollup of the ticker mentions into processed_data
+The metrics are pandas group-bys over (ticker, mention_date) for the mentions in comment_tickers and post_tickers.
+An update only recomputes the (ticker, date) partitions that got new mentions since the last rollup, plus the two
+days after each one because their 3 day moving average includes it. Only the mentions those partitions need (two days
+either side) are read back. The price columns of processed_data are left alone.
+New mentions are found by the transaction that inserted them (the xact column), not by id: ids are handed out at
+insert time and a shard or a batch holds its transaction open, so a smaller id can still commit after a larger one has
+been rolled up. The watermark is the oldest transaction still running when the last rollup read the tables
+(pg_snapshot_xmin of the same snapshot), every row that rollup could not see has an xact at or above it. Rows of
+transactions that were already done but newer than the oldest running one are read again, recomputing a partition
+twice gives the same row.
+Run from processor/tickers:
+    python rollup.py          # new mentions only
+    python rollup.py --full   # every partition
+"""
+
+# VADER's usual cut offs for a positive / negative text
+BULL = 0.05
+BEAR = -0.05
+WINDOW_DAYS = 3
+
+Metric_Columns = ["mention_volume", "unique_posters", "avg_sentiment", "sum_sentiment", "sentiment_stddev",
+                  "sentiment_skew", "moving_avg_sentiment", "bull_ratio", "bear_ratio"]
+
+Mention_Date = "((to_timestamp(created_utc) AT TIME ZONE 'UTC')::date)"
+
+# the watermark is the transaction horizon of the last rollup, kept in processor_checkpoints
+Checkpoints = {"comment_tickers": "rollup:comment_tickers:xact", "post_tickers": "rollup:post_tickers:xact"}
+# the id watermarks from before the xact column, rows written before it have no xact
+Id_Checkpoints = {"comment_tickers": "rollup:comment_tickers", "post_tickers": "rollup:post_tickers"}
+
+# the new partitions and the horizon come from one statement so they see the same snapshot
+Touched = """
+WITH horizon AS (SELECT pg_snapshot_xmin(pg_current_snapshot())::text AS xact),
+new AS (
+    SELECT DISTINCT ticker, {date} AS mention_date FROM {table}
+    WHERE xact >= %(since)s::xid8 {before_xact}
+)
+SELECT horizon.xact, new.ticker, new.mention_date FROM horizon LEFT JOIN new ON true
+"""
+
+Upsert = """
+INSERT INTO processed_data (ticker, mention_date, {columns})
+SELECT ticker, mention_date, {columns} FROM processed_data_stage
+ON CONFLICT (ticker, mention_date) DO UPDATE
+SET {updates};
+"""
+
+
+def daily_rollup(mentions):
+    """
+    Args:
+        mentions: DataFrame with ticker, created_utc, author, sentiment_real, one row per mention, or the
+            MentionBatches of a run (eg: what tickers.process_db returns) to roll up without going through the tables
+    Returns:
+        DataFrame with ticker, mention_date and Metric_Columns, one row per (ticker, date) with mentions
+    """
+    if not isinstance(mentions, pd.DataFrame):
+        mentions = mention_frame(mentions)
+    if mentions.empty:
+        return pd.DataFrame(columns=["ticker", "mention_date"] + Metric_Columns)
+
+    sentiment = mentions["sentiment_real"].astype("float64")
+    scored = sentiment.notna()
+    frame = pd.DataFrame({
+        "ticker": mentions["ticker"].to_numpy(),
+        "mention_date": pd.to_datetime(mentions["created_utc"].to_numpy(), unit="s").normalize(),
+        "author": mentions["author"].to_numpy(),
+        "sentiment": sentiment.to_numpy(),
+        "scored": scored.to_numpy(dtype="float64"),
+        # NaN when there is no score so the means only count scored mentions
+        "bull": np.where(scored, sentiment >= BULL, np.nan),
+        "bear": np.where(scored, sentiment <= BEAR, np.nan),
+    })
+
+    groups = frame.groupby(["ticker", "mention_date"], sort=True)
+    daily = pd.DataFrame({
+        "mention_volume": groups.size(),
+        "unique_posters": groups["author"].nunique(),
+        "avg_sentiment": groups["sentiment"].mean(),
+        "sum_sentiment": groups["sentiment"].sum(min_count=1),
+        "sentiment_stddev": groups["sentiment"].std(),
+        "sentiment_skew": groups["sentiment"].skew(),
+        "scored": groups["scored"].sum(),
+        "bull_ratio": groups["bull"].mean(),
+        "bear_ratio": groups["bear"].mean(),
+    })
+
+    # mention weighted sentiment over the trailing WINDOW_DAYS calendar days of each ticker
+    rolling = (daily[["sum_sentiment", "scored"]].fillna(0.0)
+               .reset_index(level="ticker")
+               .groupby("ticker")[["sum_sentiment", "scored"]]
+               .rolling(f"{WINDOW_DAYS}D").sum())
+    daily["moving_avg_sentiment"] = (rolling["sum_sentiment"] / rolling["scored"].replace(0.0, np.nan)).to_numpy()
+
+    daily = daily.reset_index()
+    daily["mention_date"] = daily["mention_date"].dt.date
+    return daily[["ticker", "mention_date"] + Metric_Columns]
+
+
+def read_mentions(conn, where = "", params = None):
+    # COPY out as csv straight into pandas, much faster than fetching tuples for a full rebuild
+    query = " UNION ALL ".join(
+        f"SELECT ticker, created_utc, author, sentiment_real FROM {table} {where}" for table in Checkpoints
+    )
+    with conn.cursor() as curr:
+        query = curr.mogrify(query, (params or {})).decode()
+        buffer = io.StringIO()
+        curr.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", buffer)
+    buffer.seek(0)
+    return pd.read_csv(buffer, dtype={"ticker": "string", "author": "string"}, keep_default_na=False,
+                       na_values={"sentiment_real": [""], "author": [""]})
+
+
+def ensure_xact(conn):
+    # the writers add the column too, the rollup can run before they do
+    # the DDL locks the tables and would wait behind a shard's open transaction, so only when it is missing
+    with conn.cursor() as curr:
+        curr.execute("SELECT count(*) FROM information_schema.columns WHERE table_name = ANY(%s) AND column_name = 'xact'",
+                     (list(Checkpoints),))
+        if curr.fetchone()[0] < len(Checkpoints):
+            curr.execute((Queries / "post_tickers.sql").read_text())
+            curr.execute((Queries / "comment_tickers.sql").read_text())
+    conn.commit()
+
+
+def touched_partitions(conn):
+    """
+    Returns:
+        (set of (ticker, date) with new mentions, {table: transaction horizon to save as the watermark})
+    """
+    touched = set()
+    high = {}
+    with conn.cursor() as curr:
+        for table, name in Checkpoints.items():
+            _, since = load_checkpoint(conn, name)
+            params = {"since": since or "0"}
+            before_xact = ""
+            if not since:
+                # first run since the column was added, the rows without one go by the old id watermark
+                _, last_id = load_checkpoint(conn, Id_Checkpoints[table])
+                params["last_id"] = int(last_id) if last_id else 0
+                before_xact = "OR (xact IS NULL AND id > %(last_id)s)"
+            curr.execute(Touched.format(date=Mention_Date, table=table, before_xact=before_xact), params)
+            rows = curr.fetchall()
+            high[table] = rows[0][0]
+            touched.update((ticker, date) for _, ticker, date in rows if ticker is not None)
+    return touched, high
+
+
+def upsert(conn, daily):
+    if daily.empty:
+        return 0
+    columns = ", ".join(Metric_Columns)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in Metric_Columns)
+    buffer = io.StringIO()
+    daily.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    with conn.cursor() as curr:
+        curr.execute("CREATE TEMP TABLE IF NOT EXISTS processed_data_stage (LIKE processed_data) ON COMMIT DELETE ROWS")
+        curr.execute("TRUNCATE processed_data_stage")
+        curr.copy_expert(f"COPY processed_data_stage (ticker, mention_date, {columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        curr.execute(Upsert.format(columns=columns, updates=updates))
+    return len(daily)
+
+
+def rollup(full = False):
+    """
+    Brings processed_data up to date with the ticker tables
+    Args:
+        full: recompute every (ticker, date) instead of only the ones with new mentions
+    Returns:
+        number of processed_data rows written
+    """
+    with connection("write") as conn:
+        start = time.perf_counter()
+        ensure_checkpoints(conn)
+        ensure_xact(conn)
+        touched, high = touched_partitions(conn)
+
+        if full:
+            daily = daily_rollup(read_mentions(conn))
+        elif touched:
+            # the touched days and the two days after them, read with two days either side for the window
+            shift = pd.Timedelta(days=WINDOW_DAYS - 1)
+            window = pd.DataFrame(sorted(touched), columns=["ticker", "mention_date"])
+            window["mention_date"] = pd.to_datetime(window["mention_date"])
+            ranges = window.groupby("ticker")["mention_date"].agg(["min", "max"])
+            mentions = read_mentions(
+                conn,
+                f"JOIN unnest(%(tickers)s::text[], %(froms)s::date[], %(tos)s::date[]) AS w(t, d_from, d_to) "
+                f"ON ticker = w.t AND {Mention_Date} BETWEEN w.d_from AND w.d_to",
+                {
+                    "tickers": list(ranges.index),
+                    "froms": [d.date() for d in ranges["min"] - shift],
+                    "tos": [d.date() for d in ranges["max"] + shift],
+                },
+            )
+            daily = daily_rollup(mentions)
+            recompute = pd.concat([window.assign(mention_date=window["mention_date"] + pd.Timedelta(days=k))
+                                   for k in range(WINDOW_DAYS)])
+            recompute = set(zip(recompute["ticker"], recompute["mention_date"].dt.date))
+            keep = [key in recompute for key in zip(daily["ticker"], daily["mention_date"])]
+            daily = daily[keep]
+        else:
+            daily = daily_rollup(pd.DataFrame())
+
+        written = upsert(conn, daily)
+        for table, name in Checkpoints.items():
+            save_checkpoint(conn, name, "now", high[table])
+        conn.commit()
+
+    print(f"rollup wrote {written} processed_data rows for {len(touched)} touched partitions in {time.perf_counter() - start:.2f}s")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll the ticker mentions up into processed_data")
+    parser.add_argument("--full", action="store_true", help="recompute every partition")
+    args = parser.parse_args()
+    rollup(args.full)
@@ -0,0 +1,27 @@
+import re
+
+"""The ticker detection rules shared by the regex path in tickers.py and the single pass matcher in matcher.py
+Keep both paths pointing at these so they can never drift apart.
+"""
+
+# We will identify tickers using regular expressions
+Dollar_RE = re.compile(r'\$([A-Za-z]{1,5})\b')
+Upper_RE = re.compile(r'([A-Z]{2,5})\b')
+Symbol_RE = re.compile(r'\b(?:ticker|symbol)[:\s]*([A-Za-z]{1,6})\b', re.I)
+Lower_RE = re.compile(r"\b[a-z]{3,5}\b")
+
+# words around the ticker that build confidence
+Context_Words = (
+    "buy", "sell", "shares", "short", "long", "stock", "IPO", "earnings", "dividend", "split", "bought", "sold",
+    "play", "position", "trading", "trade", "cheap", "M&A", "gain", "moving", "moon", "holding", "squeeze", "hold",
+    "watch", "dip", "volume", "catalyst", "pump", "dump", "bullish", "undervalued", "bearish",
+)
+
+# looks for context around the ticker to build confindence
+context_RE = re.compile(r'\b(' + '|'.join(re.escape(w) for w in Context_Words) + r')\b', re.I)
+
+# blacklisted common financial terms so they do not trigger false positives, plus other terms frequentyly capitalised
+Redlist = {"GUYS", "MOON", "US", "UK", "EBIT", "EBITDA", "UP","CAGR", "FCF", "ROE", "ROI", "ROIC", "EV", "NI", "PEG", "EU", "GPT", "AI", "IT", "LFG", "CEO", "CFO", "NASDAQ", "NYSE", "LSE", "ASX", "TSE","SSE", "SEHK","TSX"}
+
+#checks for a numerical number, optional currency sign, optional decimal points
+Numerical_RE = re.compile(r"\b(?:\$|£)?\d+(?:\.\d+)?\b")
@@ -0,0 +1,115 @@
+import os
+from importlib.metadata import version
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from extract_cache import ExtractionCache, MISSING, cache_path
+
+"""VADER sentiment for the ticker matches
+Runs on each batch after propagation, the compound score of the comment (or post title) is kept per document in the
+MentionBatch and written to sentiment_real next to each of its mentions.
+Texts repeat a lot (copypasta, bot replies, the same comment upserted again every collection cycle) so scores are
+cached by a hash of the text and only texts that are not in the cache are sent to the workers, each one once.
+The cache is an extract_cache.ExtractionCache in the PROCESSOR_CACHE file, so a comment scored by one run is not
+scored again by the next one, keyed by the VADER version instead of the ticker universe and rules.
+"""
+
+# a new VADER lexicon gives new scores
+VADER_VERSION = f"vaderSentiment {version('vaderSentiment')}"
+
+# set in each worker the first time it scores, the lexicon is only read once per process
+_analyzer = None
+
+
+def analyzer():
+    global _analyzer
+    if _analyzer is None:
+        _analyzer = SentimentIntensityAnalyzer()
+    return _analyzer
+
+
+def score_texts(texts):
+    # runs in a worker, one task is a whole chunk of texts
+    polarity = analyzer().polarity_scores
+    return [polarity(text or "")["compound"] for text in texts]
+
+
+def open_sentiment_cache():
+    """
+    The scores' cache from the PROCESSOR_CACHE settings, only the in process LRU when PROCESSOR_CACHE is "off"
+    Returns:
+        ExtractionCache
+    """
+    return ExtractionCache(cache_path(), "sentiment",
+                           memory_size=int(os.getenv("PROCESSOR_CACHE_MEMORY", 200000)),
+                           max_entries=int(os.getenv("PROCESSOR_CACHE_ENTRIES", 2000000)),
+                           rules=VADER_VERSION)
+
+
+class SentimentScorer:
+    """
+    pool: the run's pool from workers.start_pool, scored in this process when None
+    cache: ExtractionCache the scores are kept in, eg: open_sentiment_cache(), every text is scored when None
+    chunksize: texts per task sent to a worker
+    """
+
+    def __init__(self, pool = None, cache = None, chunksize = 64):
+        self.pool = pool
+        self.cache = cache
+        self.chunksize = chunksize
+        self.hits = 0
+        self.misses = 0
+
+    def score(self, texts):
+        """
+        Args:
+            texts: list of comment bodies or post titles
+        Returns:
+            list of VADER compound scores in the same order
+        """
+        if self.cache is None:
+            self.misses += len(texts)
+            return self._run(texts)
+
+        keys, scores = self.cache.lookup("vader", texts)
+        todo = {}
+        for i, key in enumerate(keys):
+            if scores[i] is not MISSING:
+                self.hits += 1
+            elif key in todo:
+                # the same text twice in one batch is only scored once
+                todo[key][1].append(i)
+                self.hits += 1
+            else:
+                todo[key] = (texts[i], [i])
+                self.misses += 1
+
+        if todo:
+            results = self._run([text for text, _ in todo.values()])
+            for (_, positions), compound in zip(todo.values(), results):
+                for i in positions:
+                    scores[i] = compound
+            self.cache.put_many(zip(todo, results))
+        return scores
+
+    def _run(self, texts):
+        if self.pool is None:
+            return score_texts(texts)
+        chunks = [texts[i:i + self.chunksize] for i in range(0, len(texts), self.chunksize)]
+        return [s for chunk in self.pool.map(score_texts, chunks) for s in chunk]
+
+    def annotate(self, batch):
+        """
+        Scores the text of every document in a mentions.MentionBatch, once per document however many tickers it has
+        """
+        if batch.docs:
+            batch.set_sentiment(self.score(batch.texts))
+
+    def close(self):
+        # writes the new scores to the cache file
+        if self.cache is not None:
+            self.cache.close()
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        disk = f", {self.cache.disk_hits} from disk" if self.cache is not None and self.cache.path is not None else ""
+        return f"sentiment cache: {self.hits} hits{disk}, {self.misses} misses ({rate:.0%} hit rate)"
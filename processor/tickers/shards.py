@@ -0,0 +1,439 @@
+import argparse
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+import psycopg2
+from psycopg2.extras import execute_values
+from db import connection
+from tickers import path, stream_comment_matches, post_mentions
+from workers import start_pool, match_batches, match_post, StageStats
+from writer import TickerWriter
+from sentiment import SentimentScorer, open_sentiment_cache
+from universe import load_universe
+from extract_cache import open_cache
+from metrics import open_metrics
+
+"""Sharded processing over several machines
+The coordinator plans a run into shards in processor_leases. A shard is a set of whole posts with all of their
+comments, so propagation never needs anything from another shard. A post whose tree is bigger than --split-above
+(The Lounge and the other megathreads) is split by top level comment instead: each shard gets some of the top level
+comments with every reply under them.
+Workers on any number of machines claim one shard at a time with FOR UPDATE SKIP LOCKED, biggest first so a large
+shard does not start last. A held lease is kept alive by a heartbeat thread, a lease that runs out (the worker died or
+hung) is handed to the next worker that asks. A shard's matches are committed in the same transaction that marks it
+done, and only while the lease is still ours.
+Run from processor/tickers:
+    python shards.py plan --run nightly           # coordinator, once
+    python shards.py work --run nightly           # on every machine
+    python shards.py status --run nightly         # progress
+"""
+
+Queries = Path(__file__).resolve().parent.parent / "queries"
+
+# pending shards, and leased ones whose lease ran out
+Claim = """
+UPDATE processor_leases l
+SET status = 'leased', owner = %(owner)s, leased_until = now() + %(ttl)s * interval '1 second',
+    heartbeat_at = now(), attempts = l.attempts + 1, started_at = now(), error = NULL
+FROM (
+    SELECT run_id, shard FROM processor_leases
+    WHERE run_id = %(run)s
+      AND (status = 'pending' OR (status = 'leased' AND leased_until < now()))
+      AND attempts < %(max_attempts)s
+    ORDER BY comments DESC, shard
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+) next
+WHERE l.run_id = next.run_id AND l.shard = next.shard
+RETURNING l.shard, l.post_ids, l.root_ids, l.comments, l.attempts
+"""
+
+# expired leases that already had every attempt
+Give_Up = """
+UPDATE processor_leases SET status = 'failed', error = coalesce(error, 'lease expired')
+WHERE run_id = %(run)s AND status IN ('pending', 'leased') AND attempts >= %(max_attempts)s
+  AND (status = 'pending' OR leased_until < now())
+"""
+
+Heartbeat = """
+UPDATE processor_leases SET leased_until = now() + %(ttl)s * interval '1 second', heartbeat_at = now()
+WHERE run_id = %(run)s AND shard = %(shard)s AND owner = %(owner)s AND status = 'leased'
+"""
+
+Finish = """
+UPDATE processor_leases SET status = 'done', finished_at = now(), leased_until = NULL, matches = %(matches)s
+WHERE run_id = %(run)s AND shard = %(shard)s AND owner = %(owner)s AND status = 'leased'
+"""
+
+Release = """
+UPDATE processor_leases
+SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'failed' ELSE 'pending' END,
+    owner = NULL, leased_until = NULL, error = %(error)s
+WHERE run_id = %(run)s AND shard = %(shard)s AND owner = %(owner)s AND status = 'leased'
+"""
+
+# rows in the same order as tickers.Comment_Scan, oldest first so a parent is matched before its replies
+Post_Comments = """
+SELECT id, parent_id, post_id, body, author, created_utc FROM comments
+WHERE post_id = ANY(%(posts)s)
+ORDER BY created_utc, id
+"""
+
+Subtree_Comments = """
+WITH RECURSIVE tree AS (
+    SELECT id FROM comments WHERE id = ANY(%(roots)s)
+    UNION ALL
+    SELECT c.id FROM comments c JOIN tree t ON c.parent_id = t.id
+)
+SELECT c.id, c.parent_id, c.post_id, c.body, c.author, c.created_utc
+FROM comments c JOIN tree USING (id)
+ORDER BY c.created_utc, c.id
+"""
+
+
+def ensure_leases(conn):
+    with conn.cursor() as curr:
+        curr.execute((Queries / "processor_leases.sql").read_text())
+    conn.commit()
+
+
+# ---------- coordinator ----------
+
+def subtree_sizes(conn, post_id):
+    """
+    Returns:
+        {top level comment id: comments in its tree}, a reply whose parent is not in the post counts as top level
+    """
+    with conn.cursor() as curr:
+        curr.execute("SELECT id, parent_id FROM comments WHERE post_id = %s", (post_id,))
+        parents = dict(curr.fetchall())
+
+    roots = {}
+    sizes = {}
+    for comment_id in parents:
+        chain = []
+        node = comment_id
+        while node not in roots:
+            parent = parents.get(node)
+            if parent is None or parent not in parents:
+                roots[node] = node
+                break
+            chain.append(node)
+            node = parent
+        root = roots[node]
+        for visited in chain:
+            roots[visited] = root
+        sizes[root] = sizes.get(root, 0) + 1
+    return sizes
+
+
+def pack(items, target):
+    # items: [(key, size)] in a stable order, consecutive items are grouped until a group reaches target
+    group, total = [], 0
+    for key, size in items:
+        group.append(key)
+        total += size
+        if total >= target:
+            yield group, total
+            group, total = [], 0
+    if group:
+        yield group, total
+
+
+def plan(run_id, target = 5000, split_above = None, replace = False):
+    """
+    Splits all posts and comments into the shards of a run
+    Args:
+        run_id: name of the run, the workers are started with the same one
+        target: comments per shard
+        split_above: posts with more comments than this are split by top level comment, defaults to 4 * target
+        replace: throw away an existing plan with the same run_id
+    Returns:
+        number of shards
+    """
+    split_above = split_above or 4 * target
+    with connection("write") as conn:
+        ensure_leases(conn)
+        with conn.cursor() as curr:
+            curr.execute("SELECT count(*) FROM processor_leases WHERE run_id = %s", (run_id,))
+            if curr.fetchone()[0]:
+                if not replace:
+                    raise SystemExit(f"run {run_id!r} is already planned, use --replace to plan it again")
+                curr.execute("DELETE FROM processor_leases WHERE run_id = %s", (run_id,))
+
+            curr.execute("""
+                SELECT p.id, count(c.id) FROM posts p LEFT JOIN comments c ON c.post_id = p.id
+                GROUP BY p.id ORDER BY p.id
+            """)
+            sizes = curr.fetchall()
+
+        shards = []
+        small = [(post_id, max(1, count)) for post_id, count in sizes if count <= split_above]
+        for post_ids, total in pack(small, target):
+            shards.append((post_ids, None, total))
+        for post_id, count in sizes:
+            if count > split_above:
+                roots = sorted(subtree_sizes(conn, post_id).items())
+                for root_ids, total in pack(roots, target):
+                    shards.append(([post_id], root_ids, total))
+
+        with conn.cursor() as curr:
+            execute_values(curr, "INSERT INTO processor_leases (run_id, shard, post_ids, root_ids, comments) VALUES %s",
+                           [(run_id, i, post_ids, root_ids, total) for i, (post_ids, root_ids, total) in enumerate(shards)])
+        conn.commit()
+
+    split = sum(1 for s in shards if s[1] is not None)
+    print(f"planned run {run_id!r}: {len(shards)} shards ({split} from split megathreads) over {len(sizes)} posts")
+    return len(shards)
+
+
+def status(run_id):
+    """
+    Prints the progress of a run: shards and comments per status, the live leases and an estimate of the time left
+    Returns:
+        {status: shards}
+    """
+    with connection("read") as conn, conn.cursor() as curr:
+        curr.execute("""
+            SELECT status, count(*), sum(comments), coalesce(sum(matches), 0) FROM processor_leases
+            WHERE run_id = %s GROUP BY status ORDER BY status
+        """, (run_id,))
+        by_status = curr.fetchall()
+        curr.execute("""
+            SELECT shard, owner, comments, attempts, extract(epoch FROM now() - heartbeat_at),
+                   extract(epoch FROM leased_until - now())
+            FROM processor_leases WHERE run_id = %s AND status = 'leased' ORDER BY shard
+        """, (run_id,))
+        leased = curr.fetchall()
+        curr.execute("""
+            SELECT extract(epoch FROM max(finished_at) - min(started_at)) FROM processor_leases
+            WHERE run_id = %s AND status = 'done'
+        """, (run_id,))
+        elapsed = curr.fetchone()[0]
+        curr.execute("SELECT shard, attempts, error FROM processor_leases WHERE run_id = %s AND status = 'failed'", (run_id,))
+        failed = curr.fetchall()
+
+    if not by_status:
+        print(f"run {run_id!r} is not planned")
+        return {}
+
+    counts = {s: n for s, n, _, _ in by_status}
+    total = sum(c for _, _, c, _ in by_status)
+    done = sum(c for s, _, c, _ in by_status if s == "done")
+    print(f"run {run_id!r}: {done:,} of {total:,} comments done ({done / total:.0%})" if total else f"run {run_id!r}")
+    for state, shards, comments, matches in by_status:
+        print(f"  {state:<8} {shards:>6} shards {comments:>12,} comments {matches:>10,} matches")
+
+    if elapsed and done:
+        rate = done / float(elapsed)
+        left = total - done
+        print(f"  {rate:,.0f} comments/sec across the workers, about {left / rate:,.0f}s left")
+
+    for shard, owner, comments, attempts, since_beat, expires in leased:
+        state = "EXPIRED" if expires < 0 else f"expires in {expires:.0f}s"
+        beat = "no heartbeat" if since_beat is None else f"heartbeat {since_beat:.0f}s ago"
+        print(f"  shard {shard:>5} {owner:<30} {comments:>8,} comments  attempt {attempts}  {beat}  {state}")
+    for shard, attempts, error in failed:
+        print(f"  shard {shard:>5} failed after {attempts} attempts: {error}")
+    return counts
+
+
+# ---------- workers ----------
+
+class LeaseKeeper(threading.Thread):
+    """
+    Heartbeat for one lease, pushes leased_until forward every ttl/3 seconds on its own connection
+    lost is set if the lease turns out to belong to somebody else (it expired and was claimed again)
+    """
+
+    def __init__(self, run_id, shard, owner, ttl):
+        super().__init__(daemon=True)
+        self.params = {"run": run_id, "shard": shard, "owner": owner, "ttl": ttl}
+        self.ttl = ttl
+        self.lost = threading.Event()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.ttl / 3):
+            try:
+                with connection("write") as conn:
+                    with conn.cursor() as curr:
+                        curr.execute(Heartbeat, self.params)
+                        kept = curr.rowcount == 1
+                    conn.commit()
+            except psycopg2.Error as e:
+                # keep trying, the lease only goes once leased_until has passed
+                print(f"Heartbeat for shard {self.params['shard']} failed: ", e)
+                continue
+            if not kept:
+                self.lost.set()
+                return
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+def claim(conn, run_id, owner, ttl, max_attempts):
+    params = {"run": run_id, "owner": owner, "ttl": ttl, "max_attempts": max_attempts}
+    with conn.cursor() as curr:
+        curr.execute(Give_Up, params)
+        curr.execute(Claim, params)
+        lease = curr.fetchone()
+    conn.commit()
+    return lease
+
+
+def process_shard(read_conn, pool, writer, scorer, lease, batchSize, chunksize, stats, cache = None):
+    """
+    Matches, propagates and scores one shard into the writer, nothing is committed here
+    Returns:
+        number of comment mentions
+    """
+    shard, post_ids, root_ids, _, _ = lease
+
+    # the post matches the comments of this shard can inherit, The Lounge is left out like in process_db
+    with read_conn.cursor() as curr:
+        curr.execute("SELECT title, id, author, created_utc FROM posts WHERE id = ANY(%s) AND NOT title = 'The Lounge'", (post_ids,))
+        posts = curr.fetchall()
+    matches_post = {}
+    for rows, bucketed in match_batches(pool, [posts] if posts else [], match_post, 0, chunksize, stats, cache):
+        found_posts = post_mentions(rows, bucketed, matches_post)
+        stats.mentions("post", found_posts)
+        if scorer:
+            scorer.annotate(found_posts)
+        # a split megathread writes its post from every part, the unique index keeps one
+        writer.add_posts(found_posts)
+
+    if root_ids is None:
+        query, params = Post_Comments, {"posts": post_ids}
+    else:
+        query, params = Subtree_Comments, {"roots": root_ids}
+
+    # the whole reply tree of the shard is local, so its parent index is small
+    parent_map = {}
+    with read_conn.cursor() as curr:
+        curr.execute(f"SELECT id, parent_id FROM ({query}) shard WHERE parent_id IS NOT NULL", params)
+        for comment_id, parent_id in curr:
+            parent_map[comment_id] = parent_id
+
+    matched = 0
+    for batch in stream_comment_matches(read_conn, pool, matches_post, parent_map, batchSize, chunksize=chunksize,
+                                        stats=stats, sentiment=scorer, query=query, params=params, cache=cache):
+        writer.add_comments(batch)
+        matched += len(batch)
+    # the server side cursor is gone, end the read transaction so the next shard sees fresh rows
+    read_conn.rollback()
+    return matched
+
+
+def work(run_id, *, ttl = 120, batchSize = 500, workers = None, chunksize = None, sentiment = True, max_attempts = 3, owner = None):
+    """
+    Claims and processes shards of a run until none are left
+    Args:
+        run_id: the run from plan
+        ttl: seconds a lease lasts without a heartbeat
+        batchSize, workers, chunksize: see process_db
+        max_attempts: a shard that failed or expired this many times is marked failed
+        owner: name of this worker in the lease table, defaults to host:pid
+    Returns:
+        (shards done, shards given back)
+    """
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    universe = load_universe(path)
+    cache = open_cache(universe.version)
+    stats = StageStats(open_metrics("shard_work"))
+    done, given_back = 0, 0
+
+    with connection("read") as read_conn, connection("write") as write_conn:
+        ensure_leases(write_conn)
+        writer = TickerWriter(write_conn, page_size=batchSize, commit_pages=False, universe=universe.version, stats=stats)
+
+        with start_pool(universe.symbols, workers) as pool:
+            scorer = SentimentScorer(pool, open_sentiment_cache()) if sentiment else None
+
+            while True:
+                lease = claim(write_conn, run_id, owner, ttl, max_attempts)
+                if lease is None:
+                    break
+                shard = lease[0]
+                keeper = LeaseKeeper(run_id, shard, owner, ttl)
+                keeper.start()
+                params = {"run": run_id, "shard": shard, "owner": owner, "max_attempts": max_attempts}
+                start = time.perf_counter()
+                try:
+                    params["matches"] = process_shard(read_conn, pool, writer, scorer, lease, batchSize, chunksize, stats, cache)
+                    keeper.stop()
+                    with write_conn.cursor() as curr:
+                        curr.execute(Finish, params)
+                        ours = curr.rowcount == 1 and not keeper.lost.is_set()
+                    if ours:
+                        writer.commit()
+                        done += 1
+                        stats.count("processor_shards_total", result="done")
+                        print(f"shard {shard}: {lease[3]:,} comments, {params['matches']:,} matches in {time.perf_counter() - start:.1f}s")
+                    else:
+                        # somebody else has the shard now, they will write it
+                        write_conn.rollback()
+                        writer.discard()
+                        given_back += 1
+                        stats.count("processor_shards_total", result="lost")
+                        print(f"shard {shard}: lease lost, results dropped")
+                except Exception as e:
+                    keeper.stop()
+                    write_conn.rollback()
+                    read_conn.rollback()
+                    writer.discard()
+                    given_back += 1
+                    with write_conn.cursor() as curr:
+                        curr.execute(Release, dict(params, error=str(e)[:1000]))
+                    write_conn.commit()
+                    print(f"shard {shard} failed: ", e)
+                    stats.error("shard", e)
+                    stats.count("processor_shards_total", result="failed")
+                    if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                        raise
+
+    print(stats.report())
+    if scorer:
+        scorer.close()
+        print(scorer.report())
+    if cache:
+        cache.close()
+        print(cache.report())
+    stats.finish(scorer, cache)
+    print(f"worker {owner}: {done} shards done, {given_back} given back")
+    return done, given_back
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded ticker processing over several workers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="split the posts and comments into shards")
+    plan_parser.add_argument("--run", required=True)
+    plan_parser.add_argument("--target", type=int, default=5000, help="comments per shard")
+    plan_parser.add_argument("--split-above", type=int, help="split posts with more comments than this by subtree")
+    plan_parser.add_argument("--replace", action="store_true")
+
+    work_parser = commands.add_parser("work", help="process shards until the run is finished")
+    work_parser.add_argument("--run", required=True)
+    work_parser.add_argument("--ttl", type=int, default=120, help="lease length in seconds")
+    work_parser.add_argument("--batch-size", type=int, default=500)
+    work_parser.add_argument("--workers", type=int)
+    work_parser.add_argument("--max-attempts", type=int, default=3)
+    work_parser.add_argument("--no-sentiment", action="store_true")
+
+    status_parser = commands.add_parser("status", help="show the progress of a run")
+    status_parser.add_argument("--run", required=True)
+
+    args = parser.parse_args()
+    if args.command == "plan":
+        plan(args.run, args.target, args.split_above, args.replace)
+    elif args.command == "work":
+        work(args.run, ttl=args.ttl, batchSize=args.batch_size, workers=args.workers, max_attempts=args.max_attempts,
+             sentiment=not args.no_sentiment)
+    else:
+        status(args.run)
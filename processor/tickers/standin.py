@@ -0,0 +1,132 @@
+import os
+import re
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+"""SQLite stand-in for the reddit database, for running the processor offline
+Holds posts and comments in a temporary SQLite file and hands out connections that look enough like psycopg2 for the
+read side of the processor: cursor(name=...) for the server side cursors, %s / %(name)s parameters, fetchmany,
+commit, rollback and close. Every connection opens the same file so forked pool workers and the several connections
+of a run all see the same rows. LocalDatabase.connection is a drop in for db.connection, the role is ignored.
+    db = LocalDatabase()
+    db.load(post_rows, comment_rows)
+    tickers.connection = db.connection
+"""
+
+Schema = """
+CREATE TABLE posts(id TEXT PRIMARY KEY, subreddit TEXT, title TEXT, body TEXT, author TEXT, created_utc INTEGER,
+                   score INTEGER, inserted_at TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE comments(id TEXT PRIMARY KEY, body TEXT, author TEXT, created_utc INTEGER, parent_id TEXT, post_id TEXT,
+                      score INTEGER, inserted_at TEXT DEFAULT CURRENT_TIMESTAMP);
+CREATE INDEX idx_comments_parent ON comments(parent_id);
+CREATE INDEX idx_comments_created_id ON comments(created_utc, id);
+"""
+
+Named_Param_RE = re.compile(r"%\((\w+)\)s")
+
+
+def sqlite_query(query):
+    # psycopg2 placeholders to sqlite ones
+    return Named_Param_RE.sub(r":\1", query).replace("%s", "?")
+
+
+class Cursor:
+    def __init__(self, conn, name = None):
+        self._cursor = conn.cursor()
+        self.name = name
+        self.itersize = 2000
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params = None):
+        self._cursor.execute(sqlite_query(query), params or ())
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(sqlite_query(query), rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size = None):
+        return self._cursor.fetchmany(size or self.itersize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+
+    def cursor(self, name = None):
+        return Cursor(self._conn, name)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+class LocalDatabase:
+    """
+    path: SQLite file, a temporary one that is removed by close() when it is None
+    """
+
+    def __init__(self, path = None):
+        self.owned = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="reddit_standin_", suffix=".sqlite")
+            os.close(fd)
+        self.path = path
+        conn = sqlite3.connect(path)
+        conn.executescript(Schema)
+        conn.close()
+
+    def load(self, post_rows, comment_rows):
+        # rows in the order of corpus.Post_Columns / corpus.Comment_Columns
+        conn = sqlite3.connect(self.path)
+        conn.executemany("INSERT INTO posts (id, subreddit, title, body, author, created_utc, score) VALUES (?,?,?,?,?,?,?)", post_rows)
+        conn.executemany("INSERT INTO comments (id, body, author, created_utc, parent_id, post_id, score) VALUES (?,?,?,?,?,?,?)", comment_rows)
+        conn.commit()
+        conn.close()
+
+    def connect(self):
+        return Connection(self.path)
+
+    @contextmanager
+    def connection(self, role = "write"):
+        conn = self.connect()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            conn.close()
+
+    def close(self):
+        if self.owned and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,38 +1,32 @@
-from db import connection
+from db import connection, server_cursor
 from psycopg2 import Error as psyError
-import re
-import pandas as pd
-from multiprocessing import Pool, cpu_count
-from functools import partial
+import time
+from contextlib import closing
+from sys import intern
+from rules import Dollar_RE, Upper_RE, Symbol_RE, Lower_RE, context_RE, Redlist, Numerical_RE
+from matcher import TickerMatcher
+from mentions import MentionBatch, PROPAGATED_COMMENT, PROPAGATED_POST, POST_HOPS, SNIPPET, PROPAGATED_SNIPPET
+from workers import start_pool, fetch_batches, match_batches, match_comment, match_post, StageStats
+from sentiment import SentimentScorer, open_sentiment_cache
+from universe import load_universe
+from extract_cache import open_cache
+from metrics import open_metrics
 
 """We will load in the scraped file from the reddit posts and comments, we will then look for any tickers mentioned in the comment
 This will be done using:
     - regular expressions
-    - Machine learning
+    - Machine learning, a model tells lowercase tickers from ordinary words (see disambiguate.py)
 
 
     """
 
 def load_tickers (path):
     # file: contains one ticker per line 
+    # pandas is only needed here, the processor itself loads the universe snapshot (see universe.py)
+    import pandas as pd
     df = pd.read_csv(path, usecols=["Ticker"]) # The tickers in all major US exchanges
     return df
 
-# We will identify tickers using regular expressions 
-Dollar_RE = re.compile(r'\$([A-Za-z]{1,5})\b')
-Upper_RE = re.compile(r'([A-Z]{2,5})\b')
-Symbol_RE = re.compile(r'\b(?:ticker|symbol)[:\s]*([A-Za-z]{1,6})\b', re.I)
-Lower_RE = re.compile(r"\b[a-z]{3,5}\b")
-
-# looks for context around the ticker to build confindence
-context_RE = re.compile(r'\b(buy|sell|shares|short|long|stock|IPO|earnings|dividend|split|bought|sold|play|position|trading|trade|cheap|M&A|gain|moving|moon|holding|squeeze|hold|watch|dip|volume|catalyst|pump|dump|earnings|bullish|undervalued|bearish)\b', re.I)
-
-# blacklisted common financial terms so they do not trigger false positives, plus other terms frequentyly capitalised
-Redlist = {"GUYS", "MOON", "US", "UK", "EBIT", "EBITDA", "UP","CAGR", "FCF", "ROE", "ROI", "ROIC", "EV", "NI", "PEG", "EU", "GPT", "AI", "IT", "LFG", "CEO", "CFO", "NASDAQ", "NYSE", "LSE", "ASX", "TSE","SSE", "SEHK","TSX"}
-
-#checks for a numerical number, optional currency sign, optional decimal points
-Numerical_RE = re.compile(r"\b(?:\$|£)?\d+(?:\.\d+)?\b")
-
 #ticker file 
 path = "./tickers.csv"
 
@@ -61,7 +55,8 @@ def extract_candidates(text, ticker_set, allow_lowercase = False):
                 continue
             candidates.add((t, "allcaps", m.start(), m.group(0)))
     
-    if allow_lowercase and context_RE.search(text) or Numerical_RE.search(text):
+    # lowercase words only when asked for, and then only in a text with context or a number
+    if allow_lowercase and (context_RE.search(text) or Numerical_RE.search(text)):
         for m in Lower_RE.finditer(text):
             t = m.group(0)
             up = t.upper()
@@ -95,7 +90,8 @@ def score_potential(text, candidate, post = False):
     #return min(score, 1.0)
     return score
 
-def process_text(text, ticker_set,*, allow_lowercase = False, threshold = 0.9,post = False):
+def process_text_regex(text, ticker_set,*, allow_lowercase = False, threshold = 0.9,post = False):
+    # the original four sweep path, kept as the reference for matcher.py and bench_matcher.py
     candidates = extract_candidates(text, ticker_set, allow_lowercase)
     results = []
     for c in candidates:
@@ -107,14 +103,21 @@ def process_text(text, ticker_set,*, allow_lowercase = False, threshold = 0.9,po
             results.append({"ticker": c[0], "kind": c[1], "score": score, "snippet": text[:200], "inferred_from": None})
     return results
 
+def process_text(text, ticker_set,*, allow_lowercase = False, threshold = 0.9,post = False, cache = None):
+    # single pass over the text, same results as process_text_regex
+    # cache: extract_cache.ExtractionCache for this ticker_set's universe, a text seen before is not matched again
+    matcher = TickerMatcher(ticker_set, cache=cache)
+    return matcher.process_text(text, allow_lowercase=allow_lowercase, threshold=threshold, post=post)
+
 def lounge_id():
-    conn = connection()
-    curr = conn.cursor()
+    with connection("read") as conn:
+        curr = conn.cursor()
 
-    curr.execute("""SELECT id FROM posts
-                 WHERE title = 'The Lounge'""")
-    
-    ids = curr.fetchall()
+        curr.execute("""SELECT id FROM posts
+                     WHERE title = 'The Lounge'""")
+        
+        ids = curr.fetchall()
+        curr.close()
 
     return ids
 
@@ -122,85 +125,73 @@ def lounge_id():
 
 def propogate_for_comment(comment_row, matches_com, matches_post, tree=None):
     """
-    comment_row: (comment_id, parent_id, post_id, body)
-    matches_com: list of comment-level matches
-                 [{"comment":[id, body], "match_details": {...}}]
-    matches_post: list of post-level matches
-                  [{"post":[title, post_id], "match_details": {...}}]
+    comment_row: (comment_id, parent_id, post_id, body, author, created_utc), extra trailing columns are ignored
+    matches_com: comment_id -> (ticker, score, ticker, score, ...) of every ticker of the comment
+    matches_post: post_id -> (ticker, score, ...) of every ticker of the post
     tree: ordered list of ancestor comment_ids, e.g. [parent, grandparent, greatgrandparent]
+    Both lookups are dictionary hits so this is O(depth) per comment
+    Returns:
+        [(ticker, kind, score, inferred_from, hops)] every ticker that qualifies from the nearest ancestor with one,
+        the post's otherwise, empty when nothing does
     """
 
-    comment_id, parent_id, post_id, body, author, created_utc = comment_row
+    post_id = comment_row[2]
 
     DECAY = 0.8
     MAX_DEPTH = 3
     PARENT_CONF_LIMIT = 0.9
     CHILD_CONF_LIMIT = 0.72
 
+    found = []
     # ---------- 1) COMMENT-LEVEL PROPAGATION ----------
     if tree:
         for depth, ancestor_id in enumerate(tree, start=1):
             if not ancestor_id or depth > MAX_DEPTH:
                 break
 
-            # find ancestor match
-            parent_match = None
-            for match in matches_com:
-                if match["comment"][0] == ancestor_id:
-                    parent_match = match
-                    break
+            # find ancestor matches, flat (ticker, score) pairs
+            parent_match = matches_com.get(ancestor_id)
 
             if parent_match:
-                parent_score = parent_match["match_details"]["score"]
-                if parent_score >= PARENT_CONF_LIMIT:
-                    child_conf = round(parent_score * (DECAY ** depth),3)
-                    if child_conf > CHILD_CONF_LIMIT:
-                        return {
-                            "comment": [comment_id, body],
-                            "match_details": {
-                                "ticker": parent_match["match_details"]["ticker"],
-                                "kind": "propagated_comment",
-                                "score": child_conf,
-                                "snippet": body[:300],
-                                "inferred_from": ancestor_id,
-                                "hops": depth
-                            }
-                    }
+                for parent_ticker, parent_score in zip(parent_match[::2], parent_match[1::2]):
+                    if parent_score >= PARENT_CONF_LIMIT:
+                        child_conf = round(parent_score * (DECAY ** depth),3)
+                        if child_conf > CHILD_CONF_LIMIT:
+                            found.append((parent_ticker, PROPAGATED_COMMENT, child_conf, ancestor_id, depth))
+                if found:
+                    return found
 
     # ---------- 2) POST-LEVEL PROPAGATION ----------
-    for post_match in matches_post:
-        
-        if post_match["post"][1] == post_id:
-            parent_score = post_match["match_details"]["score"]
+    post_match = matches_post.get(post_id)
+    if post_match:
+        for parent_ticker, parent_score in zip(post_match[::2], post_match[1::2]):
             if parent_score >= PARENT_CONF_LIMIT:
                 child_conf = round(parent_score * DECAY,3)
                 if child_conf > CHILD_CONF_LIMIT:
-                    return {
-                        "comment": [comment_id, body],
-                        "match_details": {
-                            "ticker": post_match["match_details"]["ticker"],
-                            "kind": "propagated_post",
-                            "score": child_conf,
-                            "snippet": body[:300],
-                            "inferred_from": post_id,
-                            "hops": "post"
-                        }
-                }
+                    found.append((parent_ticker, PROPAGATED_POST, child_conf, post_id, POST_HOPS))
+
+    return found
+
 
-    return None
+def comment_key(comment_row):
+    # everything about a comment the writers need, without the body
+    # the post ids and authors repeat across a batch, interned they are held once however many mentions keep them
+    comment_id, parent_id, post_id, body, author, created_utc = comment_row[:6]
+    return (comment_id, parent_id, post_id and intern(post_id), author and intern(author), created_utc)
 
 
 def build_ancestor_tree(comment_id, parent_map, max_depth=3):
     """
     Returns list of ancestor comment_ids in order:
     [parent, grandparent, greatgrandparent]
+    parent_map: comment_id -> parent_id, see load_parent_index
     """
     tree = []
     current = comment_id
     depth = 0
 
     while depth < max_depth:
-        parent = parent_map.get(current, (None, None))[0]
+        parent = parent_map.get(current)
         if not parent:
             break
         tree.append(parent)
@@ -210,112 +201,260 @@ def build_ancestor_tree(comment_id, parent_map, max_depth=3):
     return tree
 
 
-def process_posts_from_db(batchSize = 100):
-    conn = connection()
+def load_parent_index(conn, batchSize = 10000):
+    """
+    Builds the comment_id -> parent_id index for the whole comments table
+    Only replies are kept and the ids are interned so the parent strings are shared with the keys
+    Loaded once per run so an ancestor is found no matter which fetchmany batch it lands in
+    """
+    parent_map = {}
+    curr = server_cursor(conn, "parent_index", batchSize)
+    try:
+        curr.execute("SELECT id, parent_id FROM comments WHERE parent_id IS NOT NULL")
+        while True:
+            rows = curr.fetchmany(batchSize)
+            if not rows:
+                break
+            for comment_id, parent_id in rows:
+                parent_map[intern(comment_id)] = intern(parent_id)
+    finally:
+        curr.close()
+    return parent_map
+
+
+def flat_scores(mentions):
+    # (ticker, score, ticker, score, ...), one tuple per document keeps the propagation indexes small
+    flat = ()
+    for mention in mentions:
+        flat += (mention[0], mention[2])
+    return flat
 
-    curr = conn.cursor()
-    tickers = load_tickers(path)
-    ticker_set = set(tickers["Ticker"])
-    matched_ls = []
+
+def propagate_batch(rows, bucketed, matches_com, matches_post, parent_map):
+    """
+    Finds the direct and propagated mentions of one batch of comments
+    Args:
+        rows: comment rows (comment_id, parent_id, post_id, body, author, created_utc)
+        bucketed: TickerMatcher.mentions results for each row
+        matches_com: comment_id -> flat (ticker, score, ...) index, updated in place
+        matches_post: post_id -> flat (ticker, score, ...) index
+        parent_map: global comment_id -> parent_id index
+    Returns:
+        MentionBatch with every ticker of every comment in the batch that has one
+    """
+    batch = MentionBatch()
+    for row, mentions in zip(rows, bucketed):
+        comment_id = row[0]
+        if mentions:
+            doc = batch.add_doc(comment_key(row), row[3])
+            for ticker, kind, score, _ in mentions:
+                batch.add(doc, ticker, kind, score, SNIPPET)
+        else:
+            tree = build_ancestor_tree(comment_id, parent_map)
+            mentions = propogate_for_comment(
+                comment_row=row,
+                matches_com=matches_com,
+                matches_post=matches_post,
+                tree=tree
+            )
+            if not mentions:
+                continue
+            doc = batch.add_doc(comment_key(row), row[3])
+            for ticker, kind, score, inferred_from, hops in mentions:
+                batch.add(doc, ticker, kind, score, PROPAGATED_SNIPPET, inferred_from, hops)
+        matches_com[comment_id] = flat_scores(mentions)
+    return batch
+
+
+def post_mentions(rows, bucketed, matches_post = None, batch = None):
+    """
+    Args:
+        rows: post rows (title, id, author, created_utc), extra trailing columns are ignored
+        bucketed: TickerMatcher.mentions results for each title
+        matches_post: post_id -> flat (ticker, score, ...) index, updated in place when given
+        batch: MentionBatch to add to, a new one when None
+    Returns:
+        MentionBatch of the posts, keyed (post_id, author, created_utc)
+    """
+    if batch is None:
+        batch = MentionBatch()
+    for post, mentions in zip(rows, bucketed):
+        if mentions:
+            title, post_id, author, created_utc = post[:4]
+            doc = batch.add_doc((post_id, author, created_utc), title)
+            for ticker, kind, score, _ in mentions:
+                batch.add(doc, ticker, kind, score, SNIPPET)
+            if matches_post is not None:
+                matches_post[post_id] = flat_scores(mentions)
+    return batch
+
+
+def load_ticker_set(path = path):
+    return load_universe(path).symbols
+
+
+def process_posts_from_db(batchSize = 100, *, pool = None, ticker_set = None, chunksize = None, stats = None, sentiment = None, matches_post = None,
+                          cache = None):
+    """
+    Finds the ticker mentions in the post titles
+    pool: the run's pool from workers.start_pool, a pool is started just for this call when it is None
+    sentiment: SentimentScorer, when given each title is scored
+    matches_post: post_id -> flat (ticker, score, ...) index for propagation, filled in when given
+    cache: extract_cache.ExtractionCache, titles matched before are not sent to the pool
+    Returns:
+        MentionBatch of every post with a mention
+    """
+    if pool is None:
+        if ticker_set is None:
+            ticker_set = load_ticker_set()
+        with start_pool(ticker_set) as own_pool:
+            return process_posts_from_db(batchSize, pool=own_pool, chunksize=chunksize, stats=stats, sentiment=sentiment,
+                                         matches_post=matches_post, cache=cache)
+
+    with connection("read") as conn:
+        return _match_posts(conn, pool, batchSize, chunksize, stats, sentiment, matches_post, cache)
+
+
+def _match_posts(conn, pool, batchSize, chunksize, stats, sentiment, matches_post = None, cache = None):
+    curr = server_cursor(conn, "post_scan", batchSize)
+    matched = MentionBatch()
 
     try:
         curr.execute(
-        """SELECT title, id FROM posts
+        """SELECT title, id, author, created_utc FROM posts
         WHERE NOT title = 'The Lounge';""")
-        with Pool(processes=max(1,cpu_count()-1)) as pool:
-            while True:
-                rows = curr.fetchmany(batchSize)
-                if not rows:
-                    break
-                #parrallel processing for speed, args is (comment text, ticker csv)
-                fn = partial(process_text, post=True)
-                args = [(r[0], ticker_set) for r in rows]
-                #bucketed is the result from process_comment(comment_text, ticker_set)
-                bucketed = pool.starmap(fn, args)
-
-                #matches is all the matches found in the post    
-                for post, matches in zip(rows, bucketed):
-                    if matches:
-                        # print(f"Found matches in: {post[0][:300]}...\n Ticker: {matches[0]["ticker"]} Score: {matches[0]["score"]}\n ")
-                        matched_ls.append({"post":[post[0], post[1]], "match_details": matches[0]})
+        #parrallel processing for speed, the workers already hold the ticker set so only the title is sent
+        batches = fetch_batches(curr, batchSize, stats)
+        for rows, bucketed in match_batches(pool, batches, match_post, 0, chunksize, stats, cache):
+            #bucketed is every ticker found in each post
+            post_mentions(rows, bucketed, matches_post, matched)
+        if stats:
+            stats.mentions("post", matched)
+        if sentiment:
+            start = time.perf_counter()
+            sentiment.annotate(matched)
+            if stats:
+                stats.add("sentiment", len(matched.docs), time.perf_counter() - start)
     except psyError as e:
-        print("Post database error ", e)
-    
-    
+        # without the posts there is nothing to propagate from, the run fails instead of writing half the matches
+        if stats:
+            stats.error("posts", e)
+        raise
     finally:
         curr.close()
-        conn.close()
     
 
-    return matched_ls
+    return matched.trim()
 
-def process_db( batchSize = 500):
-    conn = connection()
 
-    curr= conn.cursor()
+# every comment, rows must come out as (id, parent_id, post_id, body, author, created_utc)
+# oldest first so a parent is matched before its replies, heap order is anything once the collector re-upserts rows
+Comment_Scan = "SELECT id, parent_id, post_id,  body, author, created_utc FROM comments ORDER BY created_utc, id"
 
-    tickers = load_tickers(path)
-    ticker_set = set(tickers["Ticker"])
-
-    #This will get all the matches from the posts to be used later in the propogation
-    matches_posts = process_posts_from_db()
 
+def stream_comment_matches(conn, pool, matches_post, parent_map, batchSize = 500, *, chunksize = None, stats = None, sentiment = None,
+                           query = Comment_Scan, params = None, cache = None):
+    """
+    Generator over the comment mentions, DB rows -> matching -> propagation -> sentiment -> caller
+    The comments come through a server side cursor batchSize rows at a time and only the ids and the
+    (ticker, score) pairs of each matched comment are kept between batches, so memory does not grow with the table
+    query, params: a narrower scan with the same columns as Comment_Scan, eg: the comments of one shard
+    cache: extract_cache.ExtractionCache, bodies matched before are not sent to the pool
+    Yields:
+        a MentionBatch per fetched batch that has any mentions
+    """
+    matches_com = {}
+    curr = server_cursor(conn, "comment_scan", batchSize)
     try:
-        count = 0
-        curr.execute("SELECT id, parent_id, post_id,  body, author, created_utc FROM comments")
-        matched_ls = []
-        with Pool(processes=max(1,cpu_count()-1)) as pool:
-            while True:
-                rows = curr.fetchmany(batchSize)
-                if not rows:
-                    break
-                
-                #parrallel processing for speed, args is (comment text, ticker csv)
-
-                args = [(r[3], ticker_set) for r in rows]
-                #bucketed is the result from process_comment(comment_text, ticker_set)
-                bucketed = pool.starmap(process_text, args)
-
-                # comment_id -> (parent_id, post_id)
-                parent_map = {
-                    r[0]: (r[1], r[2])
-                    for r in rows
-                }
-
-
-                #matches is a list of dictionaries of all the matches in the comment eg [{'ticker': 'AAPL', 'kind': 'dollar', 'score': 0.95, 'snippet': '...'},]]    
-                for row, matches in zip(rows, bucketed):
-                    comment_id = row[0]
-                    if matches:
-                        #print(f"Found matches in: {comment[0][:300]}...\n Ticker: {matches[0]["ticker"]} Score: {matches[0]["score"]}\n {matches}\n", )
-                        matched_ls.append({"comment": row, "match_details": matches[0]})
-                    else:
-                        tree = build_ancestor_tree(comment_id, parent_map)
-
-                        propagated = propogate_for_comment(
-                            comment_row=row,
-                            matches_com=matched_ls,
-                            matches_post=matches_posts,
-                            tree=tree
-                        )
-
-                        if propagated:
-                            matched_ls.append(propagated)
-                            # for matched in matched_ls:
-                            #     if matched["match_details"]["kind"] == "propagated_comment" or  matched["match_details"]["kind"] == "propagated_post":
-                            #          #print(f"Found matches in: {comment[0][:300]}...\n Ticker: {matched["match_details"]["ticker"]} Score: {matched["match_details"]["score"]}\n {matched}\n", )                
-                            #         ...
-        
-    except psyError as e:
-        print("Database error: ",e)
-   
-
+        curr.execute(query, params)
+        batches = fetch_batches(curr, batchSize, stats)
+        #bucketed is the result from TickerMatcher.mentions for each comment
+        for rows, bucketed in match_batches(pool, batches, match_comment, 3, chunksize, stats, cache):
+            start = time.perf_counter()
+            found = propagate_batch(rows, bucketed, matches_com, matches_post, parent_map)
+            if stats:
+                stats.add("propagate", len(rows), time.perf_counter() - start)
+                stats.mentions("comment", found)
+            if sentiment:
+                start = time.perf_counter()
+                sentiment.annotate(found)
+                if stats:
+                    stats.add("sentiment", len(found.docs), time.perf_counter() - start)
+            if len(found):
+                yield found.trim()
     finally:
         curr.close()
-        conn.close()
-    return [matched_ls, matches_posts]
 
 
+def read_comment_matches(conn, pool, matches_post, batchSize, chunksize, stats, sentiment, cache):
+    # stream_comment_matches with the parent index loaded first, a database error while reading is counted and fails the run
+    # errors raised by whoever consumes the batches happen outside this generator and are not caught here
+    try:
+        start = time.perf_counter()
+        parent_map = load_parent_index(conn)
+        stats.add("parents", len(parent_map), time.perf_counter() - start)
+
+        yield from stream_comment_matches(conn, pool, matches_post, parent_map, batchSize, chunksize=chunksize, stats=stats,
+                                          sentiment=sentiment, cache=cache)
+
+    except psyError as e:
+        stats.error("comments", e)
+        raise
+
+
+def process_db( batchSize = 500, *, workers = None, chunksize = None, sink = None, sentiment = True, universe = None, stats = None):
+    """
+    Finds the ticker mentions in every comment, directly or propagated from a parent comment or the post
+    One pool is used for the posts and the comments
+    Args:
+        batchSize: rows per round trip to the server side cursor
+        workers: pool size, defaults to PROCESSOR_WORKERS or cpu_count()-1
+        chunksize: rows per task sent to a worker, defaults to PROCESSOR_CHUNKSIZE
+        sink: called with each MentionBatch of comments as soon as it is found, nothing is kept in memory when it is given
+        sentiment: score each matched text with VADER
+        universe: universe.Universe to match against, loaded from the snapshot when it is None
+        stats: StageStats the run reports into, eg: one shared with the writer, a new one when it is None
+        The extraction cache comes from the PROCESSOR_CACHE settings, see extract_cache.py, and the metrics from the
+        PROCESSOR_METRICS settings, see metrics.py
+    Returns:
+        [comment MentionBatches, post MentionBatch], the comment batches are empty when a sink is given
+    """
+    # a caller that passes its stats in exports them itself, once its own stages are done
+    own_stats = stats is None
+    if own_stats:
+        stats = StageStats(open_metrics("process_db"))
+    if universe is None:
+        universe = load_universe(path)
+    ticker_set = universe.symbols
+    matched_ls = []
+    if sink is None:
+        sink = matched_ls.append
+
+    cache = open_cache(universe.version)
+    with start_pool(ticker_set, workers) as pool:
+        scorer = SentimentScorer(pool, open_sentiment_cache()) if sentiment else None
+
+        #This will get all the matches from the posts to be used later in the propogation
+        # post_id -> (ticker, score, ...) for propagation
+        matches_post = {}
+        matches_posts = process_posts_from_db(pool=pool, chunksize=chunksize, stats=stats, sentiment=scorer, matches_post=matches_post,
+                                              cache=cache)
+
+        with connection("read") as conn:
+            # the sink runs outside the read side's except, a write that fails (eg: the TickerWriter) fails the run
+            with closing(read_comment_matches(conn, pool, matches_post, batchSize, chunksize, stats, scorer, cache)) as batches:
+                for batch in batches:
+                    sink(batch)
+
+    print(stats.report())
+    if scorer:
+        scorer.close()
+        print(scorer.report())
+    if cache:
+        cache.close()
+        print(cache.report())
+    stats.finish(scorer, cache, export=own_stats)
+    return [matched_ls, matches_posts]
 
        
 if __name__ == "__main__":
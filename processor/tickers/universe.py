@@ -0,0 +1,131 @@
+import argparse
+import csv
+import hashlib
+import marshal
+import os
+import time
+from collections import namedtuple
+from pathlib import Path
+
+"""Ticker universe snapshot
+tickers.csv (written by data/process.py) is compiled once into tickers.snapshot next to it: the symbols as a frozenset,
+symbol -> name and a version, all in one marshal blob that loads in a few milliseconds without pandas.
+The snapshot remembers the size, mtime and hash of the csv it came from and is only rebuilt when the csv changes.
+The version is a hash of the sorted (symbol, name) pairs, so the same universe always gets the same version however the
+csv was written, it is stored with every match (universe_version) so results from another universe can be told apart.
+"""
+
+# bump when the snapshot layout changes, older snapshots are then rebuilt
+FORMAT = 1
+MAGIC = b"TKUNIV"
+
+Universe = namedtuple("Universe", ["version", "symbols", "names", "source"])
+
+
+def snapshot_path(path):
+    return Path(path).with_suffix(".snapshot")
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def universe_version(names):
+    digest = hashlib.blake2b(digest_size=8)
+    for symbol in sorted(names):
+        digest.update(f"{symbol}\t{names[symbol]}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_csv(path):
+    # Ticker,Name with a header, the first name wins when a symbol is listed twice
+    names = {}
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            symbol = (row.get("Ticker") or "").strip()
+            if symbol and symbol not in names:
+                names[symbol] = (row.get("Name") or "").strip()
+    return names
+
+
+def write_snapshot(snapshot, names, source):
+    blob = marshal.dumps({
+        "format": FORMAT,
+        "version": universe_version(names),
+        "symbols": frozenset(names),
+        "names": names,
+        "source": source,
+    })
+    # written next to it and renamed so a reader never sees half a snapshot
+    tmp = Path(f"{snapshot}.tmp")
+    tmp.write_bytes(MAGIC + blob)
+    os.replace(tmp, snapshot)
+
+
+def read_snapshot(snapshot):
+    try:
+        data = Path(snapshot).read_bytes()
+        if not data.startswith(MAGIC):
+            return None
+        loaded = marshal.loads(data[len(MAGIC):])
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    if not isinstance(loaded, dict) or loaded.get("format") != FORMAT:
+        return None
+    return loaded
+
+
+def build_snapshot(path, snapshot = None):
+    """
+    Compiles the csv into a snapshot
+    Args:
+        path: tickers.csv
+        snapshot: where to write it, defaults to the csv path with a .snapshot suffix
+    Returns:
+        Universe
+    """
+    snapshot = snapshot or snapshot_path(path)
+    stat = os.stat(path)
+    source = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash(path)}
+    names = read_csv(path)
+    write_snapshot(snapshot, names, source)
+    return Universe(universe_version(names), frozenset(names), names, source)
+
+
+def load_universe(path = "./tickers.csv", snapshot = None):
+    """
+    The ticker universe, from the snapshot when it is still up to date with the csv
+    Only the snapshot is needed when there is no csv, e.g. when the snapshot was copied to a worker on its own
+    Args:
+        path: tickers.csv
+        snapshot: defaults to the csv path with a .snapshot suffix
+    Returns:
+        Universe(version, symbols, names, source)
+    """
+    snapshot = snapshot or snapshot_path(path)
+    loaded = read_snapshot(snapshot)
+
+    if loaded is not None:
+        source = loaded["source"]
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stat = None
+        # same size and mtime is trusted, otherwise only a different hash means the csv really changed
+        if stat is None or (stat.st_size, stat.st_mtime_ns) == (source["size"], source["mtime_ns"]) \
+                or (stat.st_size == source["size"] and file_hash(path) == source["hash"]):
+            return Universe(loaded["version"], loaded["symbols"], loaded["names"], source)
+
+    return build_snapshot(path, snapshot)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or check the ticker universe snapshot")
+    parser.add_argument("path", nargs="?", default="./tickers.csv")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild even when the csv has not changed")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    universe = build_snapshot(args.path) if args.rebuild else load_universe(args.path)
+    print(f"universe {universe.version}: {len(universe.symbols)} symbols in {(time.perf_counter() - start) * 1000:.1f}ms")
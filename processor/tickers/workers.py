@@ -0,0 +1,219 @@
+import os
+import time
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from matcher import TickerMatcher
+from extract_cache import MISSING
+from disambiguate import open_classifier
+
+"""One long lived worker pool for a whole processing run
+The ticker universe is handed to every worker once through the pool initializer, so the tasks only carry the text
+instead of pickling the whole ticker set with every row.
+Worker count and chunk size come from PROCESSOR_WORKERS and PROCESSOR_CHUNKSIZE unless they are passed in.
+Each task is a chunk of a batch, so with a lowercase model (see disambiguate.py) the lowercase candidates of the whole
+chunk are scored in one go.
+"""
+
+DEFAULT_CHUNKSIZE = 64
+
+# set in each worker by init_worker
+_matcher = None
+_lowercase = False
+
+
+def worker_count(workers = None):
+    if workers is None:
+        workers = os.getenv("PROCESSOR_WORKERS")
+    if workers:
+        return max(1, int(workers))
+    return max(1, cpu_count() - 1)
+
+
+def chunk_size(chunksize = None):
+    if chunksize is None:
+        chunksize = os.getenv("PROCESSOR_CHUNKSIZE") or DEFAULT_CHUNKSIZE
+    return max(1, int(chunksize))
+
+
+def init_worker(ticker_set):
+    # runs once in every worker, the matcher is then reused for every task this worker gets
+    global _matcher, _lowercase
+    _matcher = TickerMatcher(frozenset(ticker_set), classifier=open_classifier())
+    # lowercase tickers are only looked for when there is a model to tell them from words
+    _lowercase = _matcher.classifier is not None
+
+
+def match_comment(text):
+    return _matcher.mentions(text or "", allow_lowercase=_lowercase)
+
+
+def match_post(text):
+    return _matcher.mentions(text or "", allow_lowercase=_lowercase, post=True)
+
+
+def match_comments(texts):
+    return _matcher.mentions_many(texts, allow_lowercase=_lowercase)
+
+
+def match_posts(texts):
+    return _matcher.mentions_many(texts, allow_lowercase=_lowercase, post=True)
+
+
+# the task that runs a per text function over a chunk of texts
+Chunked = {"match_comment": match_comments, "match_post": match_posts}
+
+
+def timed(fn, text):
+    # fn's result and the seconds the worker spent on it, only used when the run has metrics
+    start = time.perf_counter()
+    return fn(text), time.perf_counter() - start
+
+
+def start_pool(ticker_set, workers = None):
+    """
+    Starts the pool for a run, use it as a context manager so the workers are cleaned up
+    Args:
+        ticker_set: the ticker universe, sent to each worker once
+        workers: number of processes, defaults to PROCESSOR_WORKERS or cpu_count()-1
+    Returns:
+        multiprocessing Pool
+    """
+    return Pool(processes=worker_count(workers), initializer=init_worker, initargs=(ticker_set,))
+
+
+def fetch_batches(curr, batchSize, stats = None):
+    # fetchmany until the cursor is empty
+    while True:
+        start = time.perf_counter()
+        rows = curr.fetchmany(batchSize)
+        if stats:
+            stats.add("fetch", len(rows), time.perf_counter() - start)
+        if not rows:
+            return
+        yield rows
+
+
+def match_batches(pool, batches, fn, text_index, chunksize = None, stats = None, cache = None):
+    """
+    Streams batches of rows through the pool with imap
+    The next batch is fetched while the workers are still matching the current one
+    Args:
+        pool: pool from start_pool
+        batches: iterable of lists of rows
+        fn: match_comment or match_post
+        text_index: position of the text in each row
+        chunksize: rows per task sent to a worker, a task is matched with Chunked[fn.__name__]
+        stats: optional StageStats
+        cache: extract_cache.ExtractionCache for the pool's universe, only texts it does not have go to the workers
+            and each of those once per batch
+    Yields:
+        (rows, results) with results[i] the matches for rows[i]
+    """
+    chunksize = chunk_size(chunksize)
+    metrics = stats.metrics if stats else None
+    task = Chunked[fn.__name__]
+    if metrics is not None:
+        metrics.set("processor_pool_workers", pool._processes)
+        task = partial(timed, task)
+    pending = None
+    for rows in batches:
+        texts = [r[text_index] for r in rows]
+        if cache is None:
+            if metrics is not None:
+                metrics.adjust("processor_pool_pending_rows", len(texts))
+            job = (rows, pool.imap(task, _chunks(texts, chunksize)), None)
+        else:
+            start = time.perf_counter()
+            keys, results = cache.lookup(fn.__name__, texts)
+            todo = {}
+            for i, value in enumerate(results):
+                if value is MISSING:
+                    todo.setdefault(keys[i], []).append(i)
+            misses = [texts[positions[0]] for positions in todo.values()]
+            if stats:
+                stats.add("cache", len(rows), time.perf_counter() - start)
+            if metrics is not None:
+                metrics.adjust("processor_pool_pending_rows", len(misses))
+            job = (rows, pool.imap(task, _chunks(misses, chunksize)), (results, todo, cache))
+        if pending:
+            yield _collect(pending, stats)
+        pending = job
+    if pending:
+        yield _collect(pending, stats)
+
+
+def _chunks(texts, chunksize):
+    return [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+
+
+def _collect(job, stats):
+    rows, results, cached = job
+    start = time.perf_counter()
+    results = list(results)
+    metrics = stats.metrics if stats else None
+    if metrics is not None:
+        metrics.inc("processor_pool_busy_seconds_total", sum(seconds for _, seconds in results))
+        results = [value for value, _ in results]
+    results = [value for chunk in results for value in chunk]
+    if metrics is not None:
+        metrics.adjust("processor_pool_pending_rows", -len(results))
+    if cached is not None:
+        matched = results
+        results, todo, cache = cached
+        new = []
+        for (key, positions), value in zip(todo.items(), matched):
+            for i in positions:
+                results[i] = value
+            new.append((key, value))
+        cache.put_many(new)
+    if stats:
+        stats.add("match", len(rows), time.perf_counter() - start)
+    return rows, results
+
+
+class StageStats:
+    """
+    Rows and seconds spent in each stage of a run, printed at the end so the pool can be sized for a host
+    match time is time spent waiting on the workers, so it drops as workers are added until another stage is the limit
+    metrics: metrics.Metrics the stages, mentions and errors also report into, None when instrumentation is off
+    """
+
+    def __init__(self, metrics = None):
+        self.rows = {}
+        self.seconds = {}
+        self.started = time.perf_counter()
+        self.metrics = metrics
+
+    def add(self, stage, rows, seconds):
+        self.rows[stage] = self.rows.get(stage, 0) + rows
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        if self.metrics is not None:
+            self.metrics.stage(stage, rows, seconds)
+
+    def mentions(self, source, batch):
+        # source: "comment" or "post", batch: a mentions.MentionBatch
+        if self.metrics is not None:
+            self.metrics.mentions(source, batch)
+
+    def error(self, stage, exc):
+        if self.metrics is not None:
+            self.metrics.error(stage, exc)
+
+    def count(self, name, value = 1, **labels):
+        # any other counter, eg: shards by outcome
+        if self.metrics is not None:
+            self.metrics.inc(name, value, **labels)
+
+    def finish(self, scorer = None, cache = None, export = True):
+        # records the cache counters and exports the run's metrics, see metrics.Metrics.finish
+        if self.metrics is not None:
+            self.metrics.finish(scorer, cache, export)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        lines = [f"run took {elapsed:.2f}s"]
+        for stage, seconds in self.seconds.items():
+            rows = self.rows[stage]
+            rate = rows / seconds if seconds else float("inf")
+            lines.append(f"  {stage:<10} {rows:>10} rows {seconds:>8.2f}s {rate:>12,.0f} rows/sec")
+        return "\n".join(lines)
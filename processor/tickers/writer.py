@@ -0,0 +1,173 @@
+import csv
+import io
+import time
+from pathlib import Path
+from mentions import Kinds
+
+"""Bulk writer for comment_tickers and post_tickers
+Matches are buffered and every page_size rows they are sent with COPY FROM STDIN into a temp staging table, then moved
+across with one INSERT ... SELECT ... ON CONFLICT DO NOTHING and committed, so a page is one round trip and one
+transaction instead of one statement per match.
+add_comments can be handed straight to tickers.process_db as the sink so the results are never all held in memory.
+"""
+
+Queries = Path(__file__).resolve().parent.parent / "queries"
+
+Comment_Columns = ("comment_id", "parent_id", "post_id", "ticker", "detected_by", "confidence", "context_snippet",
+                   "inferred_from_id", "author", "created_utc", "sentiment_real", "universe_version")
+Post_Columns = ("post_id", "ticker", "detected_by", "confidence", "body", "author", "created_utc", "sentiment_real",
+                "universe_version")
+
+Columns = {"comment_tickers": Comment_Columns, "post_tickers": Post_Columns}
+
+# the staging tables are per session and emptied on every commit
+# only the copied columns and no defaults, id and xact are filled in by the insert into the real table
+Create_Stage = """
+CREATE TEMP TABLE IF NOT EXISTS {table}_stage ON COMMIT DELETE ROWS AS SELECT {columns} FROM {table} WITH NO DATA;
+"""
+
+# the id default is taken before the conflict check, rows already in the table are left out first so a run over
+# the same comments again does not use up sequence values, the ON CONFLICT is for a concurrent writer
+Move_Stage = """
+INSERT INTO {table} ({columns})
+SELECT {columns} FROM {table}_stage s
+WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE ({conflict}) = ({staged}))
+ON CONFLICT ({conflict}) DO NOTHING;
+"""
+
+
+def clean(text):
+    # postgres text can not hold NUL
+    return text.replace("\x00", "") if text else text
+
+
+def comment_rows(batch, universe = None):
+    # one row per mention of a MentionBatch of comments, in Comment_Columns order
+    for i, doc in enumerate(batch.doc):
+        comment_id, parent_id, post_id, author, created_utc = batch.docs[doc]
+        yield (comment_id, parent_id, post_id, batch.ticker[i], Kinds[batch.kind[i]], batch.score[i],
+               clean(batch.snippet_text(i)), batch.inferred_from[i], author, created_utc, batch.doc_sentiment(doc), universe)
+
+
+def post_rows(batch, universe = None):
+    # one row per mention of a MentionBatch of posts, in Post_Columns order
+    for i, doc in enumerate(batch.doc):
+        post_id, author, created_utc = batch.docs[doc]
+        yield (post_id, batch.ticker[i], Kinds[batch.kind[i]], batch.score[i], clean(batch.snippet_text(i)), author,
+               created_utc, batch.doc_sentiment(doc), universe)
+
+
+class TickerWriter:
+    """
+    conn: psycopg2 connection, the writer commits it after every page
+    page_size: rows per COPY and per transaction
+    create_tables: run the DDL in processor/queries first
+    commit_pages: commit after every page, turn off when the caller commits the writes together with other work
+    universe: version of the ticker universe the matches came from, stored with every row
+    stats: workers.StageStats, each page written is reported as the write stage
+    Use as a context manager so the last partial page is flushed
+    """
+
+    def __init__(self, conn, page_size = 5000, create_tables = True, commit_pages = True, universe = None, stats = None):
+        self.conn = conn
+        self.stats = stats
+        self.universe = universe
+        self.page_size = page_size
+        self.commit_pages = commit_pages
+        self.pending = {"comment_tickers": [], "post_tickers": []}
+        self.written = {"comment_tickers": 0, "post_tickers": 0}
+        self.seconds = 0.0
+
+        with conn.cursor() as curr:
+            if create_tables:
+                curr.execute((Queries / "post_tickers.sql").read_text())
+                curr.execute((Queries / "comment_tickers.sql").read_text())
+            for table in self.pending:
+                curr.execute(Create_Stage.format(table=table, columns=", ".join(Columns[table])))
+        conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.conn.rollback()
+
+    def add_comments(self, batch):
+        # a MentionBatch of comments
+        for row in comment_rows(batch, self.universe):
+            self._add("comment_tickers", row)
+
+    def add_posts(self, batch):
+        # a MentionBatch of posts
+        for row in post_rows(batch, self.universe):
+            self._add("post_tickers", row)
+
+    def _add(self, table, row):
+        rows = self.pending[table]
+        rows.append(row)
+        if len(rows) >= self.page_size:
+            self._write(table)
+
+    def flush(self):
+        for table in self.pending:
+            self._write(table)
+
+    def commit(self):
+        # writes what is buffered and commits it with anything else done on the connection
+        for table in self.pending:
+            self._write(table, commit=False)
+        self.conn.commit()
+
+    def discard(self):
+        # drops what is buffered, the caller rolls back any pages already written in the transaction
+        for rows in self.pending.values():
+            rows.clear()
+
+    def _write(self, table, commit = None):
+        rows = self.pending[table]
+        if not rows:
+            return
+        if table == "comment_tickers":
+            columns, conflict = Comment_Columns, "comment_id, ticker"
+        else:
+            columns, conflict = Post_Columns, "post_id, ticker"
+
+        if commit is None:
+            commit = self.commit_pages
+
+        start = time.perf_counter()
+        # csv.writer does the quoting in C, None and "" both come out as an unquoted empty field which COPY reads as NULL
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        buffer.seek(0)
+
+        names = ", ".join(columns)
+        try:
+            with self.conn.cursor() as curr:
+                # pages written without a commit in between would otherwise still be in the stage
+                curr.execute(f"TRUNCATE {table}_stage")
+                curr.copy_expert(f"COPY {table}_stage ({names}) FROM STDIN WITH (FORMAT csv)", buffer)
+                staged = ", ".join(f"s.{c.strip()}" for c in conflict.split(","))
+                curr.execute(Move_Stage.format(table=table, columns=names, conflict=conflict, staged=staged))
+            if commit:
+                self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            if self.stats:
+                self.stats.error("write", e)
+            raise
+
+        seconds = time.perf_counter() - start
+        self.written[table] += len(rows)
+        self.seconds += seconds
+        if self.stats:
+            self.stats.add("write", len(rows), seconds)
+        rows.clear()
+
+    def report(self):
+        total = sum(self.written.values())
+        rate = total / self.seconds if self.seconds else 0.0
+        return f"wrote {self.written['comment_tickers']} comment and {self.written['post_tickers']} post matches, {rate:,.0f} rows/sec"
@@ -0,0 +1,96 @@
+// Collection cycle against scripts/mock_reddit.js, no credentials, network or database needed.
+// Runs the collector twice over the same mock subreddits:
+//   sequential   one post at a time, the old loop without its 2 s sleep (the sleep is added to the estimate)
+//   concurrent   SCRAPER_CONCURRENCY posts at a time across all subreddits
+// and then once more against a mock with a small quota to check the token bucket keeps under it.
+// Both runs have to hand over the same comments, each post's comments with every parent before its replies, and no
+// run may see a 429. Exits non zero otherwise.
+//
+// Usage: node scripts/bench_collect.js [subreddits] [posts] [comments per post] [latency ms]
+
+// the scraper checks for these, the mock takes any credentials
+for (const k of ['USER_AGENT', 'CLIENT_ID', 'CLIENT_SECRET', 'REDDIT_USER', 'REDDIT_PASS',
+                 'DB_USER', 'DB_HOST', 'DB_NAME', 'DB_PASSWORD', 'DB_PORT']) {
+    if (!process.env[k]) process.env[k] = k === 'DB_PORT' ? '5432' : 'bench';
+}
+
+const { startMockReddit } = require('./mock_reddit');
+const { collect } = require('../src/scraper/scraper');
+const { RedditClient } = require('../src/scraper/reddit');
+const { TokenBucket } = require('../src/scraper/ratelimit');
+
+// the old loop slept this long after every post
+const LegacySleep = 2000;
+
+async function run(mock, subreddits, posts, concurrency, burst = 30) {
+    const client = new RedditClient({ apiUrl: mock.url, authUrl: mock.authUrl, limiter: new TokenBucket({ burst }) });
+    const ids = new Set();
+    let flushes = 0;
+    let firstFlush = null;
+    let ordered = true;
+    let duplicates = 0;
+    const start = Date.now();
+
+    const counts = await collect(subreddits, posts, {
+        client,
+        concurrency,
+        onComments: async (comments) => {
+            if (firstFlush === null) firstFlush = Date.now() - start;
+            flushes++;
+            const position = new Map(comments.map((c, i) => [c.id, i]));
+            comments.forEach((c, i) => {
+                // a reply never comes before its parent within a post
+                const parent = position.get(c.parent_id.slice(3));
+                if (c.parent_id.startsWith('t1_') && parent !== undefined && parent > i) ordered = false;
+                if (ids.has(c.id)) duplicates++;
+                ids.add(c.id);
+            });
+        }
+    });
+    return { ...counts, ids, flushes, firstFlush, ordered, duplicates, seconds: (Date.now() - start) / 1000, client };
+}
+
+function same(a, b) {
+    return a.size === b.size && [...a].every(id => b.has(id));
+}
+
+async function main() {
+    const [subredditCount = 3, posts = 10, commentsPerPost = 300, latency = 150] = process.argv.slice(2).map(Number);
+    const subreddits = Array.from({ length: subredditCount }, (_, i) => `sub${i}`);
+    let failed = false;
+
+    const mock = await startMockReddit({ posts, commentsPerPost, latency });
+    const results = {};
+    for (const [name, concurrency] of [['sequential', 1], ['concurrent', parseInt(process.env.SCRAPER_CONCURRENCY || '8', 10)]]) {
+        mock.stats.limited = 0;
+        mock.stats.maxInFlight = 0;
+        const r = results[name] = await run(mock, subreddits, posts, concurrency);
+        const legacy = name === 'sequential' ? ` (${(r.seconds + r.posts * LegacySleep / 1000).toFixed(1)} s with the old sleep)` : '';
+        console.log(`${name.padEnd(11)} ${r.posts} posts ${r.comments} comments in ${r.seconds.toFixed(2)} s${legacy}, ` +
+            `${r.client.requests} requests, ${mock.stats.maxInFlight} at once, first flush after ${r.firstFlush} ms, ` +
+            `${r.flushes} flushes, ${mock.stats.limited} rate limited`);
+        failed ||= !r.ordered || r.duplicates > 0 || mock.stats.limited > 0;
+    }
+    await mock.close();
+    const speedup = (results.sequential.seconds + results.sequential.posts * LegacySleep / 1000) / results.concurrent.seconds;
+    console.log(`concurrent cycle is ${speedup.toFixed(1)}x faster than the old loop`);
+    failed ||= !same(results.sequential.ids, results.concurrent.ids);
+
+    // a quota the cycle cannot fit into: the bucket has to wait for the window to reset instead of running into 429s
+    const tight = await startMockReddit({ posts, commentsPerPost, latency: 20, quota: 40, window: 5 });
+    const r = await run(tight, subreddits, posts, 8, 10);
+    console.log(`quota 40/5s ${r.posts} posts ${r.comments} comments in ${r.seconds.toFixed(2)} s, ${r.client.requests} requests, ` +
+        `${r.client.limiter.pauses} pauses, ${tight.stats.limited} rate limited`);
+    failed ||= tight.stats.limited > 0 || !same(r.ids, results.sequential.ids);
+    await tight.close();
+
+    if (failed) {
+        console.error('MISMATCH: collections differ, came out of order or ran into the rate limit');
+        process.exit(1);
+    }
+}
+
+main().catch(err => {
+    console.error(err);
+    process.exit(1);
+});
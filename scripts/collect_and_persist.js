@@ -6,34 +6,23 @@ require('../src/envCheck');
 
 const pool = require('../src/db/connection')
 const { batchUpsertPosts, batchUpsertComments} = require('../src/db/persist');
-const {fetchPostsAndComments} = require('../src/scraper/scraper');
+const {collect} = require('../src/scraper/scraper');
 
 
-async function runCollection(subreddit = "pennystocks", limit = 10, postChunkSize = 50, commentChunkSize = 200){
+// Posts and comments are written as they arrive: the posts of a subreddit once its listing is in, the comments of a
+// post as soon as they are fetched. A failed cycle keeps everything written before the failure, the upserts make the
+// next cycle idempotent.
+async function runCollection(subreddit = (process.env.SUBREDDITS || "pennystocks").split(",").map(s => s.trim()), limit = 10, postChunkSize = 50, commentChunkSize = 200){
     console.log("Starting collection process: ", new Date().toISOString())
+    const start = Date.now();
     try{
-        const results = await fetchPostsAndComments(subreddit, limit);
+        const results = await collect(subreddit, limit, {
+            onPosts: (posts) => batchUpsertPosts(posts, postChunkSize),
+            onComments: (comments) => batchUpsertComments(comments, commentChunkSize)
+        });
 
-        console.log(`Fetched posts: ${results.posts.length}\n Fetched Comments ${results.comments.length}`)
-        
-        if(results.posts.length> 0){
-            console.log(`Persisting posts in chunks of ${postChunkSize}...`);
-            await batchUpsertPosts(results.posts, postChunkSize);
-            console.log('✅ Posts persisted');
-        } else{
-            console.log('No posts to persist')
-        }
-
-        if (results.posts.length > 0){
-            console.log(`Persisting comments in chunks of ${commentChunkSize}...`);
-            await batchUpsertComments(results.comments, commentChunkSize);
-            console.log('✅ Comments persisted');
-        } else{
-            console.log('No comments to persist.')
-        }
-        // const p = await pool.query('SELECT *FROM posts')
-        // console.log('post rows:', p.rows);
-        console.log('Collection run finished: ', new Date().toISOString())
+        console.log(`Persisted posts: ${results.posts}\n Persisted Comments ${results.comments}`)
+        console.log(`Collection run finished in ${((Date.now() - start) / 1000).toFixed(1)}s: `, new Date().toISOString())
     }catch(err) {
         console.error('Collection Run failed', err);
         throw err;
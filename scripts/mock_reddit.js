@@ -0,0 +1,200 @@
+// Local stand-in for the Reddit API, for running the collector without credentials or network.
+// Serves the endpoints the scraper uses with generated subreddits, posts and comment trees:
+//   POST /api/v1/access_token   password grant, any credentials
+//   GET  /r/:subreddit/hot      listing of `posts` posts
+//   GET  /comments/:id          [post listing, comment listing], deep replies and the tail of the top level comments
+//                               are left behind "more" stubs like Reddit does
+//   GET  /api/morechildren      the comments behind a stub, flat, in tree order
+// Every response carries x-ratelimit-used / -remaining / -reset for a fixed window of `quota` requests, a request
+// over the quota gets a 429. `latency` ms is added to every response.
+//
+// Usage: node scripts/mock_reddit.js [port]
+//   then REDDIT_API_URL=http://localhost:<port> REDDIT_AUTH_URL=http://localhost:<port>/api/v1/access_token
+
+const http = require('http');
+
+// small seeded generator so a tree is the same on every request
+function mulberry32(seed) {
+    return () => {
+        seed = (seed + 0x6D2B79F5) | 0;
+        let t = Math.imul(seed ^ (seed >>> 15), 1 | seed);
+        t = (t + Math.imul(t ^ (t >>> 7), 61 | t)) ^ t;
+        return ((t ^ (t >>> 14)) >>> 0) / 4294967296;
+    };
+}
+
+function hash(text) {
+    let h = 2166136261;
+    for (let i = 0; i < text.length; i++) h = Math.imul(h ^ text.charCodeAt(i), 16777619);
+    return h >>> 0;
+}
+
+const Words = ['GME', '$AMC', 'to the moon', 'bought more', 'puts', 'calls', 'earnings', 'dilution', 'bagholder', 'DD'];
+
+/**
+ * Comment tree of a post, every comment is { id, parent, depth, children, data }
+ */
+function buildTree(postId, commentsPerPost) {
+    const rand = mulberry32(hash(postId));
+    const byId = new Map();
+    const all = [];
+    const roots = [];
+    for (let i = 0; i < commentsPerPost; i++) {
+        // a third of the comments start a thread, the rest reply to an earlier comment
+        const parent = i === 0 || rand() < 0.33 ? null : all[Math.floor(rand() * all.length)];
+        const id = `${postId}c${i}`;
+        const depth = parent ? parent.depth + 1 : 0;
+        const author = rand() < 0.05 ? '[deleted]' : `user${Math.floor(rand() * 500)}`;
+        const body = rand() < 0.02 ? 'I am a bot, this action was performed automatically.'
+            : Array.from({ length: 3 + Math.floor(rand() * 12) }, () => Words[Math.floor(rand() * Words.length)]).join(' ');
+        const node = {
+            id, parent, depth, children: [],
+            data: {
+                id, name: `t1_${id}`, body, author, score: Math.floor(rand() * 100),
+                created_utc: 1700000000 + i * 60, link_id: `t3_${postId}`,
+                parent_id: parent ? `t1_${parent.id}` : `t3_${postId}`, depth
+            }
+        };
+        byId.set(id, node);
+        all.push(node);
+        (parent ? parent.children : roots).push(node);
+    }
+    return { roots, byId };
+}
+
+function more(nodes, parentName, depth) {
+    return { kind: 'more', data: { count: nodes.length, children: nodes.map(n => n.id), parent_id: parentName, depth } };
+}
+
+// listing the way /comments/:id returns it, `shown` top level comments and replies down to `maxDepth`
+function listing(nodes, shown, maxDepth, parentName) {
+    const children = nodes.slice(0, shown).map(node => ({
+        kind: 't1',
+        data: {
+            ...node.data,
+            replies: node.children.length === 0 ? ''
+                : node.depth + 1 > maxDepth
+                    ? { kind: 'Listing', data: { children: [more(node.children, node.data.name, node.depth + 1)] } }
+                    : { kind: 'Listing', data: listing(node.children, 5, maxDepth, node.data.name) }
+        }
+    }));
+    if (nodes.length > shown) children.push(more(nodes.slice(shown), parentName, nodes[0].depth));
+    return { children };
+}
+
+/**
+ * @param {Object} options
+ * @param {number} options.port - 0 picks a free one
+ * @param {number} options.posts - hot posts per subreddit
+ * @param {number} options.commentsPerPost
+ * @param {number} options.latency - ms added to every response
+ * @param {number} options.quota - requests per window
+ * @param {number} options.window - window length in seconds
+ * @returns {Promise<{url, authUrl, stats, close}>}
+ */
+function startMockReddit({ port = 0, posts = 10, commentsPerPost = 200, latency = 100, quota = 600, window = 600 } = {}) {
+    const stats = { requests: 0, limited: 0, inFlight: 0, maxInFlight: 0, byPath: {} };
+    const trees = new Map();
+    let windowStart = Date.now();
+    let used = 0;
+
+    const tree = (postId) => {
+        if (!trees.has(postId)) trees.set(postId, buildTree(postId, commentsPerPost));
+        return trees.get(postId);
+    };
+
+    const server = http.createServer((req, res) => {
+        const url = new URL(req.url, 'http://localhost');
+        const send = (status, body) => {
+            const now = Date.now();
+            if (now - windowStart >= window * 1000) {
+                windowStart = now;
+                used = 0;
+            }
+            const counted = url.pathname !== '/api/v1/access_token';
+            let code = status;
+            if (counted) {
+                used++;
+                if (used > quota) {
+                    code = 429;
+                    stats.limited++;
+                    body = { message: 'Too Many Requests', error: 429 };
+                }
+            }
+            const reset = Math.max(0, Math.ceil((windowStart + window * 1000 - now) / 1000));
+            stats.inFlight++;
+            stats.maxInFlight = Math.max(stats.maxInFlight, stats.inFlight);
+            setTimeout(() => {
+                stats.inFlight--;
+                res.writeHead(code, {
+                    'Content-Type': 'application/json',
+                    'x-ratelimit-used': String(used),
+                    'x-ratelimit-remaining': String(Math.max(0, quota - used).toFixed(1)),
+                    'x-ratelimit-reset': String(reset)
+                });
+                res.end(JSON.stringify(body));
+            }, latency);
+        };
+
+        const route = url.pathname.replace(/^\/r\/[^/]+\/hot$/, '/r/:subreddit/hot').replace(/^\/comments\/[^/]+$/, '/comments/:id');
+        stats.requests++;
+        stats.byPath[route] = (stats.byPath[route] || 0) + 1;
+
+        if (req.method === 'POST' && url.pathname === '/api/v1/access_token') {
+            return send(200, { access_token: 'mock-token', token_type: 'bearer', expires_in: 3600, scope: '*' });
+        }
+        if (req.headers.authorization !== 'bearer mock-token') return send(401, { message: 'Unauthorized', error: 401 });
+
+        let m;
+        if ((m = url.pathname.match(/^\/r\/([^/]+)\/hot$/))) {
+            const limit = Math.min(parseInt(url.searchParams.get('limit') || '25', 10), posts);
+            const children = Array.from({ length: limit }, (_, i) => ({
+                kind: 't3',
+                data: {
+                    id: `${m[1]}${i}`, name: `t3_${m[1]}${i}`, subreddit: m[1], title: `$GME post ${i} in ${m[1]}`,
+                    selftext: 'what do you think', author: `op${i}`, created_utc: 1700000000 + i, score: i
+                }
+            }));
+            return send(200, { kind: 'Listing', data: { children, after: null } });
+        }
+        if ((m = url.pathname.match(/^\/comments\/([^/]+)$/))) {
+            const { roots } = tree(m[1]);
+            return send(200, [
+                { kind: 'Listing', data: { children: [{ kind: 't3', data: { id: m[1], name: `t3_${m[1]}` } }] } },
+                { kind: 'Listing', data: roots.length ? listing(roots, 20, 4, `t3_${m[1]}`) : { children: [] } }
+            ]);
+        }
+        if (url.pathname === '/api/morechildren') {
+            const { byId } = tree(url.searchParams.get('link_id').replace(/^t3_/, ''));
+            const things = [];
+            // the requested comments and everything under them, flat and in tree order
+            const stack = url.searchParams.get('children').split(',').map(id => byId.get(id)).filter(Boolean).reverse();
+            while (stack.length > 0) {
+                const node = stack.pop();
+                things.push({ kind: 't1', data: { ...node.data, replies: '' } });
+                for (let i = node.children.length - 1; i >= 0; i--) stack.push(node.children[i]);
+            }
+            return send(200, { json: { errors: [], data: { things } } });
+        }
+        send(404, { message: 'Not Found', error: 404 });
+    });
+
+    return new Promise(resolve => server.listen(port, '127.0.0.1', () => {
+        const url = `http://127.0.0.1:${server.address().port}`;
+        resolve({
+            url,
+            authUrl: `${url}/api/v1/access_token`,
+            stats,
+            close: () => new Promise(done => server.close(done))
+        });
+    }));
+}
+
+module.exports = { startMockReddit };
+
+if (require.main === module) {
+    startMockReddit({ port: parseInt(process.argv[2] || '8765', 10) }).then(mock => {
+        console.log(`Mock Reddit API on ${mock.url}`);
+        console.log(`REDDIT_API_URL=${mock.url} REDDIT_AUTH_URL=${mock.authUrl}`);
+    });
+}
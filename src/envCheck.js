@@ -3,7 +3,7 @@
 // Require this at the top of any script that needs env vars (scraper, db setup, etc).
 
 const required = [
-  // Reddit / Snoowrap
+  // Reddit OAuth (password grant)
   'USER_AGENT',
   'CLIENT_ID',
   'CLIENT_SECRET',
@@ -0,0 +1,107 @@
+// Token bucket for the Reddit API, driven by the rate-limit headers of every response.
+//
+// Reddit sends three headers with each OAuth response:
+//   x-ratelimit-used       requests made in the current window
+//   x-ratelimit-remaining  requests left in the current window
+//   x-ratelimit-reset      seconds until the window resets
+// What is left of the window above a reserve (a share of the window's quota) can be spent straight away, a collection
+// cycle is a short burst well inside the quota. Once down to the reserve the bucket refills at remaining / reset per
+// second, so the rest of the window is spread evenly over the time left instead of running into a 429, and when the
+// window is used up nothing goes out until it resets. Requests that are already in flight were counted by the limiter
+// but not yet by Reddit, they are taken off the remaining count it reports.
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+class TokenBucket {
+    /**
+     * @param {Object} options
+     * @param {number} options.rate - requests per second before the first response (Reddit allows 100 a minute)
+     * @param {number} options.burst - tokens before the first response, and the most the bucket holds once at the reserve
+     * @param {number} options.reserve - share of the window's quota that is only spent at the even rate
+     * @param {Function} options.now - clock in ms, for tests
+     */
+    constructor({ rate = 100 / 60, burst = 30, reserve = 0.2, now = Date.now } = {}) {
+        this.rate = rate;
+        this.burst = burst;
+        this.capacity = burst;
+        this.reserve = reserve;
+        this.now = now;
+        this.tokens = burst;
+        this.updated = now();
+        this.pausedUntil = 0;
+        this.inFlight = 0;
+        this.waited = 0;     // ms spent waiting for a token, summed over requests
+        this.pauses = 0;     // times the window ran out or Reddit answered 429
+    }
+
+    refill() {
+        const now = this.now();
+        this.tokens = Math.min(this.capacity, this.tokens + (now - this.updated) / 1000 * this.rate);
+        this.updated = now;
+    }
+
+    // resolves once a request may be sent, every call has to be matched by a done()
+    async take() {
+        const start = this.now();
+        for (;;) {
+            const paused = this.pausedUntil - this.now();
+            if (paused > 0) {
+                await sleep(paused);
+                continue;
+            }
+            if (this.pausedUntil) {
+                // the window has reset, one request goes out and its headers set the new rate
+                this.pausedUntil = 0;
+                this.tokens = 1;
+                this.updated = this.now();
+            }
+            this.refill();
+            if (this.tokens >= 1) {
+                this.tokens -= 1;
+                this.inFlight += 1;
+                this.waited += this.now() - start;
+                return;
+            }
+            // capped so a waiter picks up a new rate from done() without sleeping out the old one
+            await sleep(Math.min(250, Math.max(1, (1 - this.tokens) / this.rate * 1000)));
+        }
+    }
+
+    /**
+     * Called with the headers of each response (also 429s)
+     * @param {Headers} headers - fetch response headers
+     */
+    done(headers) {
+        this.inFlight = Math.max(0, this.inFlight - 1);
+        if (!headers) return;
+        const used = parseFloat(headers.get('x-ratelimit-used'));
+        const remaining = parseFloat(headers.get('x-ratelimit-remaining'));
+        const reset = parseFloat(headers.get('x-ratelimit-reset'));
+        if (Number.isNaN(remaining) || Number.isNaN(reset)) return;
+
+        this.refill();
+        const left = remaining - this.inFlight;
+        if (left < 1) {
+            // window is used up, nothing goes out until it resets
+            this.pause(reset);
+            return;
+        }
+        this.rate = left / Math.max(reset, 1);
+        const spare = left - this.reserve * ((Number.isNaN(used) ? 0 : used) + remaining);
+        this.capacity = Math.max(this.burst, spare);
+        this.tokens = Math.min(left, Math.max(this.tokens, spare));
+    }
+
+    // stop sending for the given seconds, after a 429 or an empty window
+    pause(seconds) {
+        const until = this.now() + Math.max(seconds, 1) * 1000;
+        if (until > this.pausedUntil) {
+            this.pausedUntil = until;
+            this.pauses += 1;
+        }
+        this.tokens = 0;
+        this.updated = this.now();
+    }
+}
+
+module.exports = { TokenBucket, sleep };
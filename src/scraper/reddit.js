@@ -0,0 +1,138 @@
+// Minimal Reddit OAuth client on top of fetch.
+// Every request goes through the token bucket and reports its rate-limit headers back to it. The base URLs come from
+// the environment so the collector can be pointed at scripts/mock_reddit.js:
+//   REDDIT_API_URL   default https://oauth.reddit.com
+//   REDDIT_AUTH_URL  default https://www.reddit.com/api/v1/access_token
+
+const { TokenBucket, sleep } = require('./ratelimit.js');
+
+class RedditError extends Error {
+    constructor(message, statusCode) {
+        super(message);
+        this.statusCode = statusCode;
+    }
+}
+
+class RedditClient {
+    /**
+     * @param {Object} options - credentials, base URLs and limiter, defaults from the environment
+     */
+    constructor({
+        userAgent = process.env.USER_AGENT,
+        clientId = process.env.CLIENT_ID,
+        clientSecret = process.env.CLIENT_SECRET,
+        username = process.env.REDDIT_USER,
+        password = process.env.REDDIT_PASS,
+        apiUrl = process.env.REDDIT_API_URL || 'https://oauth.reddit.com',
+        authUrl = process.env.REDDIT_AUTH_URL || 'https://www.reddit.com/api/v1/access_token',
+        limiter = new TokenBucket({ burst: parseInt(process.env.SCRAPER_BURST || '30', 10) }),
+        maxRetries = 5,
+        retryDelay = 2000
+    } = {}) {
+        Object.assign(this, { userAgent, clientId, clientSecret, username, password, apiUrl, authUrl, limiter, maxRetries, retryDelay });
+        this.token = null;
+        this.tokenExpires = 0;
+        this.tokenRequest = null;
+        this.requests = 0;
+        this.retries = 0;
+    }
+
+    // one token request at a time, the concurrent callers share it
+    async accessToken() {
+        if (this.token && Date.now() < this.tokenExpires) return this.token;
+        if (!this.tokenRequest) {
+            this.tokenRequest = (async () => {
+                const res = await fetch(this.authUrl, {
+                    method: 'POST',
+                    headers: {
+                        'Authorization': 'Basic ' + Buffer.from(`${this.clientId}:${this.clientSecret}`).toString('base64'),
+                        'Content-Type': 'application/x-www-form-urlencoded',
+                        'User-Agent': this.userAgent
+                    },
+                    body: new URLSearchParams({ grant_type: 'password', username: this.username, password: this.password })
+                });
+                if (!res.ok) throw new RedditError(`Access token request failed: ${res.status}`, res.status);
+                const body = await res.json();
+                this.token = body.access_token;
+                // renewed a minute early so a request never goes out with an expired token
+                this.tokenExpires = Date.now() + (body.expires_in - 60) * 1000;
+                return this.token;
+            })().finally(() => { this.tokenRequest = null; });
+        }
+        return this.tokenRequest;
+    }
+
+    /**
+     * GET an API path, retrying 429s, 5xx and network errors with exponential backoff
+     * @param {string} path - e.g. /r/pennystocks/hot
+     * @param {Object} params - query string
+     * @returns {Promise<Object>} parsed JSON
+     */
+    async get(path, params = {}) {
+        const url = new URL(this.apiUrl + path);
+        for (const [k, v] of Object.entries({ ...params, raw_json: 1 })) url.searchParams.set(k, v);
+
+        for (let attempt = 0; ; attempt++) {
+            const token = await this.accessToken();
+            await this.limiter.take();
+            let res;
+            try {
+                res = await fetch(url, { headers: { 'Authorization': `bearer ${token}`, 'User-Agent': this.userAgent } });
+            } catch (err) {
+                this.limiter.done(null);
+                if (attempt >= this.maxRetries) throw err;
+                await this.backoff(attempt, `${err.message}`);
+                continue;
+            }
+            this.requests++;
+            this.limiter.done(res.headers);
+
+            if (res.ok) return res.json();
+            await res.body?.cancel();
+            if (res.status === 401 && attempt < this.maxRetries) {
+                // token revoked or expired early
+                this.token = null;
+                continue;
+            }
+            if ((res.status === 429 || res.status >= 500) && attempt < this.maxRetries) {
+                if (res.status === 429) {
+                    // the headers say when the window resets, fall back to the backoff when they are missing
+                    const reset = parseFloat(res.headers.get('x-ratelimit-reset') ?? res.headers.get('retry-after'));
+                    this.limiter.pause(Number.isNaN(reset) ? this.retryDelay * Math.pow(2, attempt + 1) / 1000 : reset);
+                    console.warn(`Rate limit exceeded on ${path}. Retrying...`);
+                    this.retries++;
+                    continue;
+                }
+                await this.backoff(attempt, `status ${res.status}`);
+                continue;
+            }
+            throw new RedditError(`GET ${path} failed: ${res.status}`, res.status);
+        }
+    }
+
+    async backoff(attempt, reason) {
+        const delay = this.retryDelay * Math.pow(2, attempt);
+        console.warn(`Request failed (${reason}). Retrying in ${delay / 1000} seconds...`);
+        this.retries++;
+        await sleep(delay);
+    }
+
+    // hot posts of a subreddit, listing children data
+    async hot(subreddit, limit) {
+        const listing = await this.get(`/r/${subreddit}/hot`, { limit });
+        return listing.data.children.filter(child => child.kind === 't3').map(child => child.data);
+    }
+
+    // the comment tree of a post, [post listing, comment listing]
+    async comments(postId, params = {}) {
+        return this.get(`/comments/${postId}`, params);
+    }
+
+    // comments hidden behind "more" stubs, a flat list of things in tree order
+    async moreChildren(linkId, children) {
+        const body = await this.get('/api/morechildren', { api_type: 'json', link_id: linkId, children: children.join(',') });
+        return body.json.data.things;
+    }
+}
+
+module.exports = { RedditClient, RedditError };
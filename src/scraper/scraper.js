@@ -1,101 +1,141 @@
 require("dotenv").config();
 require('../envCheck');
-const Snoowrap = require("snoowrap");
-const { walkAndCollect } = require("./utils.js"); 
+const { RedditClient } = require("./reddit.js");
+const { walkAndCollect } = require("./utils.js");
 
-// Initialize Snoowrap with Reddit app credentials
-const r = new Snoowrap({
-    userAgent: process.env.USER_AGENT,
-    clientId: process.env.CLIENT_ID,
-    clientSecret: process.env.CLIENT_SECRET,
-    username: process.env.REDDIT_USER,
-    password: process.env.REDDIT_PASS
-});
+// Requests go out concurrently, paced by the token bucket in ratelimit.js instead of a fixed sleep after each post.
+// Posts of every subreddit share one pool of `concurrency` slots, and each post's comments are handed to the caller
+// as soon as they are fetched, so nothing waits for the whole cycle and memory stays at about one post per slot.
 
-// Main function to orchestrate everything
-
-async function fetchPostsAndComments(subreddit , max ) {
-    // This list is now local to the main function
-    let allCommentsCollected = []; 
-    const allPostsData = [];
-
-    const posts = await r.getSubreddit(subreddit).getHot({ limit: max });
+let defaultClient = null;
+function redditClient() {
+    if (!defaultClient) defaultClient = new RedditClient();
+    return defaultClient;
+}
 
-    for (const post of posts) {
-        // console.log("POST TITLE:\n ", post.title, "\n");
-        allPostsData.push({
-            id: post.id,
-            subreddit: post.subreddit.display_name,
-            title: post.title,
-            body: post.selftext,
-            author: post.author.name,
-            created_utc: post.created_utc,
-            score: post.score
+// runs at most `limit` of the given async functions at once
+function createLimit(limit) {
+    let active = 0;
+    const queue = [];
+    const next = () => {
+        if (active >= limit || queue.length === 0) return;
+        active++;
+        const { fn, resolve, reject } = queue.shift();
+        fn().then(resolve, reject).finally(() => {
+            active--;
+            next();
         });
+    };
+    return (fn) => new Promise((resolve, reject) => {
+        queue.push({ fn, resolve, reject });
+        next();
+    });
+}
 
-        // Await the comments and add them to our local list
-        const commentsFromThisPost = await fetchCommentsForPost(post.id);
-        //console.log(`Found ${commentsFromThisPost.length} comments for post ${post.id}`);
-        
-        // Use concat or the spread operator to add the new comments
-        allCommentsCollected = allCommentsCollected.concat(commentsFromThisPost);
+function toPost(post) {
+    return {
+        id: post.id,
+        subreddit: post.subreddit,
+        title: post.title,
+        body: post.selftext,
+        author: post.author,
+        created_utc: post.created_utc,
+        score: post.score
+    };
+}
 
-        // add a small delay to avoid hitting rate limits
-        await new Promise(resolve => setTimeout(resolve, 2000));
+// Fetches the comment tree of a post and flattens it.
+// The "more" stubs get the same budget expandReplies({ depth: 4, limit: 5 }) had: at most `limit` extra requests,
+// for stubs no deeper than `depth`.
+async function fetchCommentsForPost(postId, { client = redditClient(), depth = 4, limit = 5 } = {}) {
+    try {
+        const [, listing] = await client.comments(postId);
+        const comments = [];
+        const more = [];
+        walkAndCollect(listing.data.children, comments, more);
+
+        let requests = 0;
+        while (more.length > 0 && requests < limit) {
+            const stub = more.shift();
+            if (stub.depth > depth) continue;
+            // morechildren takes at most 100 ids
+            const things = await client.moreChildren(`t3_${postId}`, stub.children.slice(0, 100));
+            requests++;
+            walkAndCollect(things, comments, more);
+        }
+        return comments;
+    } catch (error) {
+        console.error(`Error fetching comments for post ${postId}:`, error.message);
+        return []; // Return empty array on errors, the next cycle picks the post up again
     }
-
-    // console.log("\n=== FINAL RESULTS ===");
-    // console.log("Total comments collected:", allCommentsCollected.length);
-    // console.log("Sample of first 3 comments:", allCommentsCollected.slice(0, 3));
-    
-  
-    return {posts: allPostsData, comments: allCommentsCollected};
 }
 
-// This function fetches comments and returns them.
-async function fetchCommentsForPost(postId) {
-    let retries = 0;
-    const maxRetries = 5;
-    const retryDelay = 2000; // 2 seconds, initial delay
-
-    while (retries < maxRetries) {
-        try {
-            const submission = await r.getSubmission(postId).fetch();
-
-            // Expand replies, to get a deeper comment tree, 4 levels deep, max 5 replies each
-            await submission.expandReplies({ depth: 4, limit: 5 });
-
-            // Recursive helper function to flatten the comment tree
-            const commentList = walkAndCollect(submission.comments);
-            
-            //console.log(`Returning ${commentList.length} comments from fetchCommentsForPost.`);
-            return commentList; // Return the result
-
-        } catch (error) {
+/**
+ * Collects the hot posts of several subreddits and their comments concurrently.
+ * @param {string|string[]} subreddits - one subreddit or a list
+ * @param {number} max - hot posts per subreddit
+ * @param {Object} options
+ * @param {Function} options.onPosts - async (posts), awaited before any comment of those posts is handed over
+ * @param {Function} options.onComments - async (comments, post), called once per post as soon as its comments arrive
+ * @param {number} options.concurrency - posts fetched at once across all subreddits (SCRAPER_CONCURRENCY, 8)
+ * @param {RedditClient} options.client
+ * @returns {Promise<{posts: number, comments: number}>} counts of what was handed over
+ */
+async function collect(subreddits, max, {
+    onPosts = async () => {},
+    onComments = async () => {},
+    concurrency = parseInt(process.env.SCRAPER_CONCURRENCY || '8', 10),
+    client = redditClient()
+} = {}) {
+    const limit = createLimit(concurrency);
+    const counts = { posts: 0, comments: 0 };
+    const list = Array.isArray(subreddits) ? subreddits : [subreddits];
+
+    const perSubreddit = list.map(async (subreddit) => {
+        const posts = (await limit(() => client.hot(subreddit, max))).map(toPost);
+        // posts are persisted first, comments reference them
+        await onPosts(posts);
+        counts.posts += posts.length;
+
+        // the flush happens inside the slot, a slow database holds back the fetching instead of piling up comments
+        const results = await Promise.allSettled(posts.map(post => limit(async () => {
+            const comments = await fetchCommentsForPost(post.id, { client });
+            if (comments.length > 0) await onComments(comments, post);
+            counts.comments += comments.length;
+        })));
+        const failed = results.find(r => r.status === 'rejected');
+        if (failed) throw failed.reason;
+    });
+
+    // every subreddit finishes its in-flight writes before an error is passed on
+    const results = await Promise.allSettled(perSubreddit);
+    const failed = results.find(r => r.status === 'rejected');
+    if (failed) throw failed.reason;
+    return counts;
+}
 
-            if (error.statusCode === 429) {
-                retries++;
-                const delay = retryDelay * Math.pow(2,retries); // Exponential backoff
-                console.warn(`Rate limit exceeded. Retrying in ${delay/1000} seconds...`)
-                await new Promise(resolve => setTimeout (resolve, delay))
-        } else{
-            console.error("Error fetching comments:", error);
-            return []; // Return empty array on other errors
-        }
-    }
-    
-    }
-    console.error("Max retries reached. Returning empty comment list.");
-    return []; // Return empty array if max retries reached
+// Main function, collects everything in memory and returns it
+async function fetchPostsAndComments(subreddit , max, options = {}) {
+    const allPostsData = [];
+    const allCommentsCollected = [];
+    await collect(subreddit, max, {
+        ...options,
+        onPosts: async (posts) => { allPostsData.push(...posts); },
+        onComments: async (comments) => { for (const c of comments) allCommentsCollected.push(c); }
+    });
+    return {posts: allPostsData, comments: allCommentsCollected};
 }
 
 // exports function
-module.exports = {fetchPostsAndComments};
+module.exports = {fetchPostsAndComments, fetchCommentsForPost, collect, createLimit};
 
-//runs code in terminal 
+//runs code in terminal
 if (require.main === module){
-    fetchPostsAndComments().catch(err =>{
+    const subreddits = (process.env.SUBREDDITS || 'pennystocks').split(',').map(s => s.trim()).filter(Boolean);
+    fetchPostsAndComments(subreddits, 10).then(results => {
+        console.log(`Fetched posts: ${results.posts.length}\n Fetched Comments ${results.comments.length}`);
+    }).catch(err =>{
         console.error("Error in fetchPostsAndComments: ",err);
         process.exit(1);
     })
-}
\ No newline at end of file
+}
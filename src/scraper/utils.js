@@ -1,24 +1,39 @@
-function walkAndCollect(comments) {
-        let collected = [];
-        comments.forEach(comment => {
-            if (comment && comment.body && !/I am a bot/.test(comment.body)) {
-                collected.push({
-                    id: comment.id,
-                    body: comment.body,
-                    author: comment.author ? comment.author.name : '[deleted]',
-                    created_utc: comment.created_utc,
-                    parent_id: comment.parent_id,
-                    post_id: comment.link_id,
-                    score: comment.score
-                });
-            }
-            if (comment && comment.replies && comment.replies.length > 0) {
-                collected = collected.concat(walkAndCollect(comment.replies));
-            }
-        });
+// Flattens a Reddit comment listing without recursion or copying.
+// The tree is walked with an explicit stack in pre-order, so a parent is always collected before its replies and a
+// chunk of the output can be upserted without breaking the parent_id foreign key. Comments are pushed onto the
+// caller's array, "more" stubs (replies Reddit left out of the listing) onto the second one.
+function walkAndCollect(things, collected = [], more = []) {
+    const stack = [];
+    for (let i = things.length - 1; i >= 0; i--) stack.push(things[i]);
+
+    while (stack.length > 0) {
+        const thing = stack.pop();
+        if (!thing) continue;
+        if (thing.kind === 'more') {
+            if (thing.data.children && thing.data.children.length > 0) more.push(thing.data);
+            continue;
+        }
+        const comment = thing.data;
+        if (comment && comment.body && !/I am a bot/.test(comment.body)) {
+            collected.push({
+                id: comment.id,
+                body: comment.body,
+                author: comment.author || '[deleted]',
+                created_utc: comment.created_utc,
+                parent_id: comment.parent_id,
+                post_id: comment.link_id,
+                score: comment.score
+            });
+        }
+        // replies is "" when there are none
+        const replies = comment && comment.replies && comment.replies.data ? comment.replies.data.children : null;
+        if (replies) {
+            for (let i = replies.length - 1; i >= 0; i--) stack.push(replies[i]);
+        }
+    }
     return collected;
 }
 
 
 
-module.exports = { walkAndCollect };
\ No newline at end of file
+module.exports = { walkAndCollect };